@@ -13,9 +13,23 @@ Subcommands:
 When installed, run and setup-cwl should be invoked with:
     aquatx <subcommand> --config <config-file>
 
-A configuration file should be supplied for the run subcommand (required)
-and for the setup-cwl subcommand (optional; alternatively you may use the
-word "None" or "none" to obtain only the workflow files). This config file
+The run subcommand executes the CWL workflow with cwltool by default. With
+--engine native, the collapse, count and merge steps instead run within the
+aquatx process, and only fastp, bowtie and DESeq2 are run as subprocesses.
+Samples are then run concurrently within the config's cpu_budget and
+memory_budget.
+
+Both engines cache the results of each step under the config's cache_dir,
+or under the run directory's stage_cache directory by default. An interrupted
+or failed run can be continued with:
+    aquatx run --resume <run-directory>
+which runs the workflow again in the same run directory, skipping the steps
+whose inputs and parameters haven't changed. The run resumes with the engine
+it was last run with, unless --engine is given.
+
+A configuration file should be supplied for the run subcommand (required,
+unless resuming) and for the setup-cwl subcommand (optional; alternatively
+you may use the word "None" or "none" to obtain only the workflow files). This config file
 will be processed and rewritten to reflect the workflow inputs defined under
 the keys ` samples_csv` and `reference_sheet_file` (use get-template for
 more info). Config files that share the same name as the template config file
@@ -23,14 +37,20 @@ will be renamed.
 """
 
 import cwltool.factory
+import ruamel.yaml
 import subprocess
+import json
 import shutil
 import os
 
 from pkg_resources import resource_filename
-from aquatx.srna.Configuration import Configuration
+from aquatx.srna.Configuration import ConfigBase, Configuration
+from aquatx.srna.stage_cache import default_cache_dir
 from argparse import ArgumentParser
 
+# Written to the run directory to record how a run can be resumed
+RESUME_FILE = 'resume.json'
+
 
 def get_args():
     """Parses command line input"""
@@ -45,12 +65,29 @@ def get_args():
         "setup-nextflow": "This subcommand is not yet implemented"
     }
 
-    # Subcommands that require a configuration file argument
+    # Subcommands that require a configuration file argument.
+    # A run is either started from a config file, or resumed from its run directory.
     for command, desc in subcommands_with_configfile.items():
-        subparsers.add_parser(command).add_argument(
-            '--config', metavar='configFile', required=True, help=desc
+        subparser = subparsers.add_parser(command)
+        if command == 'run': subparser = run_source = subparser.add_mutually_exclusive_group(required=True)
+        subparser.add_argument(
+            '--config', metavar='configFile', required=command != 'run', help=desc
         )
 
+    run_source.add_argument(
+        '--resume', metavar='runDirectory',
+        help='Runs the workflow of an earlier run again in its run directory, skipping '
+             'the steps whose results are in its cache'
+    )
+
+    subparsers.choices['run'].add_argument(
+        '--engine', choices=['cwl', 'native'],
+        help='Run the workflow with cwltool (default), or run its Python steps in-process, '
+             'with samples running concurrently within the config\'s cpu_budget and '
+             'memory_budget, and report the time of each stage. Resumed runs default to '
+             'the engine they were last run with'
+    )
+
     # Subcommand get-template has no additional arguments
     subparsers.add_parser("get-template",
                           help="Copies run config, sample, and reference templates to current directory")
@@ -58,7 +95,7 @@ def get_args():
     return parser.parse_args()
 
 
-def run(aquatx_cwl_path: str, config_file: str) -> None:
+def run(aquatx_cwl_path: str, config_file: str, engine: str = 'cwl') -> None:
     """Processes the provided config file and executes the workflow it defines
 
     The provided configuration file will be processed and rewritten to reflect the content
@@ -70,6 +107,8 @@ def run(aquatx_cwl_path: str, config_file: str) -> None:
     Args:
         aquatx_cwl_path: The path to the project's CWL workflow file directory
         config_file: The configuration file for this run.
+        engine: 'cwl' to run the workflow with cwltool, or 'native' to run it with
+            native_runner.run_native()
     """
 
     print("Running the end-to-end analysis...")
@@ -79,10 +118,64 @@ def run(aquatx_cwl_path: str, config_file: str) -> None:
     run_directory = config_object.create_run_directory()
     cwl_conf_file = config_object.write_processed_config()
 
+    # Record how to resume the run
+    with open(os.path.join(run_directory, RESUME_FILE), 'w') as f:
+        json.dump({'config': os.path.abspath(cwl_conf_file), 'cwd': os.getcwd(), 'engine': engine}, f, indent=1)
+
+    run_workflow(aquatx_cwl_path, config_object, cwl_conf_file, engine)
+
+
+def resume(aquatx_cwl_path: str, run_directory: str, engine: str = None) -> None:
+    """Runs the workflow of an earlier run again, in the same run directory
+
+    The processed config of the run is used as it was written, from the directory the
+    run was started in, so the run's relative paths are unchanged. Steps whose inputs and
+    parameters haven't changed since they last completed are restored from the cache.
+
+    Args:
+        aquatx_cwl_path: The path to the project's CWL workflow file directory
+        run_directory: The run directory of the run to resume
+        engine: The engine to resume with. Default: the engine the run was last run with
+    """
+
+    resume_file = os.path.join(run_directory, RESUME_FILE)
+    if not os.path.isfile(resume_file):
+        raise FileNotFoundError(f"{run_directory} is not the run directory of a resumable run.")
+
+    with open(resume_file) as f:
+        saved = json.load(f)
+
+    # An explicit engine replaces the recorded one for this and later resumes
+    if engine is not None and engine != saved['engine']:
+        saved['engine'] = engine
+        with open(resume_file, 'w') as f:
+            json.dump(saved, f, indent=1)
+
+    print(f"Resuming the end-to-end analysis in {run_directory}...")
+    run_directory = os.path.abspath(run_directory)
+    os.chdir(saved['cwd'])
+    with open(saved['config']) as f:
+        config_object = ConfigBase(ruamel.yaml.YAML().load(f))
+    config_object.set('run_directory', run_directory)
+
+    run_workflow(aquatx_cwl_path, config_object, saved['config'], saved['engine'])
+
+
+def run_workflow(aquatx_cwl_path: str, config_object: ConfigBase, cwl_conf_file: str, engine: str) -> None:
+    """Executes the workflow of a processed config with the given engine"""
+
+    run_directory = config_object.get('run_directory')
+    cache_dir = default_cache_dir(run_directory, config_object.get('cache_dir'))
+
+    if engine == 'native':
+        from aquatx.srna.native_runner import run_native
+        run_native(config_object)
+        return
+
     # Run with cwltool
     debug = False
     subprocess.run(f"cwltool --outdir {run_directory} --copy-outputs --on-error 'continue' "
-                   f"{'--leave-tmpdir --debug' if debug else ''} "
+                   f"--cachedir {cache_dir} {'--leave-tmpdir --debug' if debug else ''} "
                    f"{aquatx_cwl_path}/workflows/aquatx_wf.cwl {cwl_conf_file}", shell=True)
 
     # runtime_context = cwltool.factory.RuntimeContext()
@@ -150,7 +243,7 @@ def main():
     """The main routine that determines what type of run to do.
 
     Options:
-        run: Run the end-to-end analysis based on a config file.
+        run: Run the end-to-end analysis based on a config file, or resume an earlier run.
         get-template: Get the input sheets & template config files.
         setup-cwl: Get the CWL workflow for a run
     """
@@ -164,7 +257,8 @@ def main():
 
     # Execute appropriate command based on command line input
     command_map = {
-        "run": lambda: run(aquatx_cwl_path, args.config),
+        "run": lambda: (resume(aquatx_cwl_path, args.resume, args.engine) if args.resume
+                        else run(aquatx_cwl_path, args.config, args.engine or 'cwl')),
         "setup-cwl": lambda: setup_cwl(aquatx_cwl_path, args.config),
         "get-template": lambda: get_template(aquatx_extras_path),
         "setup-nextflow": lambda: setup_nextflow(args.config)
@@ -146,7 +146,7 @@ class Configuration(ConfigBase):
                 self.append_to('in_fq', self.cwl_file(fastq_file))
 
                 self.append_to('out_fq', sample_basename + '_cleaned.fastq')
-                self.append_to('outfile', sample_basename + '_aligned_seqs.sam')
+                self.append_to('outfile', sample_basename + ('_aligned_seqs.bam' if self.get('bam') else '_aligned_seqs.sam'))
                 self.append_to('un', sample_basename + '_unaligned_seqs.fa')
                 self.append_to('json', sample_basename + '_qc.json')
                 self.append_to('html', sample_basename + '_qc.html')
@@ -155,6 +155,8 @@ class Configuration(ConfigBase):
     def process_reference_sheet(self):
         reference_sheet = self.joinpath(self.dir, self.get('features_csv'))
         from_here = os.path.dirname(reference_sheet)
+        # The counter only assigns features by the sheet's rules when asked to
+        if self.get('feature_rules'): self.set('features_sheet', self.cwl_file(reference_sheet))
 
         with open(reference_sheet, 'r', encoding='utf-8-sig') as rf:
             csv_reader = csv.DictReader(rf, delimiter=',')
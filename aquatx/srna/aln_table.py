@@ -0,0 +1,226 @@
+"""
+A buffered, background writer for the counter's intermediate alignment table.
+
+The counter hands the writer each read's assigned alignments as they are tallied. These
+are buffered into batches, and full batches are passed through a bounded queue to a
+writer thread which maps feature and class IDs to names, formats the rows, and writes
+them. Formatting, compression and I/O therefore overlap with feature assignment, and the
+queue bounds the memory held by batches waiting to be written if the writer falls behind.
+
+Tables are written as tab separated text, gzip compressed text, or in the Parquet or
+Feather columnar formats when pyarrow is installed.
+"""
+
+import builtins
+import queue
+import shutil
+import threading
+
+import pandas as pd
+
+from aquatx.srna.compression import get_opener
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# The columns of the alignment table
+COLUMNS = ['seq', 'counts', 'strand', 'start', 'end', 'classes', 'features']
+
+# File extension by table format
+FORMATS = {'txt': '.txt', 'gz': '.txt.gz', 'parquet': '.parquet', 'feather': '.feather'}
+
+# The number of alignments buffered before a batch is queued for writing
+BATCH_SIZE = 50000
+
+# The number of batches which may wait in the queue before the counter blocks
+QUEUE_SIZE = 8
+
+
+def available_formats() -> list:
+    """Returns the table formats which can be written with the installed packages"""
+
+    return [fmt for fmt in FORMATS if fmt in ('txt', 'gz') or pa is not None]
+
+
+class AlnTableWriter:
+    """Writes the intermediate alignment table on a background thread
+
+    Rows are added one read bundle at a time with add(), and previously written text
+    tables (such as those of parallel workers) can be appended in order with add_table().
+    Errors raised by the writer thread are re-raised by the next call to the writer.
+
+    Attributes:
+        path: The file the table is written to
+        fmt: The table format, a key of FORMATS
+    """
+
+    def __init__(self, path: str, registry, fmt: str = 'txt', header: bool = True,
+                 batch_size: int = BATCH_SIZE, queue_size: int = QUEUE_SIZE):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown table format: {fmt}. Choose from: {', '.join(FORMATS)}")
+        if fmt not in available_formats():
+            raise ImportError(f"The {fmt} table format requires pyarrow")
+
+        self.path = path
+        self.fmt = fmt
+        self._registry = registry
+        self._batch_size = batch_size
+        self._batch, self._batch_alns = [], 0
+        self._joined = {'classes': {}, 'features': {}}  # Joined names by tuple of IDs
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+
+        self._open(header)
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+        self._thread.start()
+
+    def add(self, counts: float, assignments: list) -> None:
+        """Adds the alignments of one read, each with the read's per alignment count
+
+        Args:
+            counts: The count of each of the read's alignments
+            assignments: The (sequence, strand, start, end, feature IDs, class IDs) of each
+                alignment, from FeatureAssigner.assign()
+        """
+
+        self._batch.append((counts, assignments))
+        self._batch_alns += len(assignments)
+        if self._batch_alns >= self._batch_size:
+            self._put(('rows', self._batch))
+            self._batch, self._batch_alns = [], 0
+
+    def add_table(self, path: str) -> None:
+        """Appends a headerless tab separated table, returning once it has been written"""
+
+        self._put_batch()
+        self._put(('table', path))
+        self.flush()
+
+    def flush(self) -> None:
+        """Blocks until every queued batch has been written"""
+
+        self._put_batch()
+        self._queue.join()
+        self._raise()
+
+    def close(self) -> None:
+        if self._thread is None: return
+        try:
+            self._put_batch()
+            self._queue.put(None)
+            self._thread.join()
+        finally:
+            self._thread = None
+            self._close()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _put_batch(self) -> None:
+        if self._batch:
+            self._put(('rows', self._batch))
+            self._batch, self._batch_alns = [], 0
+
+    def _put(self, item) -> None:
+        self._raise()
+        self._queue.put(item)
+
+    def _raise(self) -> None:
+        if self._error is not None: raise self._error
+
+    def _consume(self) -> None:
+        """Writes queued items until close(). After an error, items are discarded."""
+
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None: return
+                if self._error is None:
+                    kind, value = item
+                    if kind == 'rows':
+                        self._write_rows(value)
+                    else:
+                        self._write_table(value)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _join_names(self, ids: tuple, column: str, names: list, default: str) -> str:
+        cache = self._joined[column]
+        joined = cache.get(ids)
+        if joined is None:
+            joined = cache[ids] = ';'.join(sorted(names[i] for i in ids))
+        return joined or default
+
+    def _open(self, header: bool) -> None:
+        if self.fmt in ('txt', 'gz'):
+            opener = builtins.open if self.fmt == 'txt' else get_opener('gzip', level=6)
+            self._file = opener(self.path, 'wb')
+            if header: self._file.write(('\t'.join(COLUMNS) + '\n').encode())
+            return
+
+        self._schema = pa.schema([('seq', pa.string()), ('counts', pa.float64()),
+                                  ('strand', pa.string()), ('start', pa.int64()),
+                                  ('end', pa.int64()), ('classes', pa.string()),
+                                  ('features', pa.string())])
+        if self.fmt == 'parquet':
+            self._file = pq.ParquetWriter(self.path, self._schema)
+        else:
+            # Feather files are Arrow IPC files, compressed with lz4 as by pyarrow.feather
+            options = pa.ipc.IpcWriteOptions(compression='lz4')
+            self._file = pa.ipc.new_file(self.path, self._schema, options=options)
+
+    def _close(self) -> None:
+        self._file.close()
+
+    def _write_rows(self, batch: list) -> None:
+        class_names, feat_names = self._registry.class_names, self._registry.feature_names
+        rows = [(seq, counts, strand, start, end,
+                 self._join_names(classes, 'classes', class_names, '_no_class'),
+                 self._join_names(feats, 'features', feat_names, '_no_feature'))
+                for counts, assignments in batch
+                for seq, strand, start, end, feats, classes in assignments]
+
+        if self.fmt in ('txt', 'gz'):
+            self._file.write(''.join(f"{seq}\t{counts}\t{strand}\t{start}\t{end}\t{classes}\t{feats}\n"
+                                     for seq, counts, strand, start, end, classes, feats in rows)
+                             .encode())
+        else:
+            self._write_batch(pd.DataFrame(rows, columns=COLUMNS))
+
+    def _write_table(self, path: str) -> None:
+        if self.fmt in ('txt', 'gz'):
+            with builtins.open(path, 'rb') as f:
+                shutil.copyfileobj(f, self._file)
+            return
+
+        dtypes = {'seq': str, 'counts': float, 'strand': str, 'start': int, 'end': int,
+                  'classes': str, 'features': str}
+        for chunk in pd.read_csv(path, sep='\t', header=None, names=COLUMNS, dtype=dtypes,
+                                 keep_default_na=False, chunksize=self._batch_size):
+            self._write_batch(chunk)
+
+    def _write_batch(self, df: pd.DataFrame) -> None:
+        table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        if self.fmt == 'parquet':
+            self._file.write_table(table)
+        else:
+            self._file.write(table)
+
+
+def read_aln_table(path: str) -> pd.DataFrame:
+    """Reads an alignment table written in any of the FORMATS"""
+
+    if path.endswith(FORMATS['parquet']):
+        return pd.read_parquet(path)
+    if path.endswith(FORMATS['feather']):
+        return pd.read_feather(path)
+    return pd.read_csv(path, sep='\t', keep_default_na=False)
@@ -4,24 +4,55 @@ will contain the number of times each sequence occurred in the input fastq file,
 an ID which indicates the relative order in which each sequence was first encountered.
 Gzipped files are automatically supported for fastq inputs, and compressed fasta outputs
 are available by request.
+
+Multiple fastq files can be collapsed together. Each sample is written to its own fasta
+file using IDs from a shared index of every unique sequence in the cohort. The index is
+written as a single fasta file, alongside a sequences x samples count matrix.
 """
 
 import argparse
 import builtins
 import gzip
+import itertools
 import os
 
-from collections import OrderedDict
+import numpy as np
+
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
-from typing import Tuple
+from typing import Iterable, Iterator, List, Tuple
+
+from aquatx.srna.compression import BACKENDS, get_opener
+from aquatx.srna.scheduler import process_context
+from aquatx.srna.seq_table import SeqCountTable
+from aquatx.srna.spill_table import SpillingCountTable, parse_size
 
 try:
     from _collections import _count_elements  # Load Counter's C helper function if it is available
 except ImportError:
     from collections import _count_elements   # Slower mapping[elem] = mapping.get(elem,default_val)+1
 
-# The GZIP read/write interface used by seq_counter() and seq2fasta()
-gz_f = partial(gzip.GzipFile, compresslevel=6, fileobj=None, mtime=0)
+# The default GZIP read/write interface used by seq_counter() and seq2fasta()
+gz_f = get_opener('gzip', level=6)
+
+# The number of bytes read at a time by the block parsing engine
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# The size of the record-aligned blocks handed to each worker in parallel mode
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# The smallest chunk size used to keep parallel counting within a memory budget
+MIN_CHUNK_SIZE = 64 * 1024
+
+# The number of fasta records formatted per write by seq2fasta()
+FASTA_BATCH_SIZE = 100000
+
+# The 5' nucleotides tallied by nt_len_histogram(). Any other base is tallied as N.
+HISTOGRAM_NTS = 'ACGTN'
+_NT_ROWS = np.full(256, HISTOGRAM_NTS.index('N'), dtype=np.int64)
+for _row, _nt in enumerate(HISTOGRAM_NTS):
+    _NT_ROWS[ord(_nt)] = _row
 
 
 def get_args() -> 'argparse.NameSpace':
@@ -32,14 +63,17 @@ def get_args() -> 'argparse.NameSpace':
 
     # Required arguments
     required_group.add_argument(
-        '-i', '--input-file', metavar='FASTQFILE', required=True, help=
-        'The input fastq file to collapse'
+        '-i', '--input-file', metavar='FASTQFILE', required=True, nargs='+', help=
+        'The input fastq file to collapse. If multiple files are given, they are '
+        'collapsed together with a shared sequence index'
     )
 
     required_group.add_argument(
         '-o', '--out-prefix', metavar='OUTPREFIX', required=True, help=
         'The prefix for output files {prefix}_collapsed.fa and, if '
-        'counts fall below threshold, {prefix}_collapsed_lowcounts.fa'
+        'counts fall below threshold, {prefix}_collapsed_lowcounts.fa. '
+        'For multiple inputs, these files hold the shared index and '
+        'the count matrix is written to {prefix}_count_matrix.npz'
     )
 
     def positive_threshold(t):
@@ -60,41 +94,565 @@ def get_args() -> 'argparse.NameSpace':
         help='Use gzip compression when writing fasta outputs'
     )
 
+    parser.add_argument(
+        '-d', '--nt-len-dist', required=False, action='store_true',
+        help='Also write the 5\' nucleotide x length distribution of all reads to '
+        '{prefix}_nt_len_dist_reads.csv and of unique sequences to {prefix}_nt_len_dist_unique.csv'
+    )
+
+    parser.add_argument(
+        '-p', '--sample-prefixes', metavar='SAMPLEPREFIX', required=False, nargs='+',
+        help='The output prefix for each input file when collapsing multiple inputs. '
+        'Default: {prefix}_{input file name}'
+    )
+
+    def positive_workers(w):
+        if int(w) >= 1:
+            return int(w)
+        else:
+            raise argparse.ArgumentTypeError("Workers must be >= 1")
+
+    def compression_level(l):
+        if 1 <= int(l) <= 9:
+            return int(l)
+        else:
+            raise argparse.ArgumentTypeError("Compression level must be between 1 and 9")
+
+    parser.add_argument(
+        '-l', '--compress-level', default=6, required=False, type=compression_level,
+        help='The gzip compression level (1-9) used when writing fasta outputs'
+    )
+
+    parser.add_argument(
+        '-g', '--gz-backend', default='gzip', required=False, choices=list(BACKENDS),
+        help='The gzip implementation used for compressed inputs and outputs. The threaded '
+        'backend decompresses ahead of counting and compresses blocks in parallel'
+    )
+
+    parser.add_argument(
+        '--gz-threads', default=4, required=False, type=positive_workers,
+        help='The number of threads used by the threaded gzip backend'
+    )
+
+    parser.add_argument(
+        '-e', '--engine', default='block', required=False, choices=['block', 'readline'],
+        help='The fastq parser to use when counting sequences. The readline engine '
+        'is slower and is provided for benchmarking'
+    )
+
+    parser.add_argument(
+        '-k', '--compact', required=False, action='store_true',
+        help='Count sequences in a compact array-backed table. This uses much less '
+        'memory for libraries with many unique sequences'
+    )
+
+    def memory_size(m):
+        try:
+            return parse_size(m)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+
+    parser.add_argument(
+        '-m', '--max-memory', default=None, required=False, type=memory_size,
+        help='The approximate memory limit for counting, e.g. 4G. Unique sequences '
+        'beyond this limit are spilled to temporary files in partitions, which are '
+        'collapsed separately and merged in their original order'
+    )
+
+    parser.add_argument(
+        '--spill-dir', default=None, required=False,
+        help='The directory for temporary files when --max-memory is used. '
+        'Default: the system temporary directory'
+    )
+
+    parser.add_argument(
+        '-w', '--workers', default=1, required=False, type=positive_workers,
+        help='The number of processes to use for counting sequences. Values '
+        'greater than 1 split the input into chunks which are counted in parallel'
+    )
+
     return parser.parse_args()
 
 
-def seq_counter(fastq_file: str, file_reader: callable = builtins.open) -> 'OrderedDict':
+def seq_counter(fastq_file: str, file_reader: callable = builtins.open, *, engine: str = 'block',
+                workers: int = 1, gz_reader: callable = None, compact: bool = False,
+                max_memory: int = None, spill_dir: str = None) -> 'OrderedDict':
     """Counts the number of times each sequence appears
 
     Args:
         fastq_file: A trimmed, quality filtered, optionally gzip compressed fastq file.
-        file_reader: The file context manager to use. Must support .readline() and 'rb'
-
-    Returns: An ordered dictionary of unique sequences with associated counts.
+        file_reader: The file context manager to use. Must support .read(), .readline() and 'rb'
+    Keyword Args:
+        engine: The fastq parser to count with. "block" (default) reads large blocks and
+            counts sequences as raw bytes. "readline" reads four lines per record and
+            counts sequences as decoded strings.
+        workers: The number of processes to count with. If greater than 1, the input
+            is counted in record-aligned chunks by parallel_seq_counter()
+        gz_reader: The file context manager to switch to for gzipped inputs. Default: gz_f
+        compact: If true, counts are kept in a SeqCountTable rather than an OrderedDict.
+            The table iterates in the same order but uses far less memory.
+        max_memory: If given, counts are kept in a SpillingCountTable which spills to disk
+            once it holds approximately this many bytes. Takes precedence over compact.
+        spill_dir: The directory for spill files. Default: the system temporary directory
+
+    Returns: An ordered dictionary (or SeqCountTable/SpillingCountTable) of unique sequences
+        with associated counts.
     """
 
-    with file_reader(fastq_file, 'rb') as f:
-        def line_generator():    # Generator function for every 4th line (fastq sequence line) of file
-            while f.readline():  # Sequence identifier
-                # Sequence (Binary -> ASCII extract every 4th from 1st line, newline removed)
-                yield f.readline()[:-1].decode("utf-8")
-                f.readline()     # "+"
-                f.readline()     # Quality Score
+    if gz_reader is None: gz_reader = gz_f
+    table_kwargs = dict(compact=compact, max_memory=max_memory, spill_dir=spill_dir)
+    if workers > 1: return parallel_seq_counter(fastq_file, workers, gz_reader=gz_reader, **table_kwargs)
 
+    with file_reader(fastq_file, 'rb') as f:
         # Switch file_reader interface if reading gzipped fastq files
-        if f.read(2) == b'\x1F\x8B': return seq_counter(fastq_file, gz_f)
+        head = f.read(2)
+        if head == b'\x1F\x8B': return seq_counter(fastq_file, gz_reader, engine=engine, **table_kwargs)
 
         # Count occurrences of unique sequences while maintaining insertion order
-        seqs = OrderedDict()
-        _count_elements(seqs, line_generator())
+        seqs = _new_table(**table_kwargs)
+        ENGINES[engine](f, seqs, head)
+
+    if isinstance(seqs, dict):
+        seqs.pop(b"", None)  # Remove blank line counts from the dictionary
+        seqs.pop("", None)
+    else:
+        seqs.flush()  # Blank lines are never stored in the table
+    return seqs
+
+
+def _new_table(compact: bool = False, max_memory: int = None, spill_dir: str = None):
+    """Returns an empty OrderedDict, SeqCountTable, or SpillingCountTable for counting"""
+
+    if max_memory is not None: return SpillingCountTable(max_memory, spill_dir=spill_dir)
+    return SeqCountTable() if compact else OrderedDict()
+
+
+def _counter(seqs) -> callable:
+    """Returns a function which counts an iterable of sequences into seqs (a dict or count table)"""
+
+    return partial(_count_elements, seqs) if isinstance(seqs, dict) else seqs.count
+
+
+def readline_engine(f, seqs: dict, head: bytes = b'') -> None:
+    """Counts sequences by reading each record with four calls to .readline()
+
+    Args:
+        f: The binary file object to read from. Its first record header may be partially consumed.
+        seqs: The dictionary or count table to count decoded sequences in
+        head: The bytes already consumed from f. They belong to the first header, so they're ignored.
+    """
+
+    def line_generator():    # Generator function for every 4th line (fastq sequence line) of file
+        while f.readline():  # Sequence identifier
+            # Sequence (Binary -> ASCII extract every 4th from 1st line, newline removed)
+            yield f.readline()[:-1].decode("utf-8")
+            f.readline()     # "+"
+            f.readline()     # Quality Score
+
+    _counter(seqs)(line_generator())
+
+
+def block_engine(f, seqs: dict, head: bytes = b'', block_size: int = BLOCK_SIZE) -> None:
+    """Counts sequences by splitting large blocks of the file into lines in bulk
+
+    Each block is split on newlines and every 4th line is taken by slicing. Lines that
+    don't complete a record are carried over to the next block. Sequences are counted
+    as raw bytes and are only decoded when they are written by seq2fasta().
+
+    Args:
+        f: The binary file object to read from
+        seqs: The dictionary or count table to count sequences in
+        head: The bytes already consumed from f, which are prepended to the first block
+        block_size: The number of bytes to read at a time
+    """
+
+    count = _counter(seqs)
+    remainder = head
+    while True:
+        data = f.read(block_size)
+        if not data: break
+
+        lines = (remainder + data).split(b'\n')
+        # The last line is incomplete, so only records before it are counted
+        complete = (len(lines) - 1) // 4 * 4
+        count(lines[1:complete:4])
+        remainder = b'\n'.join(lines[complete:])
+
+    count(remainder.split(b'\n')[1::4])
+
+
+# The fastq parsers available to seq_counter()
+ENGINES = {'block': block_engine, 'readline': readline_engine}
+
+
+def parallel_seq_counter(fastq_file: str, workers: int, chunk_size: int = CHUNK_SIZE,
+                         gz_reader: callable = None, compact: bool = False,
+                         max_memory: int = None, spill_dir: str = None) -> 'OrderedDict':
+    """Counts the number of times each sequence appears using a pool of worker processes
+
+    Uncompressed inputs are divided into record-aligned byte ranges, one per worker, and
+    each worker reads and counts its own range. Gzipped inputs can't be seeked, so they
+    are decompressed here and record-aligned blocks of the decompressed stream are sent
+    to the workers instead. Per-chunk counts are merged in file order, so each sequence
+    keeps the position of its first occurrence and the result is identical to seq_counter().
+
+    With a memory budget, half of the budget is given to the count table, and the other
+    half to the chunks in flight: uncompressed inputs are then divided into ranges no
+    larger than the chunk size, and the chunk size is reduced so that the counts of the
+    2 x workers pending chunks (roughly twice their size each) fit in that half.
+
+    Args:
+        fastq_file: A trimmed, quality filtered, optionally gzip compressed fastq file.
+        workers: The number of worker processes to count with
+        chunk_size: The approximate size, in bytes, of the blocks read at a time
+        gz_reader: The file context manager used to decompress gzipped inputs. Default: gz_f
+        compact: If true, chunk counts are merged into a SeqCountTable
+        max_memory: If given, chunk counts are merged into a SpillingCountTable with this budget
+        spill_dir: The directory for spill files. Default: the system temporary directory
+
+    Returns: An ordered dictionary (or count table) of unique sequences with associated counts.
+    """
+
+    n_ranges = workers
+    if max_memory is not None:
+        chunk_size = max(min(chunk_size, max_memory // (8 * workers)), MIN_CHUNK_SIZE)
+        n_ranges = max(workers, -(-os.path.getsize(fastq_file) // chunk_size))
+        max_memory //= 2
+
+    seqs = _new_table(compact, max_memory, spill_dir)
+    with open(fastq_file, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1F\x8B'
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=process_context()) as pool:
+        if is_gzip:
+            with (gz_reader or gz_f)(fastq_file, 'rb') as f:
+                jobs = (partial(_count_block, block) for block in _record_blocks(f, chunk_size))
+                _merge_counts(pool, jobs, workers * 2, seqs)
+        else:
+            ranges = _record_ranges(fastq_file, n_ranges)
+            jobs = (partial(_count_range, fastq_file, start, end, chunk_size) for start, end in ranges)
+            _merge_counts(pool, jobs, workers * 2 if max_memory is not None else workers, seqs)
+
+    if isinstance(seqs, dict):
+        seqs.pop(b"", None)  # Remove blank line counts from the dictionary
+    else:
+        seqs.flush()
+    return seqs
+
+
+def _merge_counts(pool: ProcessPoolExecutor, jobs: Iterator[callable], max_pending: int, seqs) -> None:
+    """Submits jobs to the pool and merges their counts into seqs in submission order
+
+    No more than max_pending jobs are held at once so that blocks from large gzipped
+    inputs aren't all decompressed into memory before they can be counted.
+    """
+
+    pending = deque()
+
+    def merge(chunk):
+        if isinstance(seqs, dict):
+            for seq, count in chunk.items():
+                seqs[seq] = seqs.get(seq, 0) + count
+        else:
+            seqs.add_counts(chunk)
+
+    for job in jobs:
+        pending.append(pool.submit(job))
+        if len(pending) >= max_pending:
+            merge(pending.popleft().result())
+    while pending:
+        merge(pending.popleft().result())
+
+
+def _count_block(block: bytes) -> 'OrderedDict':
+    """Counts sequences in a block of whole fastq records"""
+
+    seqs = OrderedDict()
+    _count_elements(seqs, block.split(b'\n')[1::4])
+    return seqs
+
+
+def _count_range(fastq_file: str, start: int, end: int, chunk_size: int) -> 'OrderedDict':
+    """Counts sequences in the record-aligned byte range [start, end) of an uncompressed fastq file"""
+
+    seqs = OrderedDict()
+    with open(fastq_file, 'rb') as f:
+        f.seek(start)
+        for block in _record_blocks(f, chunk_size, end - start):
+            _count_elements(seqs, block.split(b'\n')[1::4])
 
-    seqs.pop("", None)  # Remove blank line counts from the dictionary
     return seqs
 
 
-def seq2fasta(seqs: dict, out_prefix: str, thresh: int = 0, gz: bool = False, **kwargs) -> None:
+def _record_blocks(f, chunk_size: int, limit: int = -1) -> Iterator[bytes]:
+    """Yields blocks of whole fastq records from a binary stream positioned at a record start
+
+    Args:
+        f: The binary file object to read from
+        chunk_size: The number of bytes to read at a time
+        limit: The total number of bytes to read, or -1 to read to the end of the stream
+    """
+
+    remainder = b''
+    while limit:
+        data = f.read(chunk_size if limit < 0 else min(chunk_size, limit))
+        if not data: break
+        if limit > 0: limit -= len(data)
+
+        buf = remainder + data
+        cut = _last_record_start(buf)
+        if cut: yield buf[:cut]
+        remainder = buf[cut:]
+
+    if remainder: yield remainder
+
+
+def _last_record_start(buf: bytes) -> int:
+    """Returns the offset of the last complete-looking record header in buf, or 0 if there is none
+
+    Quality lines may also begin with "@", so a header is only accepted if the line two
+    below it begins with "+". The record beginning there may still be incomplete, so
+    everything from the returned offset onward should be carried over to the next block.
+    """
+
+    pos = len(buf)
+    while pos > 0:
+        pos = buf.rfind(b'\n@', 0, pos)
+        if pos < 0: return 0
+        start = pos + 1
+        seq_end = buf.find(b'\n', start)
+        seq_end = buf.find(b'\n', seq_end + 1) if seq_end >= 0 else -1
+        if seq_end >= 0 and buf.startswith(b'+', seq_end + 1):
+            return start
+
+    return 0
+
+
+def _record_ranges(fastq_file: str, n: int) -> list:
+    """Divides an uncompressed fastq file into n byte ranges which begin at record headers"""
+
+    size = os.path.getsize(fastq_file)
+    bounds = [0]
+    with open(fastq_file, 'rb') as f:
+        for i in range(1, n):
+            f.seek(max(size * i // n, bounds[-1]))
+            f.readline()  # Discard the (likely partial) line at the seek position
+            bounds.append(_next_record_start(f, size))
+    bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def _next_record_start(f, size: int) -> int:
+    """Returns the offset of the first record header at or after the current line of f"""
+
+    while True:
+        offset = f.tell()
+        lines = [f.readline() for _ in range(3)]
+        if not lines[2]: return size
+        if lines[0].startswith(b'@') and lines[2].startswith(b'+'): return offset
+        f.seek(offset + len(lines[0]))
+
+
+def collapse_samples(fastq_files: List[str], out_prefix: str, sample_prefixes: List[str] = None,
+                     thresh: int = 0, gz: bool = False, gz_writer: callable = None,
+                     nt_len_dist: bool = False, **counter_kwargs) -> SeqCountTable:
+    """Collapses multiple fastq files against a shared index of unique sequences
+
+    Samples are counted one at a time by seq_counter(). Each sample's sequences are
+    added to the shared index, which assigns IDs in the order sequences are first seen
+    across the cohort, and the sample is written to its own fasta file using those IDs.
+    The same sequence therefore has the same ID in every sample's fasta file, and the
+    index only needs to be aligned once for the whole cohort.
+
+    Outputs:
+        {sample_prefix}_collapsed.fa: Each sample's sequences with the sample's counts
+        {out_prefix}_collapsed.fa: The shared index with counts totalled across samples
+        {out_prefix}_count_matrix.npz: The sequences x samples count matrix (see write_count_matrix())
+
+    Args:
+        fastq_files: The fastq files to collapse, one per sample
+        out_prefix: The prefix for the index fasta and the count matrix
+    Keyword Args:
+        sample_prefixes: The output prefix for each sample. Default: {out_prefix}_{file name}
+        thresh: Sequences with count LE thresh are placed in separate low count files
+        gz: If true, fasta outputs will be gzip compressed
+        gz_writer: The file context manager used for compressed outputs. Default: gz_f
+        nt_len_dist: If true, each sample's 5' nt x length distributions are written
+            by write_nt_len_histogram()
+        counter_kwargs: Keyword arguments for seq_counter()
+
+    Returns: The shared index, a SeqCountTable of total counts in ID order
+    """
+
+    if sample_prefixes is None:
+        sample_prefixes = [f"{out_prefix}_{sample_name(fastq)}" for fastq in fastq_files]
+    if len(sample_prefixes) != len(fastq_files):
+        raise ValueError("Collapser critical error: the number of sample prefixes must match the number of inputs.")
+    if len(set(sample_prefixes + [out_prefix])) != len(sample_prefixes) + 1:
+        raise ValueError("Collapser critical error: sample prefixes and the output prefix must be unique.")
+
+    # Check every output before counting
+    matrix_file = f"{out_prefix}_count_matrix.npz"
+    for prefix in sample_prefixes + [out_prefix]:
+        look_before_you_leap(prefix, gz)
+    if os.path.isfile(matrix_file):
+        raise FileExistsError(f"Collapser critical error: {matrix_file} already exists.")
+
+    index, columns = SeqCountTable(), []
+    for fastq, prefix in zip(fastq_files, sample_prefixes):
+        seqs = seq_counter(fastq, **counter_kwargs)
+        ids, counts = _add_to_index(index, seqs)
+        seq2fasta(seqs, prefix, thresh, gz, gz_writer, ids=ids)
+        if nt_len_dist: write_nt_len_histogram(nt_len_histogram(seqs), prefix)
+        columns.append((ids, counts))
+        del seqs
+
+    seq2fasta(index, out_prefix, thresh, gz, gz_writer)
+    write_count_matrix(matrix_file, columns, len(index), sample_prefixes)
+    return index
+
+
+def _add_to_index(index: SeqCountTable, seqs) -> Tuple[np.ndarray, np.ndarray]:
+    """Adds a sample's counts to the shared index
+
+    Returns: The sample's sequence IDs and counts, in the sample's order
+    """
+
+    if isinstance(seqs, dict):
+        return index.add_counts(seqs), np.fromiter(seqs.values(), dtype=np.uint64, count=len(seqs))
+
+    ids, counts, items = [], [], iter(seqs.items())
+    while True:
+        batch = dict(itertools.islice(items, FASTA_BATCH_SIZE))
+        if not batch: break
+        ids.append(index.add_counts(batch))
+        counts.append(np.fromiter(batch.values(), dtype=np.uint64, count=len(batch)))
+
+    if not ids: return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+    return np.concatenate(ids), np.concatenate(counts)
+
+
+def sample_name(fastq_file: str) -> str:
+    """Returns the file name of a fastq file without its directory or fastq/gzip extensions"""
+
+    name = os.path.basename(fastq_file)
+    for ext in ['.gz', '.fastq', '.fq']:
+        if name.endswith(ext): name = name[:-len(ext)]
+    return name
+
+
+def write_count_matrix(matrix_file: str, columns: List[Tuple[np.ndarray, np.ndarray]],
+                       n_seqs: int, samples: List[str]) -> None:
+    """Saves a sequences x samples count matrix in compressed sparse column form
+
+    The .npz file holds the arrays data, indices, indptr and shape, which can be passed
+    directly to scipy.sparse.csc_matrix((data, indices, indptr), shape), and an array
+    of sample names. Row i is the sequence with ID i in the shared index.
+
+    Args:
+        matrix_file: The .npz file to write
+        columns: (sequence IDs, counts) arrays for each sample
+        n_seqs: The number of sequences in the shared index
+        samples: The name of each sample (column)
+    """
+
+    indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+    indices, data = [], []
+    for i, (ids, counts) in enumerate(columns):
+        order = np.argsort(ids, kind='stable')
+        indices.append(ids[order])
+        data.append(counts[order])
+        indptr[i + 1] = indptr[i] + len(ids)
+
+    np.savez_compressed(
+        matrix_file,
+        data=np.concatenate(data) if data else np.zeros(0, dtype=np.uint64),
+        indices=np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64),
+        indptr=indptr,
+        shape=np.array([n_seqs, len(columns)]),
+        samples=np.array(samples)
+    )
+
+
+def load_count_matrix(matrix_file: str) -> Tuple[np.ndarray, List[str]]:
+    """Loads a count matrix written by write_count_matrix() as a dense array
+
+    Returns:
+        matrix: A sequences x samples array of counts
+        samples: The name of each sample (column)
+    """
+
+    with np.load(matrix_file) as npz:
+        matrix = np.zeros(tuple(npz['shape']), dtype=np.uint64)
+        indptr = npz['indptr']
+        for col in range(matrix.shape[1]):
+            start, end = indptr[col], indptr[col + 1]
+            matrix[npz['indices'][start:end], col] = npz['data'][start:end]
+
+        return matrix, npz['samples'].tolist()
+
+
+def nt_len_histogram(seqs) -> Tuple[np.ndarray, np.ndarray]:
+    """Tallies the 5' nucleotide and length of each unique sequence
+
+    The histogram is computed from the collapsed counts, so the fastq file isn't read
+    a second time and each unique sequence is only visited once.
+
+    Args:
+        seqs: A dictionary or count table containing sequences (str or bytes) and associated counts
+
+    Returns:
+        unique: A HISTOGRAM_NTS x length array of unique sequence counts
+        reads: A HISTOGRAM_NTS x length array of read counts
+    """
+
+    unique = np.zeros((len(HISTOGRAM_NTS), 0), dtype=np.int64)
+    reads = np.zeros((len(HISTOGRAM_NTS), 0), dtype=np.int64)
+
+    items = iter(seqs.items())
+    while True:
+        batch = list(itertools.islice(items, FASTA_BATCH_SIZE))
+        if not batch: break
+
+        batch_seqs = [seq.encode('utf-8') if isinstance(seq, str) else seq for seq, _ in batch]
+        counts = np.fromiter((count for _, count in batch), dtype=np.int64, count=len(batch))
+        lengths = np.fromiter(map(len, batch_seqs), dtype=np.int64, count=len(batch))
+        first = np.frombuffer(b''.join(seq[:1] for seq in batch_seqs), dtype=np.uint8)
+        rows = _NT_ROWS[first]
+
+        # Tally flat (nucleotide, length) indices, growing the arrays to the longest sequence
+        width = max(unique.shape[1], int(lengths.max()) + 1)
+        flat = rows * width + lengths
+        size = len(HISTOGRAM_NTS) * width
+        unique = np.pad(unique, ((0, 0), (0, width - unique.shape[1])))
+        reads = np.pad(reads, ((0, 0), (0, width - reads.shape[1])))
+        unique += np.bincount(flat, minlength=size).reshape(-1, width)
+        reads += np.bincount(flat, weights=counts, minlength=size).astype(np.int64).reshape(-1, width)
+
+    return unique, reads
+
+
+def write_nt_len_histogram(histograms: Tuple[np.ndarray, np.ndarray], out_prefix: str) -> None:
+    """Writes the histograms from nt_len_histogram() to CSV files
+
+    Outputs {out_prefix}_nt_len_dist_unique.csv and {out_prefix}_nt_len_dist_reads.csv.
+    Each row is a sequence length and each column is a 5' nucleotide.
+    """
+
+    for name, hist in zip(['unique', 'reads'], histograms):
+        with open(f"{out_prefix}_nt_len_dist_{name}.csv", 'w') as f:
+            f.write(','.join(['Length'] + list(HISTOGRAM_NTS)) + '\n')
+            for length in range(1, hist.shape[1]):
+                f.write(','.join(map(str, [length] + hist[:, length].tolist())) + '\n')
+
+
+def seq2fasta(seqs: dict, out_prefix: str, thresh: int = 0, gz: bool = False,
+              gz_writer: callable = None, ids: Iterable[int] = None, **kwargs) -> None:
     """Converts a sequence count dictionary to a fasta file, with count filtering
 
+    Records are streamed to the output file(s) in a single pass by write_fasta_records().
+
     If a threshold is specified, sequences with count > thresh will be written to
     {out_prefix}_collapsed.fa, and sequences with count <= thresh will be written
     to {out_prefix}_collapsed_lowcounts.fa. If the specified threshold results in
@@ -110,11 +668,13 @@ def seq2fasta(seqs: dict, out_prefix: str, thresh: int = 0, gz: bool = False, **
     ID will be 1 not n+1.
 
     Args:
-        seqs: A dictionary containing sequences and associated counts
+        seqs: A dictionary or count table containing sequences (str or bytes) and associated counts
         out_prefix: A prefix name for the output fasta files
     Keyword Args:
         thresh: Sequences with count LE thresh will placed in a separate file
         gz: If true, fasta outputs will be gzip compressed
+        gz_writer: The file context manager used for compressed outputs. Default: gz_f
+        ids: The ID of each sequence, in the same order as seqs. Default: 0, 1, 2...
 
     Returns: None
     """
@@ -122,24 +682,61 @@ def seq2fasta(seqs: dict, out_prefix: str, thresh: int = 0, gz: bool = False, **
     assert out_prefix is not None, "Collapser critical error: an output file prefix must be specified."
     assert thresh >= 0, "An invalid threshold was specified."
 
-    writer, encoder, mode = fasta_interface(gz)
+    writer, encoder, mode = fasta_interface(gz, gz_writer)
     out_file, low_count_file = look_before_you_leap(out_prefix, gz)
 
-    def to_fasta_record(x):
-        # x[0]=ID, x[1][1]=sequence count, x[1][0]=sequence
-        return ">%d_count=%d\n%s" % (x[0], x[1][1], x[1][0])
-
-    above_thresh = filter(lambda x: x[1][1] > thresh, enumerate(seqs.items()))
-    below_thresh = filter(lambda x: x[1][1] <= thresh, enumerate(seqs.items()))
-
     with writer(out_file, mode) as fasta:
 
         if thresh == 0:  # No filtering required
-            fasta.write(encoder('\n'.join(map(to_fasta_record, enumerate(seqs.items())))))
+            write_fasta_records(seqs.items(), encoder, fasta, ids=ids)
         else:
             with writer(low_count_file, mode) as lowfa:
-                fasta.write(encoder('\n'.join(map(to_fasta_record, above_thresh))))
-                lowfa.write(encoder('\n'.join(map(to_fasta_record, below_thresh))))
+                write_fasta_records(seqs.items(), encoder, fasta, lowfa, thresh, ids=ids)
+
+
+def write_fasta_records(records: Iterator[tuple], encoder: callable, fasta, lowfa=None,
+                        thresh: int = 0, batch_size: int = FASTA_BATCH_SIZE,
+                        ids: Iterable[int] = None) -> None:
+    """Streams (sequence, count) records to one or two fasta files in a single pass
+
+    Records are assigned IDs in the order they are received, unless ids are given, and
+    are routed to the low count file if their count is <= thresh. Formatted records are
+    accumulated in batches of batch_size per file, so only a fixed number of records is
+    held in memory at a time. The output is identical to joining every record of each
+    file with newlines.
+
+    Args:
+        records: An iterable of (sequence, count) pairs. Sequences may be str or bytes.
+        encoder: Converts formatted text for writing to the file handles
+        fasta: The file handle for records with count > thresh
+        lowfa: The file handle for records with count <= thresh. If None, no filtering is done.
+        thresh: The count threshold for the low count file
+        batch_size: The number of records to format before each write
+        ids: The ID of each record. Default: 0, 1, 2...
+    """
+
+    handles = (fasta, lowfa)
+    batches = ([], [])
+    started = [False, False]
+
+    def flush(i):
+        if not batches[i]: return
+        # Records are separated by newlines, and the final record has no trailing newline
+        text = '\n'.join(batches[i])
+        handles[i].write(encoder('\n' + text if started[i] else text))
+        started[i] = True
+        batches[i].clear()
+
+    filtering = lowfa is not None
+    ids = itertools.count() if ids is None else ids
+    for seq_id, (seq, count) in zip(ids, records):
+        if isinstance(seq, bytes): seq = seq.decode('utf-8')
+        i = filtering and count <= thresh
+        batches[i].append(">%d_count=%d\n%s" % (seq_id, count, seq))
+        if len(batches[i]) >= batch_size: flush(i)
+
+    flush(0)
+    if filtering: flush(1)
 
 
 def look_before_you_leap(out_prefix: str, gz: bool) -> (str, str):
@@ -154,13 +751,13 @@ def look_before_you_leap(out_prefix: str, gz: bool) -> (str, str):
     return tuple(candidates)
 
 
-def fasta_interface(gz: bool) -> Tuple[callable, callable, str]:
-    """Switches to writing via gzip.GzipFile() if fasta compression is specified"""
+def fasta_interface(gz: bool, gz_writer: callable = None) -> Tuple[callable, callable, str]:
+    """Switches to writing via gz_writer (default: gz_f) if fasta compression is specified"""
 
     if gz:
         # Writing gzip requires byte array input
         def encoder(x): return x.encode('utf-8')
-        writer, mode = gz_f, 'wb'
+        writer, mode = gz_writer or gz_f, 'wb'
     else:
         # No gzip, no conversion
         def encoder(x): return x
@@ -174,10 +771,22 @@ def main():
     args = get_args()
     # Ensure that the provided prefix will not result in overwritten output files
     look_before_you_leap(args.out_prefix, args.compress)
-    # Count unique sequences in input fastq file
-    seqs = seq_counter(args.input_file)
-    # Write counted sequences to output file(s)
-    seq2fasta(seqs, args.out_prefix, args.threshold, args.compress)
+    # Select the gzip implementation for compressed inputs and outputs
+    gz_opener = get_opener(args.gz_backend, args.compress_level, args.gz_threads)
+    counter_kwargs = dict(engine=args.engine, workers=args.workers, gz_reader=gz_opener, compact=args.compact,
+                          max_memory=args.max_memory, spill_dir=args.spill_dir)
+
+    if len(args.input_file) > 1 or args.sample_prefixes:
+        # Collapse all samples against a shared sequence index
+        collapse_samples(args.input_file, args.out_prefix, args.sample_prefixes, args.threshold,
+                         args.compress, gz_writer=gz_opener, nt_len_dist=args.nt_len_dist, **counter_kwargs)
+    else:
+        # Count unique sequences in input fastq file
+        seqs = seq_counter(args.input_file[0], **counter_kwargs)
+        # Write counted sequences to output file(s)
+        seq2fasta(seqs, args.out_prefix, args.threshold, args.compress, gz_writer=gz_opener)
+        # Write the 5' nt x length distributions of the counted sequences
+        if args.nt_len_dist: write_nt_len_histogram(nt_len_histogram(seqs), args.out_prefix)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,306 @@
+"""
+Gzip backends for reading and writing compressed files.
+
+Each backend is a factory which returns a file opener with the same call signature
+as gzip.GzipFile(filename, mode). The "gzip" backend is the standard library's
+single-threaded implementation. The "threaded" backend decompresses on background
+threads while the caller consumes the data, and compresses independent blocks in a
+thread pool which are written as concatenated gzip members (in the style of pigz).
+Members written by the threaded backend record their compressed size in the gzip
+header, as do BGZF files, which allows the threaded reader to decompress them in parallel.
+"""
+
+import builtins
+import gzip
+import io
+import queue
+import struct
+import threading
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional
+
+# The number of bytes of uncompressed data in each member written by ParallelGzipWriter,
+# and the approximate number of compressed bytes read at a time by ThreadedGzipReader
+BLOCK_SIZE = 1024 * 1024
+
+# gzip header constants
+GZIP_MAGIC = b'\x1F\x8B'
+FEXTRA = 4
+# The extra subfield written by ParallelGzipWriter: 'AQ', 4 bytes, total member size
+AQ_SUBFIELD = b'AQ'
+# The extra subfield written by bgzip: 'BC', 2 bytes, total block size - 1
+BGZF_SUBFIELD = b'BC'
+
+
+def gzip_backend(level: int = 6, threads: int = 1) -> callable:
+    """The standard library's gzip.GzipFile. The threads argument is ignored."""
+
+    return partial(gzip.GzipFile, compresslevel=level, fileobj=None, mtime=0)
+
+
+def threaded_backend(level: int = 6, threads: int = 2) -> callable:
+    """Threaded decompression for reads and parallel block compression for writes"""
+
+    def opener(filename: str, mode: str = 'rb'):
+        if 'r' in mode:
+            return io.BufferedReader(ThreadedGzipReader(filename, threads), BLOCK_SIZE)
+        else:
+            return ParallelGzipWriter(filename, level, threads)
+
+    return opener
+
+
+BACKENDS = {'gzip': gzip_backend, 'threaded': threaded_backend}
+
+
+def get_opener(backend: str = 'gzip', level: int = 6, threads: int = 1) -> callable:
+    """Returns a gzip file opener for the named backend
+
+    Args:
+        backend: The name of a backend in BACKENDS
+        level: The compression level used when writing (1-9)
+        threads: The number of threads the backend may use
+    """
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown gzip backend: {backend}. Choose from: {', '.join(BACKENDS)}")
+    if not 1 <= level <= 9:
+        raise ValueError("Compression level must be between 1 and 9")
+
+    return BACKENDS[backend](level=level, threads=max(threads, 1))
+
+
+def gzip_member(data: bytes, level: int = 6) -> bytes:
+    """Compresses data as a complete gzip member which records its own size in the header"""
+
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = deflate.compress(data) + deflate.flush()
+
+    # ID1 ID2 CM FLG MTIME XFL OS XLEN, then the AQ subfield: SI1 SI2 LEN member_size
+    member_size = 12 + 8 + len(body) + 8
+    header = GZIP_MAGIC + struct.pack('<BBIBBH', 8, FEXTRA, 0, 0, 255, 8)
+    header += AQ_SUBFIELD + struct.pack('<HI', 4, member_size)
+    trailer = struct.pack('<II', zlib.crc32(data), len(data) & 0xFFFFFFFF)
+
+    return header + body + trailer
+
+
+def member_size(header: bytes) -> Optional[int]:
+    """Returns the total size of a gzip member if its header records it, otherwise None
+
+    Args:
+        header: The bytes at the start of the member. At least the fixed 12 byte header
+            and the extra field must be present for the size to be found.
+    """
+
+    if len(header) < 12 or header[:2] != GZIP_MAGIC or not header[3] & FEXTRA:
+        return None
+
+    xlen = struct.unpack_from('<H', header, 10)[0]
+    pos, end = 12, min(12 + xlen, len(header))
+    while pos + 4 <= end:
+        subfield, length = header[pos:pos + 2], struct.unpack_from('<H', header, pos + 2)[0]
+        if subfield == AQ_SUBFIELD and length == 4 and pos + 8 <= end:
+            return struct.unpack_from('<I', header, pos + 4)[0]
+        if subfield == BGZF_SUBFIELD and length == 2 and pos + 6 <= end:
+            return struct.unpack_from('<H', header, pos + 4)[0] + 1
+        pos += 4 + length
+
+    return None
+
+
+def _decompress_members(members: list) -> bytes:
+    """Decompresses a list of complete gzip members"""
+
+    return b''.join(zlib.decompress(member, 16 + zlib.MAX_WBITS) for member in members)
+
+
+class ThreadedGzipReader(io.RawIOBase):
+    """Decompresses a gzip file on background threads
+
+    Decompressed blocks are produced ahead of the consumer and are passed through a bounded
+    queue, so file reads and decompression overlap with whatever the consumer does with the
+    data. If every member of the file records its size in the header (files written by
+    ParallelGzipWriter, and BGZF files), groups of members are decompressed in parallel by
+    a thread pool. Otherwise a single thread decompresses the stream.
+
+    Wrap in io.BufferedReader for .readline() support.
+    """
+
+    def __init__(self, filename: str, threads: int = 2, block_size: int = BLOCK_SIZE):
+        super().__init__()
+        self._file = builtins.open(filename, 'rb')
+        self._threads = threads
+        self._block_size = block_size
+        self._queue = queue.Queue(maxsize=threads * 2)
+        self._stop = threading.Event()
+        self._buffer = memoryview(b'')
+        self._eof = False
+
+        self._producer = threading.Thread(target=self._produce, daemon=True)
+        self._producer.start()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buffer:
+            if self._eof: return 0
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                self._buffer = memoryview(item)
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self._stop.set()
+            self._producer.join()
+            self._file.close()
+        super().close()
+
+    def _put(self, item) -> bool:
+        """Blocks until the item is queued or the reader is closed"""
+
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self) -> None:
+        try:
+            head = self._file.read(self._block_size)
+            if self._threads > 1 and member_size(head) is not None:
+                self._produce_members(head)
+            else:
+                self._produce_stream(head)
+            self._put(None)
+        except BaseException as e:
+            self._put(e)
+
+    def _produce_stream(self, data: bytes) -> None:
+        """Decompresses the stream sequentially, including concatenated members"""
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        in_member = False
+        while data:
+            while data:
+                out = decompressor.decompress(data)
+                in_member = True
+                if out and not self._put(out): return
+                if decompressor.eof:
+                    # Start the next member, ignoring any zero padding between members
+                    data = decompressor.unused_data.lstrip(b'\x00')
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    in_member = False
+                else:
+                    data = b''
+            data = self._file.read(self._block_size)
+
+        if in_member:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+    def _produce_members(self, data: bytes) -> None:
+        """Decompresses groups of size-annotated members in a thread pool"""
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self._threads) as pool:
+            while True:
+                group, group_bytes = [], 0
+                while group_bytes < self._block_size:
+                    if len(data) < 64: data += self._file.read(self._block_size)
+                    if not data.lstrip(b'\x00'): break
+
+                    size = member_size(data)
+                    if size is None:
+                        # This member can't be located without decompressing it. Finish sequentially.
+                        self._drain(pending, group, pool)
+                        return self._produce_stream(data)
+                    while len(data) < size:
+                        more = self._file.read(max(self._block_size, size - len(data)))
+                        if not more: raise EOFError("Compressed file ended before the end of a member")
+                        data += more
+
+                    group.append(data[:size])
+                    group_bytes += size
+                    data = data[size:]
+
+                if not group: break
+                pending.append(pool.submit(_decompress_members, group))
+                while len(pending) >= self._threads * 2:
+                    if not self._put(pending.popleft().result()): return
+
+            self._drain(pending, [], pool)
+
+    def _drain(self, pending: deque, group: list, pool: ThreadPoolExecutor) -> None:
+        """Queues the results of pending groups, and of a final partial group, in order"""
+
+        if group: pending.append(pool.submit(_decompress_members, group))
+        while pending:
+            if not self._put(pending.popleft().result()): return
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Compresses independent blocks in a thread pool and writes them as concatenated gzip members
+
+    Written data is accumulated until a full block is available. Each block is compressed
+    as its own gzip member by a pool thread, and members are written to the file in the
+    order their data was received. The output is a valid multi-member gzip file which can
+    be read by any gzip implementation.
+    """
+
+    def __init__(self, filename: str, level: int = 6, threads: int = 2, block_size: int = BLOCK_SIZE):
+        super().__init__()
+        self._file = builtins.open(filename, 'wb')
+        self._level = level
+        self._threads = threads
+        self._block_size = block_size
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._members = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._buffer += b
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+
+        return len(b)
+
+    def close(self) -> None:
+        if self.closed: return
+        try:
+            # An empty file still requires one (empty) member to be valid gzip
+            if self._buffer or not self._members:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown()
+            self._file.close()
+            super().close()
+
+    def _submit(self, block: bytes) -> None:
+        self._pending.append(self._pool.submit(gzip_member, block, self._level))
+        self._members += 1
+        while len(self._pending) > self._threads * 2:
+            self._file.write(self._pending.popleft().result())
@@ -0,0 +1,353 @@
+"""
+A fused merge of per-sample feature count files into one count matrix.
+
+The feature count files written by aquatx-count are read by a pool of threads. Only
+reading a file's bytes releases the GIL; splitting them into fields and casting the
+counts hold it, so threads overlap the reads of some files with the parsing of others,
+which helps when files are on slow or network storage, but parsing isn't parallel. As
+each file is read, in sample order, its counts are written directly into a column of
+a float64 NumPy matrix. Rows follow one union index of feature names in the order they are first
+seen, so files which list different features are aligned without reindexing
+DataFrames. Features missing from a sample's file have a count of 0.
+
+Counts are parsed with correct rounding, so they are the exact values the counter
+wrote; pandas' default parser can differ from them in the last digit. The matrix is
+written as CSV, in the same layout as the pandas merge, or as Parquet (with pyarrow)
+or HDF5 (with h5py). CSV rows are formatted a chunk at a time from the matrix rather
+than through a DataFrame.
+
+As most features are zero in most samples, the matrix can also be written sparse:
+as a compressed sparse row .npz holding the feature and sample names, in the same
+form as the collapser's count matrix, or as a Matrix Market .mtx with a file each
+of feature and sample names, which R reads with Matrix::readMM().
+"""
+
+import csv
+import io
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# File extension by output format
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'hdf5': '.h5', 'npz': '.npz', 'mtx': '.mtx'}
+
+# The number of matrix rows formatted at a time when writing CSV
+CSV_CHUNK_ROWS = 10000
+
+
+class CountMatrix(NamedTuple):
+    """Feature counts of each sample
+
+    Attributes:
+        features: Feature name by row
+        samples: Sample name by column
+        counts: A float64 matrix of counts, with a row per feature and a column per sample
+    """
+
+    features: List[str]
+    samples: List[str]
+    counts: np.ndarray
+
+
+class SparseCountMatrix(NamedTuple):
+    """Feature counts of each sample in compressed sparse row form
+
+    The arrays can be passed directly to scipy.sparse.csr_matrix((data, indices, indptr), shape).
+
+    Attributes:
+        features: Feature name by row
+        samples: Sample name by column
+        data: The float64 nonzero counts, row by row
+        indices: The column of each nonzero count
+        indptr: The nonzero counts of row i are data[indptr[i]:indptr[i + 1]]
+        shape: The (features, samples) shape of the matrix
+    """
+
+    features: List[str]
+    samples: List[str]
+    data: np.ndarray
+    indices: np.ndarray
+    indptr: np.ndarray
+    shape: Tuple[int, int]
+
+
+def available_formats() -> list:
+    """Returns the output formats which can be written with the installed packages"""
+
+    required = {'csv': True, 'parquet': pa is not None, 'hdf5': h5py is not None, 'npz': True, 'mtx': True}
+    return [fmt for fmt in FORMATS if required[fmt]]
+
+
+def read_counts(path: str) -> Tuple[List[str], np.ndarray]:
+    """Reads the feature names and counts of a tab separated feature counts file
+
+    Count files have two columns, so unless a feature name is quoted their fields are
+    split directly from the file's bytes, and counts are converted with a single NumPy cast.
+    """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if b'"' in data:
+        table = pd.read_csv(io.BytesIO(data), sep='\t', header=None, names=['feature', 'count'],
+                            dtype={'feature': str, 'count': np.float64}, keep_default_na=False,
+                            float_precision='round_trip')
+        return table['feature'].tolist(), table['count'].to_numpy(dtype=np.float64)
+
+    fields = data.replace(b'\r\n', b'\n').replace(b'\n', b'\t').split(b'\t')
+    if fields[-1] == b'': fields.pop()
+    if len(fields) % 2:
+        raise ValueError(f"{path} is not a tab separated file of features and counts.")
+
+    names = b'\t'.join(fields[0::2]).decode('utf-8').split('\t') if fields else []
+    return names, np.array(fields[1::2], dtype=bytes).astype(np.float64)
+
+
+def merge_count_files(counts_files: list, samples: list, workers: int = 1) -> CountMatrix:
+    """Merges feature count files into a CountMatrix
+
+    Args:
+        counts_files: The feature count files to merge
+        samples: Sample names, ordered the same as counts_files
+        workers: The number of threads to read files with
+
+    Returns: The CountMatrix, with features in the order they are first seen
+    """
+
+    if len(counts_files) != len(samples):
+        raise ValueError("The number of count files and sample names must be the same.")
+
+    features, lookup = [], {}
+    counts = np.zeros((0, len(samples)), dtype=np.float64)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for column, (names, values) in enumerate(pool.map(read_counts, counts_files)):
+            # Files usually list the same features in the same order
+            if names == features:
+                counts[:len(features), column] = values
+                continue
+
+            rows = union_rows(features, lookup, names)
+            if len(features) > len(counts):
+                # The matrix's capacity doubles, so rows are copied O(log n) times rather than per file
+                grown = np.zeros((max(len(features), 2 * len(counts)), len(samples)), dtype=np.float64)
+                grown[:len(counts)] = counts
+                counts = grown
+            counts[rows, column] = values
+
+    if len(counts) > len(features): counts = counts[:len(features)].copy()
+    return CountMatrix(features, list(samples), counts)
+
+
+def union_rows(features: List[str], lookup: dict, names: List[str]) -> np.ndarray:
+    """Returns the row of each name in a union index of features, appending names not yet in it
+
+    The index is updated in place, so adding a file's names costs time in proportion to
+    the number of names rather than to the size of the index.
+
+    Args:
+        features: Feature names of the union index, in row order
+        lookup: The row of each name in features
+        names: The feature names of a count file
+
+    Returns: Each name's row
+    """
+
+    rows = np.empty(len(names), dtype=np.int64)
+    for i, name in enumerate(names):
+        row = lookup.get(name)
+        if row is None:
+            row = lookup[name] = len(features)
+            features.append(name)
+        rows[i] = row
+
+    return rows
+
+
+def write_count_matrix(matrix: CountMatrix, path: str, fmt: str = 'csv') -> None:
+    """Writes a CountMatrix in one of the FORMATS
+
+    CSV files have a header of 'feature' and the sample names, then a row per feature.
+    Parquet files have a string 'feature' column and a float64 column per sample. HDF5
+    files hold the matrix as the 'counts' dataset, with 'features' and 'samples' datasets
+    of names. Sparse formats are described in write_sparse_count_matrix().
+    """
+
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown count matrix format: {fmt}. Choose from: {', '.join(FORMATS)}")
+    if fmt not in available_formats():
+        package = 'pyarrow' if fmt == 'parquet' else 'h5py'
+        raise ImportError(f"The {fmt} count matrix format requires {package}")
+
+    if fmt == 'csv':
+        _write_csv(matrix, path)
+    elif fmt in ('npz', 'mtx'):
+        write_sparse_count_matrix(to_sparse(matrix), path, fmt)
+    elif fmt == 'parquet':
+        columns = np.asfortranarray(matrix.counts)
+        table = pa.Table.from_arrays([pa.array(matrix.features, type=pa.string())] +
+                                     [pa.array(columns[:, j]) for j in range(columns.shape[1])],
+                                     names=['feature'] + list(matrix.samples))
+        pq.write_table(table, path)
+    else:
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('counts', data=matrix.counts, compression='gzip')
+            f.create_dataset('features', data=matrix.features, dtype=h5py.string_dtype())
+            f.create_dataset('samples', data=matrix.samples, dtype=h5py.string_dtype())
+
+
+def read_count_matrix(path: str) -> CountMatrix:
+    """Reads a count matrix written by write_count_matrix() in any of the FORMATS"""
+
+    if path.endswith((FORMATS['npz'], FORMATS['mtx'])):
+        return to_dense(read_sparse_count_matrix(path))
+    if path.endswith(FORMATS['parquet']):
+        table = pq.read_table(path)
+        counts = np.zeros((table.num_rows, table.num_columns - 1), dtype=np.float64)
+        for j in range(1, table.num_columns):
+            counts[:, j - 1] = table.column(j).to_numpy()
+        return CountMatrix(table.column(0).to_pylist(), table.column_names[1:], counts)
+    if path.endswith(FORMATS['hdf5']):
+        with h5py.File(path, 'r') as f:
+            return CountMatrix(f['features'].asstr()[:].tolist(), f['samples'].asstr()[:].tolist(),
+                               f['counts'][:])
+
+    table = pd.read_csv(path, index_col=0, keep_default_na=False, na_values=[''],
+                        float_precision='round_trip')
+    return CountMatrix(table.index.tolist(), table.columns.tolist(),
+                       table.to_numpy(dtype=np.float64))
+
+
+def to_sparse(matrix: CountMatrix) -> SparseCountMatrix:
+    """Converts a CountMatrix to a SparseCountMatrix of its nonzero counts"""
+
+    # Nonzero positions of a C ordered matrix are returned row by row, as CSR orders them
+    rows, columns = np.nonzero(matrix.counts)
+    indptr = np.zeros(len(matrix.features) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(matrix.features)), out=indptr[1:])
+    return SparseCountMatrix(list(matrix.features), list(matrix.samples), matrix.counts[rows, columns],
+                             columns.astype(np.int64), indptr, (len(matrix.features), len(matrix.samples)))
+
+
+def to_dense(matrix: SparseCountMatrix) -> CountMatrix:
+    """Converts a SparseCountMatrix to a CountMatrix"""
+
+    counts = np.zeros(matrix.shape, dtype=np.float64)
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    counts[rows, matrix.indices] = matrix.data
+    return CountMatrix(list(matrix.features), list(matrix.samples), counts)
+
+
+def label_files(path: str) -> Tuple[str, str]:
+    """Returns the feature and sample name files which accompany a Matrix Market count matrix"""
+
+    stem = path[:-len(FORMATS['mtx'])] if path.endswith(FORMATS['mtx']) else path
+    return f"{stem}_features.txt", f"{stem}_samples.txt"
+
+
+def write_sparse_count_matrix(matrix: SparseCountMatrix, path: str, fmt: str = 'npz') -> None:
+    """Writes a SparseCountMatrix as a compressed sparse row .npz or a Matrix Market .mtx
+
+    The .npz file holds the arrays data, indices, indptr and shape (see SparseCountMatrix),
+    and arrays of feature and sample names. The .mtx file is a real, general coordinate
+    matrix with 1-based (feature, sample) positions. Its feature and sample names are
+    written one per line to the files named by label_files().
+    """
+
+    if fmt == 'npz':
+        np.savez_compressed(
+            path,
+            data=matrix.data,
+            indices=matrix.indices,
+            indptr=matrix.indptr,
+            shape=np.array(matrix.shape),
+            features=np.array(matrix.features, dtype=str),
+            samples=np.array(matrix.samples, dtype=str)
+        )
+    elif fmt == 'mtx':
+        rows = np.repeat(np.arange(1, matrix.shape[0] + 1), np.diff(matrix.indptr)).tolist()
+        columns = (matrix.indices + 1).tolist()
+        values = matrix.data.tolist()
+        with open(path, 'w') as f:
+            f.write("%%MatrixMarket matrix coordinate real general\n")
+            f.write(f"{matrix.shape[0]} {matrix.shape[1]} {len(values)}\n")
+            for start in range(0, len(values), CSV_CHUNK_ROWS):
+                end = start + CSV_CHUNK_ROWS
+                f.write(''.join(f"{i} {j} {v!r}\n" for i, j, v in
+                                zip(rows[start:end], columns[start:end], values[start:end])))
+
+        for names, label_file in zip([matrix.features, matrix.samples], label_files(path)):
+            with open(label_file, 'w') as f:
+                f.write(''.join(f"{name}\n" for name in names))
+    else:
+        raise ValueError(f"Unknown sparse count matrix format: {fmt}. Choose from: npz, mtx")
+
+
+def read_sparse_count_matrix(path: str) -> SparseCountMatrix:
+    """Reads a count matrix written by write_sparse_count_matrix() without densifying it"""
+
+    if path.endswith(FORMATS['npz']):
+        with np.load(path) as npz:
+            return SparseCountMatrix(npz['features'].tolist(), npz['samples'].tolist(), npz['data'],
+                                     npz['indices'], npz['indptr'], tuple(npz['shape'].tolist()))
+
+    with open(path, 'rb') as f:
+        header = f.readline()
+        if not header.startswith(b'%%MatrixMarket matrix coordinate'):
+            raise ValueError(f"{path} is not a Matrix Market coordinate matrix.")
+        line = f.readline()
+        while line.startswith(b'%'):
+            line = f.readline()
+        n_rows, n_columns, nnz = map(int, line.split())
+        entries = f.read().split()
+
+    if len(entries) != 3 * nnz:
+        raise ValueError(f"{path} does not hold the {nnz} entries its header lists.")
+
+    rows = np.array(entries[0::3], dtype=bytes).astype(np.int64) - 1
+    columns = np.array(entries[1::3], dtype=bytes).astype(np.int64) - 1
+    data = np.array(entries[2::3], dtype=bytes).astype(np.float64)
+
+    # Entries may be listed in any order
+    order = np.lexsort((columns, rows))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+
+    names = []
+    for label_file in label_files(path):
+        with open(label_file, 'r') as f:
+            names.append(f.read().splitlines())
+
+    return SparseCountMatrix(names[0], names[1], data[order], columns[order], indptr, (n_rows, n_columns))
+
+
+def _write_csv(matrix: CountMatrix, path: str) -> None:
+    # Values are formatted with repr, as pandas does, with empty fields for NaN
+    fmt = repr if not np.isnan(matrix.counts).any() else (lambda v: '' if v != v else repr(v))
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['feature'] + list(matrix.samples))
+        for start in range(0, len(matrix.features), CSV_CHUNK_ROWS):
+            names = matrix.features[start:start + CSV_CHUNK_ROWS]
+            rows = matrix.counts[start:start + CSV_CHUNK_ROWS].tolist()
+            f.write(''.join(f"{_quote(name)},{','.join(map(fmt, row))}\n" for name, row in zip(names, rows)))
+
+
+def _quote(field: str) -> str:
+    """Quotes a CSV field if it contains a delimiter, quote or line break, as csv.QUOTE_MINIMAL does"""
+
+    if any(c in field for c in ',"\r\n'):
+        return '"' + field.replace('"', '""') + '"'
+    return field
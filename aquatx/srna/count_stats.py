@@ -0,0 +1,121 @@
+"""
+Structured summary statistics of the counter, and their merge across samples.
+
+The counter writes each sample's summary statistics to a JSON file which lists every
+key of the fixed schema, STATS_KEYS, with 0 for statistics that never occurred, then
+any other statistics. The legacy tab separated _stats.txt files can be read too.
+
+Stats files are parsed in parallel and merged into one float64 matrix over the union
+of their keys, with schema keys first, so a statistic missing from one sample is 0
+for that sample rather than dropped. Derived per-sample rates are computed from the
+merged matrix in the same pass.
+"""
+
+import json
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Tuple
+
+# Incremented when the layout of stats files changes
+STATS_VERSION = 1
+
+# Statistics of the alignments, and of their assignment to features
+ALIGNMENT_STATS = ['_unique_sequences_aligned', '_aligned_reads',
+                   '_aligned_reads_multi_mapping', '_aligned_reads_unique_mapping']
+FEATURE_STATS = ['_no_feature', '_ambiguous_alignments_classes',
+                 '_ambiguous_reads_classes', '_ambiguous_alignments_features',
+                 '_ambiguous_reads_features', '_alignments_unique_features',
+                 '_reads_unique_features']
+CACHE_STATS = ['_assignment_cache_hits', '_assignment_cache_misses', '_assignment_cache_hit_rate']
+STATS_KEYS = ALIGNMENT_STATS + FEATURE_STATS + CACHE_STATS
+
+# Derived rates, as (numerator, denominator) statistics. The overall mapping rate isn't
+# listed as stats files don't hold the number of reads given to the aligner.
+RATES = {
+    '_unique_mapping_rate': ('_aligned_reads_unique_mapping', '_aligned_reads'),
+    '_multi_mapping_rate': ('_aligned_reads_multi_mapping', '_aligned_reads'),
+    '_no_feature_rate': ('_no_feature', '_aligned_reads'),
+    '_ambiguity_rate_features': ('_ambiguous_reads_features', '_aligned_reads'),
+    '_ambiguity_rate_classes': ('_ambiguous_reads_classes', '_aligned_reads'),
+}
+
+
+class StatsMatrix(NamedTuple):
+    """Summary statistics of each sample
+
+    Attributes:
+        keys: Statistic name by row
+        samples: Sample name by column
+        values: A float64 matrix with a row per statistic and a column per sample
+    """
+
+    keys: List[str]
+    samples: List[str]
+    values: np.ndarray
+
+
+def write_stats(stats: dict, path: str) -> None:
+    """Writes a sample's summary statistics as JSON
+
+    Every key of STATS_KEYS is listed, in schema order, followed by any other statistics.
+    """
+
+    ordered = {key: stats.get(key, 0) for key in STATS_KEYS}
+    ordered.update((key, value) for key, value in stats.items() if key not in ordered)
+    with open(path, 'w') as f:
+        json.dump({'version': STATS_VERSION, 'stats': ordered}, f, indent=1)
+
+
+def read_stats(path: str) -> Tuple[List[str], np.ndarray]:
+    """Reads the statistic names and values of a JSON or legacy tab separated stats file"""
+
+    with open(path, 'r') as f:
+        text = f.read()
+
+    if text.lstrip().startswith('{'):
+        saved = json.loads(text)
+        if saved['version'] != STATS_VERSION:
+            raise ValueError(f"Stats file {path} was written by an incompatible version.")
+        stats = saved['stats']
+    else:
+        stats = dict(line.split('\t') for line in text.splitlines()[1:] if line.strip())
+
+    return list(stats), np.array(list(stats.values()), dtype=np.float64)
+
+
+def merge_stats_files(stats_files: list, samples: list, workers: int = 1) -> Tuple[StatsMatrix, StatsMatrix]:
+    """Merges stats files into a matrix over the union of their keys, and derives rates
+
+    Args:
+        stats_files: The stats files to merge
+        samples: Sample names, ordered the same as stats_files
+        workers: The number of threads to read files with
+
+    Returns:
+        stats: The merged statistics, with STATS_KEYS first and other keys in the order
+            they are first seen. Statistics a sample doesn't list are 0.
+        rates: The RATES of each sample, which are 0 where the denominator is 0
+    """
+
+    if len(stats_files) != len(samples):
+        raise ValueError("The number of stats files and sample names must be the same.")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parsed = list(pool.map(read_stats, stats_files))
+
+    rows = {key: i for i, key in enumerate(STATS_KEYS)}
+    for names, _ in parsed:
+        for name in names:
+            rows.setdefault(name, len(rows))
+
+    values = np.zeros((len(rows), len(samples)), dtype=np.float64)
+    for column, (names, sample_values) in enumerate(parsed):
+        values[[rows[name] for name in names], column] = sample_values
+
+    numerators = values[[rows[num] for num, _ in RATES.values()]]
+    denominators = values[[rows[den] for _, den in RATES.values()]]
+    rates = np.divide(numerators, denominators, out=np.zeros_like(numerators), where=denominators > 0)
+
+    return StatsMatrix(list(rows), list(samples), values), StatsMatrix(list(RATES), list(samples), rates)
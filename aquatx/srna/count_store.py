@@ -0,0 +1,200 @@
+"""
+An incremental store of merged feature counts.
+
+A store is a directory holding one features x samples matrix of counts as a .npy
+file, the union index of feature names in features.txt, and a manifest.json listing
+the matrix file and each sample's name and the SHA-256 hash of the count file it was
+read from. Adding count files to a store only reads those whose sample isn't in the
+store yet, or whose contents have changed since they were added, so re-merging a
+project after adding a batch of libraries reads just the new batch.
+
+The matrix is stored in column-major order, with spare rows and columns, so adding a
+sample writes one contiguous column in place. When new features or samples outgrow
+the matrix, it is copied into a new file with twice the capacity. The union index
+only grows, with new feature names appended in the order they are first seen, so
+rows never move; features added after a sample are 0 in that sample. The full matrix
+is read memory-mapped, so it isn't loaded into memory.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from aquatx.srna.count_matrix import CountMatrix, read_counts, union_rows
+
+# Incremented when the layout of stores changes
+STORE_VERSION = 2
+
+
+def file_hash(path: str) -> str:
+    """Returns the SHA-256 hash of a file's contents"""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class CountStore:
+    """A features x samples count matrix which new samples are appended to
+
+    Attributes:
+        path: The store directory
+        features: Feature name by row, in the order they were first seen
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.features = []
+        self._entries = []  # {'name', 'hash'} by sample, in column order
+        self._matrix = None  # The name of the matrix file
+        self._grown = []     # The names of matrix files grown since the manifest was saved
+
+        manifest = os.path.join(path, 'manifest.json')
+        if os.path.isfile(manifest):
+            with open(manifest) as f:
+                saved = json.load(f)
+            if saved['version'] != STORE_VERSION:
+                raise ValueError(f"Count store {path} was written by an incompatible version.")
+            with open(os.path.join(path, 'features.txt'), 'r') as f:
+                self.features = f.read().splitlines()
+            self._entries = saved['samples']
+            self._matrix = saved['matrix']
+        else:
+            os.makedirs(path, exist_ok=True)
+
+        self._lookup = {feature: row for row, feature in enumerate(self.features)}
+
+    @property
+    def samples(self) -> List[str]:
+        """Sample name by column, in the order they were added"""
+
+        return [entry['name'] for entry in self._entries]
+
+    def add(self, counts_files: list, samples: list, workers: int = 1) -> List[str]:
+        """Adds feature count files to the store, skipping those it already holds
+
+        A sample that is already in the store is read again only if its count file's
+        contents have changed, in which case its column is overwritten. If adding is
+        interrupted, the manifest still holds the column's earlier hash, so the column
+        is read again by the next add.
+
+        Args:
+            counts_files: The feature count files to add
+            samples: Sample names, ordered the same as counts_files
+            workers: The number of threads to hash and read files with
+
+        Returns: The names of the samples which were read
+        """
+
+        if len(counts_files) != len(samples):
+            raise ValueError("The number of count files and sample names must be the same.")
+
+        stored = {entry['name']: i for i, entry in enumerate(self._entries)}
+        entries = list(self._entries)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            hashes = list(pool.map(file_hash, counts_files))
+            changed = [i for i, (sample, digest) in enumerate(zip(samples, hashes))
+                       if sample not in stored or entries[stored[sample]]['hash'] != digest]
+
+            matrix = self._open() if changed else None
+            for i, (names, values) in zip(changed, pool.map(read_counts, [counts_files[i] for i in changed])):
+                rows = union_rows(self.features, self._lookup, names)
+                column = stored.setdefault(samples[i], len(entries))
+                matrix = self._reserve(matrix, len(self.features), column + 1)
+
+                matrix[:, column] = 0
+                matrix[rows, column] = values
+                entry = {'name': samples[i], 'hash': hashes[i]}
+                if column < len(entries):
+                    entries[column] = entry
+                else:
+                    entries.append(entry)
+
+        if changed:
+            matrix.flush()
+            self._entries = entries
+            self._save()
+
+        return [samples[i] for i in changed]
+
+    def read(self, samples: list = None) -> CountMatrix:
+        """Reads the counts of all samples, or of the listed samples in the order given
+
+        The counts of all samples are a read-only view of the memory-mapped matrix.
+        The counts of listed samples are copied into memory.
+        """
+
+        columns = {entry['name']: j for j, entry in enumerate(self._entries)}
+        selected = self.samples if samples is None else list(samples)
+        missing = [sample for sample in selected if sample not in columns]
+        if missing:
+            raise KeyError(f"Samples not in count store {self.path}: {', '.join(missing)}")
+
+        if self._matrix is None:
+            return CountMatrix(list(self.features), selected, np.zeros((len(self.features), len(selected))))
+
+        matrix = np.load(os.path.join(self.path, self._matrix), mmap_mode='r')[:len(self.features)]
+        if samples is None:
+            counts = matrix[:, :len(selected)]
+        else:
+            counts = np.asarray(matrix[:, [columns[sample] for sample in selected]])
+
+        return CountMatrix(list(self.features), selected, counts)
+
+    def _open(self):
+        """Opens the matrix file for writing, or returns None if there is none yet"""
+
+        if self._matrix is None: return None
+        return np.load(os.path.join(self.path, self._matrix), mmap_mode='r+')
+
+    def _reserve(self, matrix, rows: int, columns: int):
+        """Returns the matrix, or a copy of it with doubled capacity if it has fewer rows or columns
+
+        Grown matrices are written to a new file, which the manifest refers to once it is
+        saved, so the matrix of the saved manifest is never modified in a way that moves rows.
+        """
+
+        shape = matrix.shape if matrix is not None else (0, 0)
+        if rows <= shape[0] and columns <= shape[1]: return matrix
+
+        capacity = tuple(max(need, 2 * have, 16) if need > have else have
+                         for need, have in zip((rows, columns), shape))
+        name = f"matrix_{capacity[0]}x{capacity[1]}.npy"
+        grown = np.lib.format.open_memmap(os.path.join(self.path, name), mode='w+', dtype=np.float64,
+                                          shape=capacity, fortran_order=True)
+        if matrix is not None:
+            grown[:shape[0], :shape[1]] = matrix
+            del matrix
+        self._grown.append(name)
+        return grown
+
+    def _save(self) -> None:
+        """Writes the feature index, then the manifest which refers to the matrix"""
+
+        previous, grown = self._matrix, self._grown
+        if grown: self._matrix = grown[-1]
+
+        self._replace('features.txt', ''.join(f"{feature}\n" for feature in self.features))
+        self._replace('manifest.json', json.dumps({'version': STORE_VERSION, 'matrix': self._matrix,
+                                                   'samples': self._entries}))
+
+        # Matrices the manifest no longer refers to are removed once it is saved
+        for name in set(grown + [previous]) - {self._matrix, None}:
+            os.remove(os.path.join(self.path, name))
+        self._grown = []
+
+    def _replace(self, name: str, contents: str) -> None:
+        """Atomically replaces a file of the store"""
+
+        tmp = os.path.join(self.path, f".{name}.tmp")
+        with open(tmp, 'w') as f:
+            f.write(contents)
+        os.replace(tmp, os.path.join(self.path, name))
@@ -9,11 +9,34 @@ certain features (ie miRNA within a coding region), and whether or not to count
 both sense and antisense reads. The output is appropriate for use in other DEG
 programs such as DESeq2. Summary statistics are also produced.
 """
-from collections import Counter
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import argparse
+import os
+import tempfile
 import numpy as np
 import pandas as pd
 import HTSeq
+import pysam
+
+from aquatx.srna.aln_table import FORMATS, AlnTableWriter, available_formats
+from aquatx.srna.count_stats import write_stats
+from aquatx.srna.feature_index import FeatureIndex, FeatureRegistry, index_cache_key, subtract_masks
+from aquatx.srna.feature_rules import FeatureSelector, read_rules
+from aquatx.srna.scheduler import process_context
+
+# The number of chunks each worker process is given when counting in parallel
+CHUNKS_PER_WORKER = 4
+
+# The number of alignments assigned to features at a time
+ASSIGN_BATCH_SIZE = 10000
+
+# The default number of alignment intervals whose assigned features are cached
+ASSIGN_CACHE_SIZE = 100000
+
+# The FeatureAssigner used by worker processes, inherited from the parent when forked
+_worker_assigner = None
 
 def get_args():
     """
@@ -24,7 +47,7 @@ def get_args():
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input-file', metavar='SAMFILE', required=True,
-                        help='input sam file to count features for')
+                        help='input sam or bam file to count features for')
     parser.add_argument('-r', '--ref-annotations', metavar='GTFFILE', nargs='+', required=True,
                         help='reference gff3 files with annotations to count.')
     parser.add_argument('-m', '--mask-file', metavar='MASKFILE', nargs='+', default=None,
@@ -37,51 +60,157 @@ def get_args():
     parser.add_argument('-t', '--intermed-file', action='store_true',
                         help='Save the intermediate file containing all alignments and'
                              'associated features.')
+    parser.add_argument('-f', '--intermed-format', choices=list(FORMATS), default='txt',
+                        help='the format of the intermediate file: tab separated text, gzip '
+                             'compressed text, or the parquet or feather columnar formats, '
+                             'which require pyarrow. The file is written on a background thread.')
+    parser.add_argument('-s', '--features-csv', metavar='FEATURESCSV', default=None,
+                        help='the features.csv reference sheet. Each row selects the features of '
+                             'the reference file named by its Feature Source, and its Strand, '
+                             "5' End Nucleotide, Length and Hierarchy columns decide which of an "
+                             'alignment\'s overlapping features it is assigned to. Rules are '
+                             'evaluated with the numpy feature index. Rules count the strands they '
+                             'name, so --antisense can\'t be combined with this option.')
+    parser.add_argument('-x', '--feature-index', choices=['htseq', 'numpy'], default='htseq',
+                        help='the feature index used to assign alignments to features. The numpy '
+                             'index is faster to build and query, and assigns identical features.')
+    parser.add_argument('-c', '--index-cache', metavar='CACHEDIR', default=None,
+                        help='directory for caching compiled numpy feature indexes. Indexes are '
+                             'keyed by the contents of the gff files and options, and are reused '
+                             'by later runs. Requires --feature-index numpy.')
+
+    def positive_workers(w):
+        if int(w) >= 1:
+            return int(w)
+        else:
+            raise argparse.ArgumentTypeError("Workers must be >= 1")
+
+    parser.add_argument('-w', '--workers', default=1, type=positive_workers,
+                        help='the number of processes to use for assigning features. Values '
+                             'greater than 1 split the alignments into chunks of whole multi-'
+                             'mapping bundles, or into chromosomes for indexed coordinate sorted '
+                             'bam files, which are counted in parallel. Reads are then grouped by '
+                             'name across chromosomes in memory, so memory grows with the number '
+                             'of alignments. Otherwise coordinate sorted bam files are grouped by '
+                             'name on disk with samtools collate, and memory is bounded.')
+
+    def cache_size(n):
+        if int(n) >= 0:
+            return int(n)
+        else:
+            raise argparse.ArgumentTypeError("Cache size must be >= 0")
+
+    parser.add_argument('-k', '--cache-size', default=ASSIGN_CACHE_SIZE, type=cache_size,
+                        help='the number of alignment intervals whose assigned features are '
+                             'cached, so that reads aligning to the same locus are only assigned '
+                             'once (per worker). The cache hit rate is reported in the stats file. '
+                             '0 disables the cache.')
 
     args = parser.parse_args()
+    if args.index_cache is not None and args.feature_index != 'numpy':
+        parser.error('--index-cache requires --feature-index numpy')
+    if args.features_csv is not None and args.antisense is not None:
+        parser.error('--antisense can\'t be combined with --features-csv, whose rules name the strands to count')
+    if args.intermed_format not in available_formats():
+        parser.error(f'--intermed-format {args.intermed_format} requires pyarrow')
 
     return args
 
-def create_ref_array(ref_file, class_counts, feat_counts, mask_file=None, stranded=True):
+def create_ref_array(ref_file, registry, mask_file=None, stranded=True, index='htseq',
+                     cache_dir=None, selector=None):
     """
-    Creates the array of features to count from a reference gff3 file. Masks reads from array
-    if desired.
+    Creates the array of features to count from a reference gff3 file. Positions covered by
+    the features of a mask file are removed from the features, so they aren't counted.
 
     Inputs:
       ref_file: The reference gff3 file with features to counts.
-      class_counts: The dictionary for counting classes to assign a value of 0 to
-      feat_counts: The dictionary for counting features to assign a value of 0 to
+      registry: The FeatureRegistry to register features and classes with. Every
+                feature is registered so the final output contains all features, even if
+                a library contains no reads for that feature.
       mask_file: The associated file with features to mask from counting. Default: None
       stranded - Boolean indicating if only sense of a feature is counted. Default: True
+      index - The feature index to build, 'htseq' or 'numpy'. Default: 'htseq'
+      cache_dir - Directory of cached numpy indexes to load from and save to. Default: None
+      selector - The FeatureSelector of features.csv rules. If given, only the features
+                 selected by the rules for ref_file are added, with the rule's class, and
+                 bound to those rules. The rules decide which strands are counted, so a
+                 stranded numpy index is always built, and unstranded features are added
+                 to both strands. Default: None
 
     Outputs:
-      ref_array - the HTSeq Genomic array of sets containing features and mask features.
+      ref_array - the HTSeq Genomic array of sets (or FeatureIndex) containing the registry
+                  labels of the features' unmasked intervals.
     """
+    file_rules = selector.rules_for(ref_file) if selector is not None else None
+    if selector is not None:
+        index, stranded = 'numpy', True
+
+    # Load a previously compiled index for the same files and options
+    if index == 'numpy' and cache_dir is not None:
+        options = {'stranded': stranded}
+        if selector is not None:
+            # Features are selected by each rule's Identifier and Class. Its other columns are applied when counting.
+            options['rules'] = [[selector.rules[r].identifier, selector.rules[r].feature_class]
+                                for r in file_rules]
+        cache_path = os.path.join(cache_dir, index_cache_key(ref_file, mask_file, **options))
+        if os.path.isdir(cache_path):
+            feat_array, meta = FeatureIndex.load(cache_path, registry)
+            for label, positions in zip(feat_array.labels, meta.get('bindings', [])):
+                for position in positions:
+                    selector.bind(label, file_rules[position])
+            return feat_array
+
     # Read in the gff files
     feat_gff = HTSeq.GFF_Reader(ref_file)
     # Initialize feature array
-    feat_array = HTSeq.GenomicArrayOfSets("auto", stranded=stranded)
+    if index == 'numpy':
+        feat_array = FeatureIndex(registry, stranded=stranded)
+    else:
+        feat_array = HTSeq.GenomicArrayOfSets("auto", stranded=stranded)
 
-    # Add all features in the feature file to the array along with class information
+    # Read all features in the feature file along with class information
+    features = []
     for feat in feat_gff:
-        feat_array[feat.iv] += "class_" + feat.type + "_feature_" + feat.attr["ID"]
-        # Set value in Counter dicts to 0 so the final output contains all features, even if
-        # a library contains no reads for that feature. Required for future normalization.
-        class_counts[feat.type] = 0
-        feat_counts[feat.attr["ID"]] = 0
-    # Add mask features so intervals that overlap have > 1 feature and aren't counted
-    if mask_file is not None:
-        mask_gff = HTSeq.GFF_Reader(mask_file)
-        # Add all masked features that overlap with existing features in array
-        for mask in mask_gff:
-            # mark features as mask to distinguish them later
-            # might make sense to to step through feature array & only add if the mask overlaps
-            # with a features
-            feat_array[mask.iv] += "class_" + mask.type + "_mask_" + mask.attr["ID"]
-
-    return feat_array, class_counts, feat_counts
-
-def create_ref_dict(ref_files, stranded=None, mask_files=None):
+        if selector is None:
+            features.append((feat.iv, registry.add(feat.attr["ID"], feat.type)))
+            continue
+        for rule in file_rules:
+            if selector.rules[rule].matches(feat):
+                label = registry.add(feat.attr["ID"], selector.rules[rule].feature_class)
+                selector.bind(label, rule)
+                if feat.iv.strand in ('+', '-'):
+                    features.append((feat.iv, label))
+                else:
+                    features.extend((HTSeq.GenomicInterval(feat.iv.chrom, feat.iv.start, feat.iv.end, strand), label)
+                                    for strand in ('+', '-'))
+
+    # Every feature is kept in the index, including those which are fully masked
+    if index == 'numpy':
+        for _, label in features:
+            feat_array.add_label(label)
+
+    # Remove masked positions from features once, so the array holds no masks to check when counting
+    masks = [mask.iv for mask in HTSeq.GFF_Reader(mask_file)] if mask_file is not None else []
+    for chrom, start, end, strand, label in subtract_masks(features, masks, stranded):
+        iv = HTSeq.GenomicInterval(chrom, start, end, strand)
+        if index == 'numpy':
+            feat_array.add(iv, label)
+        else:
+            feat_array[iv] += label
+
+    if index == 'numpy' and cache_dir is not None:
+        if selector is None:
+            feat_array.save(cache_path)
+        else:
+            # The positions in file_rules of the rules each of the index's labels is bound to
+            feat_array.save(cache_path, bindings=[[file_rules.index(r) for r in selector.bindings(label)
+                                                   if r in file_rules]
+                                                  for label in feat_array.labels])
+
+    return feat_array
+
+def create_ref_dict(ref_files, stranded=None, mask_files=None, index='htseq', cache_dir=None,
+                    selector=None):
     """
     Creates a dictionary of reference genomic arrays for multiple inputs to later use for
     assigning counts to features.
@@ -93,12 +222,16 @@ def create_ref_dict(ref_files, stranded=None, mask_files=None):
                   Default is None when no mask files are used.
         stranded: List of booleans indicating whether these features should be counted stranded
                   or not. Default is only count sense strands
+        index: The feature index to build for each reference file, 'htseq' or 'numpy'.
+        cache_dir: Directory of cached numpy indexes to load from and save to.
+        selector: The FeatureSelector of features.csv rules to select and bind features with.
+                  The rules replace stranded and index. See create_ref_array().
     Output:
         ref_array_dict: a dictionary containing all feature arrays to be counted.
+        registry: the FeatureRegistry of all features and classes in the arrays
     """
     ref_array_dict = {}
-    class_counts = Counter()
-    feat_counts = Counter()
+    registry = FeatureRegistry()
 
     # Set up mask files list
     if mask_files is not None:
@@ -119,144 +252,636 @@ def create_ref_dict(ref_files, stranded=None, mask_files=None):
 
     # populate dict with reference arrays
     for rf, mf, st in ref_mask_files:
-        ref_array_dict[rf], class_counts, feat_counts = create_ref_array(rf, class_counts,
-                                                                         feat_counts, mf, st)
+        ref_array_dict[rf] = create_ref_array(rf, registry, mf, st, index, cache_dir, selector)
 
-    return ref_array_dict, class_counts, feat_counts
+    return ref_array_dict, registry
 
-def assign_features(aln, ref_array_dict):
+def assign_features(aln, ref_array_dict, registry):
     """
     Finds a class and a feature that overlaps with the alignment of interest
 
     Inputs:
         aln: the alignment
         ref_array_dict: the dictionary of feature arrays to check
+        registry: the FeatureRegistry of the arrays' labels
 
     Output:
-        aln_feats: List of unique features that the alignment corresponds to
-        aln_classes: List of unique classes that the alignment corresponds to
+        aln_feats: Array of the unique feature IDs that the alignment corresponds to
+        aln_classes: Array of the unique class IDs that the alignment corresponds to
+                     Both are empty if no features are found.
     """
-    aln_feats = list()
-    aln_classes = list()
+    labels = list()
 
     # Check all reference arrays for overlapping features
     for ref_file, ref_array in ref_array_dict.items():
+        if isinstance(ref_array, FeatureIndex):
+            # The index resolves the HTSeq rules below in a single lookup
+            label = ref_array.assign(aln.iv.chrom, aln.iv.strand, aln.iv.start, aln.iv.end)
+            if label is not None:
+                labels.append(label)
+            continue
+
         gene_ids = set()
         for iv, val in ref_array[aln.iv].steps():
             gene_ids |= val
 
             # Assign only if it's one feature per interval
             if len(gene_ids) == 1:
-                gene_id = list(gene_ids)[0]
-                if gene_id.split('_')[2] == 'mask':
-                    continue
-                else:
-                    aln_feats.append(gene_id.split('_')[3])
-                    aln_classes.append(gene_id.split('_')[1])
-
-    # Assign category if no features are found
-    if not aln_feats:
-        aln_feats.append('_no_feature')
-        aln_classes.append('_no_class')
+                labels.append(next(iter(gene_ids)))
 
     # Drop duplicate features or classes
-    aln_feats = np.unique(np.array(aln_feats))
-    aln_classes = np.unique(np.array(aln_classes))
+    labels = np.array(labels, dtype=np.int64)
+    aln_feats = np.unique(registry.label_features[labels])
+    aln_classes = np.unique(registry.label_classes[labels])
 
     return aln_feats, aln_classes
 
-def tally_feature_counts(sam_alignment, ref_array_dict, class_counts, feat_counts,
-                         stats_out, write=False, outfile=None):
+def read_count(read_name):
+    """
+    Returns the number of reads a collapsed sequence represents, from its name.
+    Names from aquatx-collapse are formatted ID_count=COUNT. The older ID_xCOUNT
+    format is also accepted.
+    """
+    if '_count=' in read_name:
+        return int(read_name.rsplit('_count=', 1)[1])
+    return int(read_name.split('_x')[1])
+
+class FeatureAssigner:
+    """
+    Assigns integer feature and class IDs to batches of alignments.
+
+    When every reference array is a FeatureIndex, a batch of alignments is assigned with
+    one vectorized query per index, and the resulting labels are translated to IDs with
+    the registry's label arrays. HTSeq arrays are queried one alignment at a time with
+    assign_features(). With a FeatureSelector, every feature overlapping an alignment is
+    considered and the features.csv rules decide which are assigned. The ambiguous class
+    is registered on creation, so it has an ID for counting in every worker process.
+
+    Multi-mapping reads, and different reads from clusters such as those of piRNAs, often
+    align to the same intervals. Assignments are therefore cached by (chrom, strand, start,
+    end) in a least recently used cache, and only intervals missing from the cache are
+    queried. With a FeatureSelector, the read's 5' nucleotide and length are added to the
+    key, since the rules depend on them.
+
+    Attributes:
+        registry: the FeatureRegistry of the reference arrays' labels
+        selector: the FeatureSelector the arrays were built with, or None
+        ambiguous: the class ID of reads assigned to more than one class
+        batched: True if alignments are assigned with vectorized queries
+        cache_size: the maximum number of cached assignments. 0 disables the cache.
+    """
+    def __init__(self, ref_array_dict, registry, selector=None, cache_size=ASSIGN_CACHE_SIZE):
+        self.registry = registry
+        self.selector = selector
+        self.ambiguous = registry.class_id("ambiguous")
+        self.batched = all(isinstance(ref_array, FeatureIndex) for ref_array in ref_array_dict.values())
+        self.cache_size = cache_size
+        self._ref_array_dict = ref_array_dict
+        self._cache = OrderedDict()
+
+        # Feature and class IDs by label, with a final -1 for unassigned alignments
+        self._label_features = np.append(registry.label_features, -1)
+        self._label_classes = np.append(registry.label_classes, -1)
+
+    def save_indexes(self, directory):
+        """
+        Saves each numpy index which has no on-disk copy to directory, so that pickled copies
+        of the assigner memory-map the index rather than carrying its arrays.
+        """
+        for i, ref_array in enumerate(self._ref_array_dict.values()):
+            if isinstance(ref_array, FeatureIndex) and ref_array.path is None:
+                ref_array.save(os.path.join(directory, str(i)))
+
+    def __getstate__(self):
+        # Cached assignments aren't needed by worker processes
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def assign(self, alns, stats_counts=None):
+        """
+        Returns the (read sequence, strand, start, end, feature IDs, class IDs) of each
+        alignment. IDs are unique tuples, which are empty if no feature is assigned.
+        If stats_counts is given, the cache's hits and misses are added to it.
+        """
+        if not alns: return []
+        seqs = [str(aln.read) for aln in alns]
+        ivs = [(aln.iv.chrom, aln.iv.strand, aln.iv.start, aln.iv.end) for aln in alns]
+        if not self.cache_size:
+            return [(seq, *iv[1:], *ids)
+                    for seq, iv, ids in zip(seqs, ivs, self._assign_ids(alns, ivs, seqs))]
+
+        if self.selector is not None:
+            keys = [(*iv, seq[:1], len(seq)) for iv, seq in zip(ivs, seqs)]
+        else:
+            keys = ivs
+
+        # Look up each key once, and query the first alignment of each key which isn't cached
+        cache, results, missing = self._cache, [None] * len(alns), {}
+        for i, key in enumerate(keys):
+            ids = cache.get(key)
+            if ids is not None:
+                cache.move_to_end(key)
+                results[i] = ids
+            elif key not in missing:
+                missing[key] = i
+
+        if missing:
+            queries = list(missing.values())
+            assigned = dict(zip(missing, self._assign_ids([alns[i] for i in queries],
+                                                          [ivs[i] for i in queries],
+                                                          [seqs[i] for i in queries])))
+            for i, key in enumerate(keys):
+                if results[i] is None: results[i] = assigned[key]
+            cache.update(assigned)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+        if stats_counts is not None:
+            stats_counts['_assignment_cache_hits'] += len(alns) - len(missing)
+            stats_counts['_assignment_cache_misses'] += len(missing)
+
+        return [(seq, *iv[1:], *ids) for seq, iv, ids in zip(seqs, ivs, results)]
+
+    def _assign_ids(self, alns, ivs, seqs):
+        """Returns the (feature IDs, class IDs) of each alignment, given their intervals and reads"""
+        if not self.batched:
+            return [tuple(tuple(ids.tolist()) for ids in assign_features(aln, self._ref_array_dict,
+                                                                         self.registry))
+                    for aln in alns]
+
+        chroms, strands, starts, ends = zip(*ivs)
+        if self.selector is not None:
+            feats, classes = self.selector.assign_batch(self._ref_array_dict.values(), self.registry,
+                                                        chroms, strands, starts, ends, seqs)
+            return list(zip(feats, classes))
+
+        labels = np.stack([ref_array.assign_batch(chroms, strands, starts, ends)
+                           for ref_array in self._ref_array_dict.values()], axis=1)
+        feat_ids, class_ids = self._label_features[labels], self._label_classes[labels]
+
+        if labels.shape[1] == 1:
+            feats = [(i,) if i >= 0 else () for i in feat_ids[:, 0].tolist()]
+            classes = [(i,) if i >= 0 else () for i in class_ids[:, 0].tolist()]
+        else:
+            feats = [tuple(sorted({i for i in row if i >= 0})) for row in feat_ids.tolist()]
+            classes = [tuple(sorted({i for i in row if i >= 0})) for row in class_ids.tolist()]
+
+        return list(zip(feats, classes))
+
+    def new_counts(self):
+        """Returns zeroed class and feature count arrays"""
+        return (np.zeros(len(self.registry.class_names)),
+                np.zeros(len(self.registry.feature_names)))
+
+def tally_feature_counts(sam_alignment, ref_array_dict, registry, stats_out, write=False,
+                         outfile=None, workers=1, selector=None, cache_size=ASSIGN_CACHE_SIZE,
+                         stats_json=None):
     """
     Tally the counts appropriately for different features and classes of small RNAs.
 
+    Alignments are counted in bundles of consecutive alignments with the same read name,
+    as aligners report them. Coordinate sorted bam files are instead regrouped by read
+    name so that multi-mapping bundles stay intact.
+
     Inputs:
         sam_alignment: The sam/bam alignment file
         ref_array_dict: the dictionary containing reference genomic arrays
+        registry: the FeatureRegistry of the arrays' labels
         stats_out: file to write summary stats to
         write: boolean indicating whether the full feature information should be written
                Default is False.
-        outfile: the file handle to write to. Default is none, write must be True to write.
+        outfile: the AlnTableWriter to write to. Default is none, write must be True to write.
+        workers: the number of processes to assign features with. If greater than 1, the
+                 alignments are divided into chunks of whole bundles (or into references,
+                 for indexed coordinate sorted bam files) which are counted in parallel
+                 and reduced in file order. Default is 1. Reads of coordinate sorted bam
+                 files are grouped by name in memory when counted by reference, and are
+                 otherwise grouped on disk by collated_bam().
+        selector: the FeatureSelector which ref_array_dict was built with, to assign
+                  features by features.csv rules. Default: None
+        cache_size: the number of alignment intervals whose assignments are cached. The
+                    cache's hits, misses and hit rate are written to stats_out. 0 disables
+                    the cache. Default: ASSIGN_CACHE_SIZE
+        stats_json: file to also write summary stats to as JSON, in the fixed schema of
+                    count_stats.write_stats(). Default: None
 
     Outputs:
-        class_counts: A dataframe containing counts per possible class
-        feature_counts: A dataframe containing counts per feature
-        nt_len_mat: A dataframe containing counts per 5' nt x length
+        class_counts: An array of counts indexed by the registry's class IDs
+        feature_counts: An array of counts indexed by the registry's feature IDs
+        nt_len_mat: A dictionary of counts per 5' nt x length
     """
     nt_len_mat = {'A': Counter(),
                   'C': Counter(),
                   'T': Counter(),
                   'G': Counter()}
     stats_counts = Counter()
-
-    for aln_bundle in HTSeq.bundle_multiple_alignments(sam_alignment):
-        # Calculate counts for multimapping
-        dup_counts = int(aln_bundle[0].read.name.split('_x')[1])
-        cor_counts = dup_counts / len(aln_bundle)
-        stats_counts['_unique_sequences_aligned'] += 1
-        stats_counts['_aligned_reads'] += dup_counts
-        if len(aln_bundle) > 1:
-            stats_counts['_aligned_reads_multi_mapping'] += dup_counts
+    assigner = FeatureAssigner(ref_array_dict, registry, selector, cache_size)
+    class_counts, feat_counts = assigner.new_counts()
+    counters = class_counts, feat_counts, stats_counts, nt_len_mat
+    outfile = outfile if write else None
+    aln_file = getattr(sam_alignment, 'filename', None)
+
+    if aln_file is not None and is_coordinate_sorted(aln_file):
+        regions = bam_regions(aln_file, workers)
+        if regions == [None]:
+            # Grouping reads by name on disk keeps memory bounded by the size of a bundle
+            with collated_bam(aln_file) as collated:
+                tally_bundles(HTSeq.bundle_multiple_alignments(HTSeq.BAM_Reader(collated)), assigner,
+                              *counters, outfile)
         else:
-            stats_counts['_aligned_reads_unique_mapping'] += dup_counts
-
-        # fill in 5p nt/length matrix
-        nt_len_mat[str(aln_bundle[0].read)[0]][len(aln_bundle[0].read)] += dup_counts
-
-        # bundle counts
-        bundle_feats = Counter()
-        bundle_class = Counter()
-
-        for aln in aln_bundle:
-            aln_feats, aln_classes = assign_features(aln, ref_array_dict)
-            if write and outfile is not None:
-                aln_str = '\t'.join([str(aln.read), str(cor_counts), aln.iv.strand,
-                                     str(aln.iv.start), str(aln.iv.end), ';'.join(aln_classes),
-                                     ';'.join(aln_feats)])
-                outfile.write(aln_str + '\n')
-
-            if len(aln_classes) > 1:
-                bundle_class["ambiguous"] += cor_counts
-            elif len(aln_feats) > 1:
-                for feat in aln_feats:
-                    bundle_feats[feat] += cor_counts / len(aln_feats)
-            else:
-                if aln_classes.item() == '_no_feature':
-                    stats_counts['_no_feature'] += cor_counts
-                else:
-                    bundle_class[aln_classes.item()] += cor_counts
-                    bundle_feats[aln_feats.item()] += cor_counts
-
-        if len(bundle_class) > 1:
-            class_counts["ambiguous"] += sum(bundle_class.values())
-            stats_counts['_ambiguous_alignments_classes'] += 1
-            stats_counts['_ambiguous_reads_classes'] += dup_counts
-        elif len(bundle_feats) > 1:
-            key = next(iter(bundle_class))
-            stats_counts['_ambiguous_alignments_features'] += 1
-            stats_counts['_ambiguous_reads_features'] += dup_counts
-            class_counts[key] += bundle_class[key]
-            for key, value in bundle_feats.items():
-                feat_counts[key] += value
+            jobs = [(aln_file, region) for region in regions]
+            tally_read_groups(map_chunks(_assign_region, jobs, assigner, workers), assigner,
+                              *counters, outfile)
+    elif workers > 1 and aln_file is not None:
+        if is_sam_text(aln_file):
+            jobs = [(_sam_alignments, aln_file, start, end)
+                    for start, end in sam_bundle_ranges(aln_file, workers * CHUNKS_PER_WORKER)]
         else:
-            try:
-                key = next(iter(bundle_class))
-                class_counts[key] += bundle_class[key]
-                key = next(iter(bundle_feats))
-                feat_counts[key] += bundle_feats[key]
-                stats_counts['_alignments_unique_features'] += 1
-                stats_counts['_reads_unique_features'] += 1
-            except StopIteration:
-                pass
+            jobs = [(_bam_alignments, aln_file, start, end)
+                    for start, end in bam_bundle_ranges(aln_file, workers * CHUNKS_PER_WORKER)]
+        reduce_chunks(map_chunks(_tally_range, jobs, assigner, workers, outfile is not None),
+                      *counters, outfile)
+    else:
+        tally_bundles(HTSeq.bundle_multiple_alignments(sam_alignment), assigner,
+                      *counters, outfile)
+
+    # Cache statistics are listed last
+    cache_stats = [(key, stats_counts.pop(key, 0))
+                   for key in ['_assignment_cache_hits', '_assignment_cache_misses']]
+
+    if cache_size:
+        hits, misses = cache_stats[0][1], cache_stats[1][1]
+        cache_stats.append(('_assignment_cache_hit_rate', round(hits / max(hits + misses, 1), 4)))
 
     with open(stats_out, 'w') as out:
         out.write('Summary Statistics\n')
         for key, value in stats_counts.items():
+            if key == '_no_feature': continue
             out.write('\t'.join([key, str(value) + '\n']))
-        out.write('\t'.join(['_no_feature', feat_counts['_no_feature'] + '\n']))
+        # Stats files have always listed _no_feature, even when every read was assigned
+        out.write('\t'.join(['_no_feature', str(stats_counts.get('_no_feature', 0)) + '\n']))
+        if cache_size:
+            for key, value in cache_stats:
+                out.write('\t'.join([key, str(value) + '\n']))
+
+    if stats_json is not None:
+        write_stats({**stats_counts, **dict(cache_stats)}, stats_json)
 
     return class_counts, feat_counts, nt_len_mat
 
+def tally_bundles(aln_bundles, assigner, class_counts, feat_counts, stats_counts,
+                  nt_len_mat, outfile=None):
+    """
+    Assigns each bundle of multi-mapping alignments to features and adds its counts.
+    Bundles are assigned in batches of about ASSIGN_BATCH_SIZE alignments.
+
+    Inputs:
+        aln_bundles: An iterable of lists of alignments, one list per read
+        assigner: the FeatureAssigner for the reference arrays
+        class_counts, feat_counts: arrays to add class and feature counts to, by ID
+        stats_counts: Counter to add summary counts to
+        nt_len_mat: dictionary of Counters to add 5' nt x length counts to
+        outfile: AlnTableWriter to write each alignment's features to. Default: None
+    """
+    def tally_batch(bundles):
+        assignments = assigner.assign([aln for bundle in bundles for aln in bundle], stats_counts)
+        start = 0
+        for bundle in bundles:
+            tally_bundle(bundle[0].read.name, assignments[start:start + len(bundle)], assigner,
+                         class_counts, feat_counts, stats_counts, nt_len_mat, outfile)
+            start += len(bundle)
+
+    batch, batch_size = [], 0
+    for aln_bundle in aln_bundles:
+        batch.append(aln_bundle)
+        batch_size += len(aln_bundle)
+        if batch_size >= ASSIGN_BATCH_SIZE:
+            tally_batch(batch)
+            batch, batch_size = [], 0
+    tally_batch(batch)
+
+def tally_bundle(read_name, assignments, assigner, class_counts, feat_counts, stats_counts,
+                 nt_len_mat, outfile=None):
+    """
+    Adds the counts of one read's bundle of alignments.
+
+    Inputs:
+        read_name: the read's name, which holds its count
+        assignments: the (read sequence, strand, start, end, feature IDs, class IDs) of
+                     each alignment, from FeatureAssigner.assign()
+        assigner: the FeatureAssigner which assigned the alignments
+        class_counts, feat_counts: arrays to add class and feature counts to, by ID
+        stats_counts: Counter to add summary counts to
+        nt_len_mat: dictionary of Counters to add 5' nt x length counts to
+        outfile: AlnTableWriter to write each alignment's features to. Default: None
+    """
+    # Calculate counts for multimapping
+    dup_counts = read_count(read_name)
+    cor_counts = dup_counts / len(assignments)
+    stats_counts['_unique_sequences_aligned'] += 1
+    stats_counts['_aligned_reads'] += dup_counts
+    if len(assignments) > 1:
+        stats_counts['_aligned_reads_multi_mapping'] += dup_counts
+    else:
+        stats_counts['_aligned_reads_unique_mapping'] += dup_counts
+
+    # fill in 5p nt/length matrix
+    read_seq = assignments[0][0]
+    nt_len_mat[read_seq[0]][len(read_seq)] += dup_counts
+
+    # bundle counts
+    bundle_feats = Counter()
+    bundle_class = Counter()
+
+    if outfile is not None:
+        outfile.add(cor_counts, assignments)
+
+    # bundle counts by ID
+    for aln_seq, strand, start, end, aln_feats, aln_classes in assignments:
+        if len(aln_classes) > 1:
+            bundle_class[assigner.ambiguous] += cor_counts
+        elif len(aln_feats) > 1:
+            # Several features of one class share the alignment's counts
+            bundle_class[aln_classes[0]] += cor_counts
+            for feat in aln_feats:
+                bundle_feats[feat] += cor_counts / len(aln_feats)
+        elif not aln_feats:
+            stats_counts['_no_feature'] += cor_counts
+        else:
+            bundle_class[aln_classes[0]] += cor_counts
+            bundle_feats[aln_feats[0]] += cor_counts
+
+    if len(bundle_class) > 1:
+        class_counts[assigner.ambiguous] += sum(bundle_class.values())
+        stats_counts['_ambiguous_alignments_classes'] += 1
+        stats_counts['_ambiguous_reads_classes'] += dup_counts
+    elif len(bundle_feats) > 1:
+        key = next(iter(bundle_class))
+        stats_counts['_ambiguous_alignments_features'] += 1
+        stats_counts['_ambiguous_reads_features'] += dup_counts
+        class_counts[key] += bundle_class[key]
+        for key, value in bundle_feats.items():
+            feat_counts[key] += value
+    else:
+        try:
+            key = next(iter(bundle_class))
+            class_counts[key] += bundle_class[key]
+            key = next(iter(bundle_feats))
+            feat_counts[key] += bundle_feats[key]
+            stats_counts['_alignments_unique_features'] += 1
+            stats_counts['_reads_unique_features'] += 1
+        except StopIteration:
+            pass
+
+def tally_read_groups(chunks, assigner, class_counts, feat_counts, stats_counts, nt_len_mat,
+                      outfile=None):
+    """
+    Combines the assigned alignments of each read across chunks, then adds each read's counts.
+
+    Inputs:
+        chunks: An iterable of (dictionary of read name -> assignments, Counter of cache
+                statistics) from _assign_region(). Reads are counted in the order they are
+                first seen.
+        assigner: the FeatureAssigner which assigned the chunks
+        class_counts, feat_counts: arrays to add class and feature counts to, by ID
+        stats_counts, nt_len_mat: Counters to add summary and 5' nt x length counts to
+        outfile: AlnTableWriter to write each alignment's features to. Default: None
+    """
+    reads = {}
+    for chunk, cache_stats in chunks:
+        stats_counts.update(cache_stats)
+        for read_name, assignments in chunk.items():
+            if read_name in reads:
+                reads[read_name].extend(assignments)
+            else:
+                reads[read_name] = assignments
+
+    for read_name, assignments in reads.items():
+        tally_bundle(read_name, assignments, assigner, class_counts, feat_counts, stats_counts,
+                     nt_len_mat, outfile)
+
+def reduce_chunks(chunks, class_counts, feat_counts, stats_counts, nt_len_mat, outfile=None):
+    """
+    Adds the counts of chunks counted by _tally_range() in order, and appends each
+    chunk's intermediate alignment table to outfile.
+    """
+    for counts, chunk_out in chunks:
+        class_counts += counts[0]
+        feat_counts += counts[1]
+        stats_counts.update(counts[2])
+        for nt, lengths in counts[3].items():
+            nt_len_mat[nt].update(lengths)
+        if chunk_out is not None:
+            outfile.add_table(chunk_out)
+            os.remove(chunk_out)
+
+def map_chunks(func, jobs, assigner, workers, chunk_files=False):
+    """
+    Yields func(assigner, *job) for each job, in order, using a pool of worker processes.
+
+    Where processes can be forked safely (see scheduler.process_context()), workers share the
+    parent's assigner and reference arrays rather than receiving copies. Otherwise, numpy
+    indexes are passed to workers by path and memory-mapped, so workers share the pages of
+    the on-disk index; indexes which weren't loaded from or saved to a cache are first saved
+    to a temporary directory. If chunk_files is True, each job is also given the path of a
+    temporary file to write its intermediate alignment table to.
+    """
+    with tempfile.TemporaryDirectory(prefix='aquatx_count_') as tmp:
+        if chunk_files:
+            jobs = [(*job, os.path.join(tmp, f"chunk_{i}.txt")) for i, job in enumerate(jobs)]
+
+        if workers == 1 or len(jobs) < 2:
+            for job in jobs:
+                yield func(assigner, *job)
+            return
+
+        context = process_context()
+        if context.get_start_method() != 'fork':
+            assigner.save_indexes(os.path.join(tmp, 'index'))
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(assigner,)) as pool:
+            futures = [pool.submit(_in_worker, func, *job) for job in jobs]
+            for future in futures:
+                yield future.result()
+
+def sam_bundle_ranges(sam_file, n):
+    """
+    Divides the alignments of a sam file into at most n byte ranges which begin and end
+    on bundle boundaries, so that each read's alignments fall in the same range.
+    """
+    size = os.path.getsize(sam_file)
+    with open(sam_file, 'rb') as f:
+        # Skip the header
+        start = 0
+        for line in f:
+            if not line.startswith(b'@'): break
+            start += len(line)
+
+        bounds = [start]
+        for i in range(1, n):
+            f.seek(max(start + (size - start) * i // n, bounds[-1]))
+            if f.tell() > start:
+                f.seek(f.tell() - 1)
+                f.readline()  # Move to the start of the next line
+            bounds.append(_next_bundle_start(f))
+    bounds.append(size)
+
+    return [(s, e) for s, e in zip(bounds, bounds[1:]) if e > s]
+
+def _next_bundle_start(f):
+    """Returns the offset of the first line after the bundle of the current line of f"""
+    name = f.readline().split(b'\t', 1)[0]
+    offset = f.tell()
+    for line in iter(f.readline, b''):
+        if line.split(b'\t', 1)[0] != name: break
+        offset = f.tell()
+    return offset
+
+def bam_bundle_ranges(bam_file, n):
+    """
+    Divides the alignments of a bam file into at most n ranges of BGZF virtual offsets
+    which begin and end on bundle boundaries. The file is scanned once to find them,
+    which only decompresses records and is fast compared to assigning features.
+    """
+    size = os.path.getsize(bam_file)
+    with pysam.AlignmentFile(bam_file, check_sq=False) as sf:
+        records = sf.fetch(until_eof=True)
+        bounds = [sf.tell()]
+        target, prev_name = 1, None
+        while True:
+            offset = sf.tell()
+            record = next(records, None)
+            if record is None: break
+            # Virtual offsets hold the compressed offset of the record's block in their high bits
+            if record.query_name != prev_name and (offset >> 16) >= size * target // n:
+                if offset > bounds[-1]: bounds.append(offset)
+                target = (offset >> 16) * n // size + 1
+            prev_name = record.query_name
+        bounds.append(offset)
+
+    return list(zip(bounds, bounds[1:]))
+
+def bam_regions(bam_file, workers):
+    """
+    Returns the references with aligned reads in an indexed bam file, to assign in parallel,
+    or [None] to assign the whole file at once.
+    """
+    if workers == 1: return [None]
+    with pysam.AlignmentFile(bam_file) as sf:
+        if not sf.has_index(): return [None]
+        return [stat.contig for stat in sf.get_index_statistics() if stat.mapped]
+
+def is_sam_text(aln_file):
+    """Returns True if the file is an uncompressed sam file, rather than bam or cram"""
+    with open(aln_file, 'rb') as f:
+        magic = f.read(4)
+    return magic[:2] != b'\x1f\x8b' and magic != b'CRAM'
+
+@contextmanager
+def collated_bam(bam_file):
+    """
+    Yields the path of a temporary copy of a bam file in which each read's alignments are
+    adjacent. Alignments are grouped by samtools collate (via pysam), which spills to
+    temporary files rather than holding the file's reads in memory.
+    """
+    with tempfile.TemporaryDirectory(prefix='aquatx_collate_') as tmp:
+        collated = os.path.join(tmp, 'collated.bam')
+        pysam.collate('-u', '-o', collated, '-T', os.path.join(tmp, 'collate'), bam_file,
+                      catch_stdout=False)
+        yield collated
+
+def is_coordinate_sorted(aln_file):
+    """Returns True if the alignment file's header declares it sorted by coordinate"""
+    with pysam.AlignmentFile(aln_file, check_sq=False) as sf:
+        return sf.header.to_dict().get('HD', {}).get('SO') == 'coordinate'
+
+def _init_worker(assigner):
+    global _worker_assigner
+    _worker_assigner = assigner
+
+def _in_worker(func, *args):
+    return func(_worker_assigner, *args)
+
+def _sam_alignments(sam_file, start, end):
+    """Yields the alignments of a byte range of a sam file"""
+    with open(sam_file, 'rb') as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            offset += len(line)
+            yield HTSeq.SAM_Alignment.from_SAM_line(line.decode())
+            if offset >= end: break
+
+def _bam_alignments(bam_file, start, end):
+    """Yields the alignments of a range of virtual offsets of a bam file"""
+    with pysam.AlignmentFile(bam_file, check_sq=False) as sf:
+        sf.seek(start)
+        records = sf.fetch(until_eof=True)
+        while sf.tell() < end:
+            yield HTSeq.SAM_Alignment.from_pysam_AlignedSegment(next(records), sf)
+
+def _tally_range(assigner, reader, aln_file, start, end, chunk_out=None):
+    """Counts the bundles of a range of an alignment file"""
+    counts = *assigner.new_counts(), Counter(), {nt: Counter() for nt in 'ACTG'}
+
+    outfile = AlnTableWriter(chunk_out, assigner.registry, header=False) \
+        if chunk_out is not None else None
+    try:
+        tally_bundles(HTSeq.bundle_multiple_alignments(reader(aln_file, start, end)),
+                      assigner, *counts, outfile)
+    finally:
+        if outfile is not None: outfile.close()
+
+    return counts, chunk_out
+
+def _assign_region(assigner, bam_file, region=None):
+    """
+    Assigns features to the aligned reads of one reference of an indexed bam file, or of the
+    whole file if region is None, and groups them by read name. The assignment cache's
+    statistics are returned with them.
+    """
+    reads, cache_stats = {}, Counter()
+
+    def assign_batch(alns):
+        for aln, assignment in zip(alns, assigner.assign(alns, cache_stats)):
+            reads.setdefault(aln.read.name, []).append(assignment)
+
+    with pysam.AlignmentFile(bam_file, check_sq=False) as sf:
+        records = sf.fetch(region) if region is not None else sf.fetch(until_eof=True)
+        batch = []
+        for record in records:
+            if record.is_unmapped: continue
+            batch.append(HTSeq.SAM_Alignment.from_pysam_AlignedSegment(record, sf))
+            if len(batch) >= ASSIGN_BATCH_SIZE:
+                assign_batch(batch)
+                batch = []
+        assign_batch(batch)
+
+    return reads, cache_stats
+
+def write_counts(out_prefix, registry, class_counts, feat_counts, nt_len_mat):
+    """
+    Writes the class counts, feature counts and 5' nt x length distribution of a sample.
+
+    Inputs:
+        out_prefix: the prefix of the output files
+        registry: the FeatureRegistry which the count arrays are indexed by
+        class_counts: an array of counts indexed by the registry's class IDs
+        feat_counts: an array of counts indexed by the registry's feature IDs
+        nt_len_mat: a dictionary of counts per 5' nt x length
+    """
+    class_counts_df = pd.DataFrame({'class': registry.class_names, 'count': class_counts})
+    feat_counts_df = pd.DataFrame({'feature': registry.feature_names, 'count': feat_counts})
+
+    # The ambiguous class is only reported when reads were counted to it
+    class_counts_df = class_counts_df[(class_counts_df['class'] != 'ambiguous') | (class_counts_df['count'] > 0)]
+
+    class_counts_df.to_csv(out_prefix + '_out_class_counts.csv', index=False, header=False)
+    feat_counts_df.to_csv(out_prefix + '_out_feature_counts.txt', sep='\t', index=False, header=False)
+    pd.DataFrame(nt_len_mat).to_csv(out_prefix + '_out_nt_len_dist.csv')
+
 def main():
     """
     Main routine for small RNA counter script
@@ -268,43 +893,47 @@ def main():
     sam_alignment = HTSeq.SAM_Reader(args.input_file)
 
     # Step 3: Create feature arrays from GFF files
-    ref_array_dict, class_counts, feat_counts = create_ref_dict(args.ref_annotations,
-                                                                args.antisense,
-                                                                args.mask_file)
+    selector = FeatureSelector(read_rules(args.features_csv)) if args.features_csv else None
+    ref_array_dict, registry = create_ref_dict(args.ref_annotations,
+                                               args.antisense,
+                                               args.mask_file,
+                                               args.feature_index,
+                                               args.index_cache,
+                                               selector)
     print("Processed feature arrays...")
 
     # Step 4: Assign alignment counts to features
     stats_out = args.out_prefix + '_stats.txt'
+    stats_json = args.out_prefix + '_stats.json'
 
     # Save an intermediate file with all assigned features
     if args.intermed_file:
-        aln_int_file = args.out_prefix + '_out_aln_table.txt'
-        aln_header = '\t'.join(['seq', 'counts', 'strand', 'start', 'end', 'classes', 'features'])
-        with open(aln_int_file, 'w') as outfile:
-            outfile.write(aln_header + '\n')
+        aln_int_file = args.out_prefix + '_out_aln_table' + FORMATS[args.intermed_format]
+        with AlnTableWriter(aln_int_file, registry, args.intermed_format) as outfile:
             class_counts, feat_counts, nt_len_mat = tally_feature_counts(sam_alignment,
                                                                          ref_array_dict,
-                                                                         class_counts,
-                                                                         feat_counts,
+                                                                         registry,
                                                                          stats_out,
                                                                          write=True,
-                                                                         outfile=outfile)
+                                                                         outfile=outfile,
+                                                                         workers=args.workers,
+                                                                         selector=selector,
+                                                                         cache_size=args.cache_size,
+                                                                         stats_json=stats_json)
     else:
         # assign features
         class_counts, feat_counts, nt_len_mat = tally_feature_counts(sam_alignment,
                                                                      ref_array_dict,
-                                                                     class_counts,
-                                                                     feat_counts,
-                                                                     stats_out)
+                                                                     registry,
+                                                                     stats_out,
+                                                                     workers=args.workers,
+                                                                     selector=selector,
+                                                                     cache_size=args.cache_size,
+                                                                     stats_json=stats_json)
 
     print("Completed feature assignment...")
-    class_counts_df = pd.DataFrame.from_dict(class_counts, orient='index').reset_index()
-    feat_counts_df = pd.DataFrame.from_dict(feat_counts, orient='index').reset_index().drop('_no_feature')
-
     print("Writing final count files...")
-    class_counts_df.to_csv(args.out_prefix + '_out_class_counts.csv', index=False, header=False)
-    feat_counts_df.to_csv(args.out_prefix + '_out_feature_counts.txt', sep='\t', index=False, header=False)
-    pd.DataFrame(nt_len_mat).to_csv(args.out_prefix + '_out_nt_len_dist.csv')
+    write_counts(args.out_prefix, registry, class_counts, feat_counts, nt_len_mat)
 
 if __name__ == '__main__':
     main()
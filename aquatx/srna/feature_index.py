@@ -0,0 +1,499 @@
+"""
+A NumPy feature index for assigning alignments to features.
+
+This is an alternative to HTSeq's GenomicArrayOfSets for the counter. Features are
+added with the same interval and label interface, then compiled into sorted arrays
+per chromosome and strand. The genome is divided into elementary segments at every
+feature start and end, so that the set of features covering each segment is constant.
+Each segment's set is stored in compressed sparse row form, and a query only needs a
+binary search for the segment containing the alignment's start followed by a lookup
+of the next non-empty segment.
+
+Feature assignment follows the counter's HTSeq rules exactly: an alignment is assigned
+to a feature when the first covered position of the alignment is covered by that
+feature alone, and the feature is not a mask.
+
+Labels are integer IDs from a FeatureRegistry, which numbers the features, classes
+and masks of all of a run's annotations so that counts can be held in arrays.
+
+Compiled indexes can be saved to a directory of .npy files and memory-mapped on later
+runs. index_cache_key() derives a cache directory name from the contents of the GFF
+files and the index options, so a cached index is never used for changed inputs.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from collections import defaultdict
+from typing import Optional, Tuple
+
+# Incremented whenever the saved index format changes, which invalidates existing caches
+CACHE_VERSION = 3
+
+_ARRAYS = ['bounds', 'next_nonempty', 'single', 'ptr', 'seg_labels']
+
+
+class FeatureRegistry:
+    """Dense integer IDs for the features, classes and masks of a run's annotations
+
+    Each annotation is registered as a label: a feature of a class, or a mask. Labels,
+    features and classes are numbered from 0 in the order they are first registered,
+    so counts can be held in arrays indexed by ID and names are only needed for output.
+    Masks have no feature or class ID.
+
+    Attributes:
+        feature_names: Feature name by feature ID
+        class_names: Class name by class ID
+    """
+
+    def __init__(self):
+        self.feature_names = []
+        self.class_names = []
+
+        self._feature_ids = {}
+        self._class_ids = {}
+        self._label_ids = {}      # (name, class, is mask) -> label ID
+        self._labels = []         # (name, class, is mask) by label ID
+        self._label_features = []
+        self._label_classes = []
+        self._arrays = None
+
+    def add(self, name: str, feature_class: str, mask: bool = False) -> int:
+        """Registers a feature of a class, or a mask, and returns its label ID"""
+
+        key = (name, feature_class, mask)
+        label = self._label_ids.get(key)
+        if label is None:
+            label = self._label_ids[key] = len(self._labels)
+            self._labels.append(key)
+            self._label_features.append(-1 if mask else self.feature_id(name))
+            self._label_classes.append(-1 if mask else self.class_id(feature_class))
+            self._arrays = None
+
+        return label
+
+    def feature_id(self, name: str) -> int:
+        """Returns the ID of a feature, registering it if it is new"""
+
+        feature_id = self._feature_ids.get(name)
+        if feature_id is None:
+            feature_id = self._feature_ids[name] = len(self.feature_names)
+            self.feature_names.append(name)
+        return feature_id
+
+    def class_id(self, name: str) -> int:
+        """Returns the ID of a class, registering it if it is new"""
+
+        class_id = self._class_ids.get(name)
+        if class_id is None:
+            class_id = self._class_ids[name] = len(self.class_names)
+            self.class_names.append(name)
+        return class_id
+
+    def label(self, label: int) -> Tuple[str, str, bool]:
+        """Returns the (name, class, is mask) of a label ID"""
+
+        return self._labels[label]
+
+    @property
+    def label_features(self) -> np.ndarray:
+        """The feature ID of each label ID, -1 for masks"""
+
+        return self._label_arrays()[0]
+
+    @property
+    def label_classes(self) -> np.ndarray:
+        """The class ID of each label ID, -1 for masks"""
+
+        return self._label_arrays()[1]
+
+    @property
+    def is_mask(self) -> np.ndarray:
+        """A boolean array which is True for the label IDs of masks"""
+
+        return self._label_arrays()[2]
+
+    def _label_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if self._arrays is None:
+            features = np.array(self._label_features, dtype=np.int64)
+            self._arrays = (features, np.array(self._label_classes, dtype=np.int64),
+                            np.array([label[2] for label in self._labels], dtype=bool))
+        return self._arrays
+
+
+class FeatureIndex:
+    """An index of labelled intervals compiled into NumPy arrays
+
+    Labels are label IDs from the index's FeatureRegistry. The index is compiled the
+    first time it is queried; intervals added after that trigger a recompile on the next
+    query. Indexes returned by load() are read-only.
+
+    Attributes:
+        stranded: If false, intervals and queries ignore strand
+        registry: The FeatureRegistry of the index's labels
+        path: The directory the index was saved to or loaded from, or None. Indexes
+            with a path are pickled by path and memory-mapped when unpickled.
+    """
+
+    def __init__(self, registry: FeatureRegistry, stranded: bool = True):
+        self.registry = registry
+        self.stranded = stranded
+        self.path = None
+
+        self._labels = []         # Registry label by local label ID
+        self._label_ids = {}      # Registry label -> local label ID
+        self._intervals = defaultdict(list)  # (chrom, strand) -> [(start, end, local label ID)]
+        self._compiled = None     # (chrom, strand) -> (bounds, next_nonempty, single)
+        self._label_map = None    # Registry label by local label ID, with -1 for unassigned last
+        self._read_only = False
+
+    def add(self, iv, label: int) -> None:
+        """Adds a label to an HTSeq GenomicInterval (or any object with chrom, start, end and strand)"""
+
+        if self._read_only:
+            raise ValueError("Features can't be added to an index loaded from a cache.")
+        if self.stranded and iv.strand not in ('+', '-'):
+            raise KeyError("Non-stranded index used for stranded GenomicArray.")
+
+        label_id = self.add_label(label)
+        self._intervals[self._key(iv.chrom, iv.strand)].append((iv.start, iv.end, label_id))
+        self._compiled = self.path = None
+
+    def add_label(self, label: int) -> int:
+        """Adds a label to the index, even if it has no intervals, and returns its local label ID
+
+        Labels are saved with the index, so a label added without intervals (such as that
+        of a fully masked feature) is still registered when the index is loaded.
+        """
+
+        if self._read_only:
+            raise ValueError("Features can't be added to an index loaded from a cache.")
+
+        label_id = self._label_ids.get(label)
+        if label_id is None:
+            label_id = self._label_ids[label] = len(self._labels)
+            self._labels.append(label)
+            self._compiled = self.path = None
+
+        return label_id
+
+    def assign(self, chrom: str, strand: str, start: int, end: int) -> Optional[int]:
+        """Returns the registry label assigned to an alignment, or None if it isn't assigned"""
+
+        if self._compiled is None: self.compile()
+
+        arrays = self._compiled.get(self._key(chrom, strand))
+        if arrays is None: return None
+        bounds, next_nonempty, single = arrays
+
+        # The segment containing start, or the first segment if start precedes all features
+        seg = max(int(np.searchsorted(bounds, start, side='right')) - 1, 0)
+        seg = next_nonempty[seg]
+        if seg == len(single) or bounds[seg] >= end: return None
+
+        label_id = single[seg]
+        return None if label_id < 0 else self._labels[label_id]
+
+    def assign_batch(self, chroms, strands, starts, ends) -> np.ndarray:
+        """Returns the registry label assigned to each of a batch of alignments, or -1 if it isn't assigned
+
+        Alignments are grouped by chromosome and strand, and each group is queried with
+        a single vectorized search.
+
+        Args:
+            chroms: The chromosome of each alignment
+            strands: The strand of each alignment, '+' or '-'
+            starts: The start of each alignment
+            ends: The end of each alignment
+        """
+
+        if self._compiled is None: self.compile()
+
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        label_ids = np.full(len(starts), -1, dtype=np.int64)
+        if not len(starts): return label_ids
+
+        # Strands are a single character, so each key can be split from the end
+        keys = np.char.add(np.asarray(chroms, dtype=str),
+                           np.asarray(strands, dtype=str) if self.stranded else '.')
+        groups, inverse = np.unique(keys, return_inverse=True)
+        for group, key in enumerate(groups):
+            arrays = self._compiled.get((key[:-1], key[-1]))
+            if arrays is None: continue
+            bounds, next_nonempty, single = arrays
+            rows = np.flatnonzero(inverse == group)
+
+            seg = np.maximum(np.searchsorted(bounds, starts[rows], side='right') - 1, 0)
+            seg = next_nonempty[seg]
+            hit = seg < len(single)
+            seg = np.minimum(seg, len(single) - 1)
+            hit &= bounds[seg] < ends[rows]
+            label_ids[rows[hit]] = single[seg[hit]]
+
+        return self._label_map[label_ids]
+
+    def overlaps_batch(self, chroms, strands, starts, ends) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns every registry label overlapping each of a batch of alignments
+
+        Unlike assign_batch(), every label covering any position of an alignment is
+        returned, including masks. Args are as for assign_batch().
+
+        Returns: Arrays of (alignment row, registry label) pairs, each pair listed once
+        """
+
+        if self._compiled is None: self.compile()
+
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        rows, labels = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        if not len(starts) or not self._labels: return rows[0], labels[0]
+
+        keys = np.char.add(np.asarray(chroms, dtype=str),
+                           np.asarray(strands, dtype=str) if self.stranded else '.')
+        groups, inverse = np.unique(keys, return_inverse=True)
+        for group, key in enumerate(groups):
+            segments = self._segments.get((key[:-1], key[-1]))
+            if segments is None: continue
+            bounds, ptr, seg_labels = segments
+            group_rows = np.flatnonzero(inverse == group)
+
+            # The labels of the segments from the one containing start to the last which begins before end
+            first = np.maximum(np.searchsorted(bounds, starts[group_rows], side='right') - 1, 0)
+            last = np.minimum(np.searchsorted(bounds, ends[group_rows], side='left'), len(ptr) - 1)
+            lo, hi = ptr[np.minimum(first, last)], ptr[last]
+            counts = hi - lo
+            rows.append(np.repeat(group_rows, counts))
+            labels.append(seg_labels[np.repeat(lo, counts) + _ranges(counts)])
+
+        rows, labels = np.concatenate(rows), np.concatenate(labels)
+        pairs = np.unique(rows * len(self._labels) + labels)
+        return pairs // len(self._labels), self._label_map[pairs % len(self._labels)]
+
+    def labels_at(self, chrom: str, strand: str, pos: int) -> set:
+        """Returns the set of registry labels covering a position, as GenomicArrayOfSets would"""
+
+        if self._compiled is None: self.compile()
+
+        key = self._key(chrom, strand)
+        if key not in self._compiled: return set()
+        bounds, ptr, seg_labels = self._segments[key]
+        seg = int(np.searchsorted(bounds, pos, side='right')) - 1
+        if seg < 0 or seg >= len(ptr) - 1: return set()
+        return {self._labels[i] for i in seg_labels[ptr[seg]:ptr[seg + 1]]}
+
+    def compile(self) -> None:
+        """Compiles the added intervals into segment arrays"""
+
+        self._compiled, self._segments = {}, {}
+        self._label_map = np.array(self._labels + [-1], dtype=np.int64)
+        is_mask = self.registry.is_mask[self._label_map[:-1]]
+
+        for key, intervals in self._intervals.items():
+            starts, ends, labels = (np.array(col, dtype=np.int64) for col in zip(*intervals))
+            bounds = np.unique(np.concatenate([starts, ends]))
+            n_segs = len(bounds) - 1
+
+            # Expand each interval into the segments it covers
+            first, last = np.searchsorted(bounds, starts), np.searchsorted(bounds, ends)
+            lengths = last - first
+            segs = np.repeat(first, lengths) + _ranges(lengths)
+            seg_labels = np.repeat(labels, lengths)
+
+            # Sets hold each label once per segment
+            pairs = np.unique(segs * len(self._labels) + seg_labels)
+            segs, seg_labels = pairs // len(self._labels), pairs % len(self._labels)
+            counts = np.bincount(segs, minlength=n_segs)
+            ptr = np.concatenate([[0], np.cumsum(counts)])
+
+            # A segment assigns a feature if it holds exactly one label which isn't a mask
+            single = np.full(n_segs, -1, dtype=np.int64)
+            one = counts == 1
+            single[one] = seg_labels[ptr[:-1][one]]
+            single[one & is_mask[np.maximum(single, 0)]] = -1
+
+            # next_nonempty[i] is the first segment at or after i which is covered by any label
+            nonempty = np.flatnonzero(counts)
+            next_nonempty = np.full(n_segs + 1, n_segs, dtype=np.int64)
+            at = np.searchsorted(nonempty, np.arange(n_segs))
+            has_next = at < len(nonempty)
+            next_nonempty[:n_segs][has_next] = nonempty[at[has_next]]
+
+            self._compiled[key] = (bounds, next_nonempty, single)
+            self._segments[key] = (bounds, ptr, seg_labels)
+
+    def save(self, path: str, **meta) -> None:
+        """Saves the compiled index to a new directory
+
+        The directory is written under a temporary name and renamed into place, so
+        concurrent runs never load a partially written index. If another run saved
+        the same index first, its copy is kept.
+
+        Args:
+            path: The directory to create
+            meta: Additional JSON serializable values to store with the index
+        """
+
+        if self._compiled is None: self.compile()
+
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp_', dir=parent)
+        try:
+            keys = []
+            for i, key in enumerate(self._compiled):
+                bounds, next_nonempty, single = self._compiled[key]
+                _, ptr, seg_labels = self._segments[key]
+                for name, array in zip(_ARRAYS, [bounds, next_nonempty, single, ptr, seg_labels]):
+                    np.save(os.path.join(tmp, f"{i}_{name}.npy"), array)
+                keys.append(list(key))
+
+            labels = [self.registry.label(label) for label in self._labels]
+            with open(os.path.join(tmp, 'index.json'), 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'stranded': self.stranded, 'keys': keys,
+                           'labels': labels, 'meta': meta}, f)
+            os.rename(tmp, path)
+        except OSError:
+            if not os.path.isdir(path): raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.path = path
+
+    @classmethod
+    def load(cls, path: str, registry: FeatureRegistry, mmap: bool = True) -> Tuple['FeatureIndex', dict]:
+        """Loads an index saved by save()
+
+        The index's labels are added to the registry in the order they were first added
+        to the saved index, so the registry assigns the same IDs as building the index anew.
+
+        Args:
+            path: The index directory
+            registry: The registry to add the index's labels to
+            mmap: If true, arrays are memory-mapped rather than read into memory
+
+        Returns: The read-only index and the metadata it was saved with
+        """
+
+        with open(os.path.join(path, 'index.json')) as f:
+            saved = json.load(f)
+        if saved['version'] != CACHE_VERSION:
+            raise ValueError(f"Feature index cache {path} was written by an incompatible version.")
+
+        index = cls(registry, stranded=saved['stranded'])
+        index._labels = [registry.add(*label) for label in saved['labels']]
+        index._label_ids = {label: i for i, label in enumerate(index._labels)}
+        index._label_map = np.array(index._labels + [-1], dtype=np.int64)
+        index._compiled, index._segments = {}, {}
+        for i, key in enumerate(map(tuple, saved['keys'])):
+            arrays = [np.load(os.path.join(path, f"{i}_{name}.npy"), mmap_mode='r' if mmap else None)
+                      for name in _ARRAYS]
+            index._compiled[key] = tuple(arrays[:3])
+            index._segments[key] = (arrays[0], arrays[3], arrays[4])
+        index._read_only = True
+        index.path = path
+
+        return index, saved['meta']
+
+    def __reduce__(self):
+        # Worker processes map a saved index from disk rather than receiving a copy of its arrays
+        if self.path is None:
+            return super().__reduce__()
+        return _load_index, (self.path, self.registry)
+
+    @property
+    def labels(self) -> list:
+        """The registry label of each of the index's local label IDs, in the order they were added"""
+
+        return list(self._labels)
+
+    def _key(self, chrom: str, strand: str) -> Tuple[str, str]:
+        return chrom, strand if self.stranded else '.'
+
+
+def _load_index(path: str, registry: FeatureRegistry) -> FeatureIndex:
+    return FeatureIndex.load(path, registry)[0]
+
+
+def index_cache_key(*files, **options) -> str:
+    """Returns a hash of the contents of files (None is allowed) and of the index options"""
+
+    digest = hashlib.sha256(f"{CACHE_VERSION}:{json.dumps(options, sort_keys=True)}".encode())
+    for file in files:
+        digest.update(b'\0')
+        if file is None: continue
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+def subtract_masks(features: list, masks: list, stranded: bool = True) -> list:
+    """Removes the positions covered by masks from features
+
+    Masks are merged into disjoint intervals for each chromosome (and strand, if
+    stranded) and subtracted from every feature on the same chromosome and strand, so
+    masks never need to be added to an index. Masks without a strand apply to both
+    strands. Features keep their labels, and fully masked features are dropped.
+
+    Args:
+        features: (interval, label) pairs, where intervals have chrom, start, end and strand
+        masks: Mask intervals
+        stranded: If false, masks apply to features on either strand
+
+    Returns: (chrom, start, end, strand, label) for each unmasked fragment of each feature,
+        in the order of features
+    """
+
+    if not masks:
+        return [(iv.chrom, iv.start, iv.end, iv.strand, label) for iv, label in features]
+
+    def keys(iv):
+        if not stranded: return [(iv.chrom, '.')]
+        if iv.strand in ('+', '-'): return [(iv.chrom, iv.strand)]
+        return [(iv.chrom, '+'), (iv.chrom, '-')]
+
+    mask_ivs = defaultdict(list)
+    for iv in masks:
+        for key in keys(iv):
+            mask_ivs[key].append((iv.start, iv.end))
+
+    # Merge each key's masks into disjoint, sorted intervals
+    merged = {}
+    for key, ivs in mask_ivs.items():
+        starts, ends = (np.array(col, dtype=np.int64) for col in zip(*sorted(ivs)))
+        reach = np.maximum.accumulate(ends)
+        new = np.concatenate([[True], starts[1:] > reach[:-1]])
+        merged[key] = starts[new], np.maximum.reduceat(ends, np.flatnonzero(new))
+
+    fragments = []
+    for iv, label in features:
+        key = (iv.chrom, iv.strand if stranded else '.')
+        if key not in merged:
+            fragments.append((iv.chrom, iv.start, iv.end, iv.strand, label))
+            continue
+
+        # The masks overlapping the feature split it into one more fragment than there are masks
+        mask_starts, mask_ends = merged[key]
+        lo = int(np.searchsorted(mask_ends, iv.start, side='right'))
+        hi = int(np.searchsorted(mask_starts, iv.end, side='left'))
+        bounds = [iv.start] + [int(x) for pair in zip(mask_starts[lo:hi], mask_ends[lo:hi]) for x in pair] + [iv.end]
+        for start, end in zip(bounds[::2], bounds[1::2]):
+            start, end = max(start, iv.start), min(end, iv.end)
+            if start < end:
+                fragments.append((iv.chrom, start, end, iv.strand, label))
+
+    return fragments
+
+
+def _ranges(lengths: np.ndarray) -> np.ndarray:
+    """Concatenates np.arange(n) for each n in lengths"""
+
+    total = int(lengths.sum())
+    if total == 0: return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.arange(total, dtype=np.int64) - offsets
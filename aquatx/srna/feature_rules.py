@@ -0,0 +1,259 @@
+"""
+Rule-based selection of the features an alignment is assigned to.
+
+Each row of the features.csv reference sheet is a rule. A rule selects the features of
+its Feature Source whose Identifier attribute includes its Class, and constrains which
+alignments those features may be assigned: the strand of the alignment relative to the
+feature (sense, antisense or both), the read's 5' end nucleotide, and the read's length.
+When an alignment overlaps features selected by several rules, only the features of the
+matching rules with the best (lowest) Hierarchy value are assigned.
+
+Rules are compiled into lookup tables indexed by rule: a hierarchy rank, a bitmask of
+the allowed 5' nucleotides, a bitmask of the allowed strands, and a bitmap of allowed
+lengths. Feature labels are bound to the rules which selected them. A batch of
+alignments is resolved by gathering each alignment's overlapping labels from the numpy
+FeatureIndex, expanding them to their rules, filtering with the tables, and keeping the
+lowest rank per alignment, all with array operations whose cost grows with the number
+of overlaps.
+"""
+
+import csv
+import os
+import re
+
+import numpy as np
+
+from typing import List, NamedTuple, Tuple
+
+from aquatx.srna.feature_index import FeatureRegistry, _ranges
+
+# Strand relations of an alignment to a feature, as bits of a rule's strand mask
+SENSE, ANTISENSE = 1, 2
+STRANDS = {'sense': SENSE, 'antisense': ANTISENSE, 'both': SENSE | ANTISENSE}
+
+# 5' nucleotide bits. U is read as T, and any other character (such as N) has its own bit.
+_NT_BITS = np.full(256, 16, dtype=np.uint8)
+for _bit, _nts in enumerate(['A', 'C', 'G', 'TU']):
+    for _nt in _nts:
+        _NT_BITS[ord(_nt)] = _NT_BITS[ord(_nt.lower())] = 1 << _bit
+ANY_NT = 31
+
+# Column names of the features.csv reference sheet
+COLUMNS = {'identifier': 'Identifier', 'feature_class': 'Class',
+           'strand': 'Strand (sense/antisense/both)', 'source': 'Feature Source',
+           'hierarchy': 'Hierarchy', 'nt': "5' End Nucleotide", 'length': 'Length'}
+
+
+class FeatureRule(NamedTuple):
+    """A row of the features.csv reference sheet"""
+
+    identifier: str
+    feature_class: str
+    strand: str
+    source: str
+    hierarchy: int
+    nt: str
+    length: str
+
+    def matches(self, feature) -> bool:
+        """Returns True if the feature's Identifier attribute lists this rule's Class"""
+
+        values = feature.attr.get(self.identifier)
+        if values is None: return False
+        return self.feature_class in (v.strip() for v in str(values).split(','))
+
+
+def read_rules(features_csv: str) -> List[FeatureRule]:
+    """Reads the rules of a features.csv reference sheet
+
+    Feature Source paths are resolved relative to the sheet, as Configuration does.
+    """
+
+    from_here = os.path.dirname(os.path.abspath(features_csv))
+    rules = []
+    with open(features_csv, 'r', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f, delimiter=','):
+            rule = {key: row[column].strip() for key, column in COLUMNS.items()}
+            rule['source'] = os.path.normpath(os.path.join(from_here, rule['source']))
+            rule['hierarchy'] = int(rule['hierarchy'])
+            rules.append(FeatureRule(**rule))
+
+    return rules
+
+
+def parse_strand(spec: str) -> int:
+    """Converts sense, antisense or both into a strand mask"""
+
+    try:
+        return STRANDS[spec.lower()]
+    except KeyError:
+        raise ValueError(f"Invalid strand: {spec}. Use sense, antisense or both.") from None
+
+
+def parse_nt(spec: str) -> int:
+    """Converts a 5' nucleotide specification such as G, "A,G" or any into a bitmask"""
+
+    if spec.lower() in ('any', 'all', ''): return ANY_NT
+    nts = re.sub(r'[\s,;/]', '', spec).upper()
+    if not nts or any(nt not in 'ACGTUN' for nt in nts):
+        raise ValueError(f"Invalid 5' end nucleotide: {spec}. Use any or nucleotides such as A,G.")
+
+    return int(np.bitwise_or.reduce(_NT_BITS[np.frombuffer(nts.encode(), dtype=np.uint8)]))
+
+
+def parse_length(spec: str) -> List[Tuple[int, int]]:
+    """Converts a length specification such as 22, 16-35, "20,22-24" or any into inclusive ranges
+
+    Returns: A list of (min, max) ranges, or an empty list if any length is allowed
+    """
+
+    if spec.lower() in ('any', 'all', ''): return []
+    ranges = []
+    for part in re.split(r'[,;]', spec):
+        match = re.fullmatch(r'\s*(\d+)\s*(?:-\s*(\d+)\s*)?', part)
+        if match is None:
+            raise ValueError(f"Invalid length: {spec}. Use any, or lengths and ranges such as 20,22-24.")
+        low = int(match.group(1))
+        high = int(match.group(2) or low)
+        if high < low: raise ValueError(f"Invalid length range: {part}")
+        ranges.append((low, high))
+
+    return ranges
+
+
+class FeatureSelector:
+    """Compiled features.csv rules and the feature labels bound to them
+
+    Labels from a FeatureRegistry are bound to rules while the reference arrays are built
+    (see bind()). The lookup tables are compiled the first time a batch is assigned.
+
+    Attributes:
+        rules: The rules, in the order of the reference sheet
+    """
+
+    def __init__(self, rules: List[FeatureRule]):
+        self.rules = rules
+
+        # Invalid rules are reported before any reference files are read
+        for rule in rules:
+            parse_strand(rule.strand)
+            parse_nt(rule.nt)
+            parse_length(rule.length)
+
+        self._bindings = {}     # label -> [rule index]
+        self._tables = None
+
+    def rules_for(self, ref_file: str) -> List[int]:
+        """Returns the indices of the rules whose Feature Source is ref_file
+
+        Sources are matched by file name, so that reference files staged into another
+        directory (as CWL does) still match the sheet's paths.
+        """
+
+        name = os.path.basename(ref_file)
+        return [i for i, rule in enumerate(self.rules) if os.path.basename(rule.source) == name]
+
+    def bind(self, label: int, rule: int) -> None:
+        """Binds a feature label to a rule which selected it"""
+
+        rules = self._bindings.setdefault(label, [])
+        if rule not in rules:
+            rules.append(rule)
+            self._tables = None
+
+    def bindings(self, label: int) -> List[int]:
+        return self._bindings.get(label, [])
+
+    def assign_batch(self, indexes, registry, chroms, strands, starts, ends, reads) -> Tuple[list, list]:
+        """Returns the feature IDs and class IDs assigned to each of a batch of alignments
+
+        Args:
+            indexes: The stranded FeatureIndex of each reference file
+            registry: The FeatureRegistry of the indexes' labels
+            chroms, strands, starts, ends: The alignments' intervals
+            reads: The read sequence of each alignment, in its original orientation
+
+        Returns: A tuple of unique, sorted feature IDs and a tuple of unique, sorted class
+            IDs for each alignment. Both are empty if the alignment isn't assigned.
+        """
+
+        n = len(starts)
+        if n == 0: return [], []
+        rank, nt_mask, strand_mask, length_bitmap, bind_ptr, bind_rules = self._compile(registry)
+
+        first = np.frombuffer(b''.join(read[:1].encode() for read in reads), dtype=np.uint8)
+        nt_bits = _NT_BITS[first]
+        lengths = np.minimum(np.fromiter(map(len, reads), dtype=np.int64, count=n),
+                             length_bitmap.shape[1] - 1)
+        antisense = ['-' if s == '+' else '+' for s in strands]
+
+        rows, labels, relations = [], [], []
+        for index in indexes:
+            for query_strands, relation in [(strands, SENSE), (antisense, ANTISENSE)]:
+                r, l = index.overlaps_batch(chroms, query_strands, starts, ends)
+                rows.append(r)
+                labels.append(l)
+                relations.append(np.full(len(r), relation, dtype=np.uint8))
+
+        rows, labels, relations = np.concatenate(rows), np.concatenate(labels), np.concatenate(relations)
+
+        # Expand each overlapping label into the rules it is bound to, and apply the rules
+        counts = bind_ptr[labels + 1] - bind_ptr[labels]
+        rules = bind_rules[np.repeat(bind_ptr[labels], counts) + _ranges(counts)]
+        rows, labels, relations = (np.repeat(a, counts) for a in (rows, labels, relations))
+        ok = (strand_mask[rules] & relations).astype(bool) & \
+             (nt_mask[rules] & nt_bits[rows]).astype(bool) & \
+             length_bitmap[rules, lengths[rows]]
+        rows, labels, rules = rows[ok], labels[ok], rules[ok]
+
+        # Keep the features of the best ranked rules
+        ranks = rank[rules]
+        best = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(best, rows, ranks)
+        won = ranks == best[rows]
+        rows, labels = rows[won], labels[won]
+
+        return (_group(rows, registry.label_features[labels], n),
+                _group(rows, registry.label_classes[labels], n))
+
+    def _compile(self, registry: FeatureRegistry) -> tuple:
+        """Compiles the rule lookup tables and the label -> rule bindings"""
+
+        n_labels = len(registry.is_mask)
+        if self._tables is not None and len(self._tables[4]) == n_labels + 1: return self._tables
+
+        rank = np.array([rule.hierarchy for rule in self.rules], dtype=np.int64)
+        nt_mask = np.array([parse_nt(rule.nt) for rule in self.rules], dtype=np.uint8)
+        strand_mask = np.array([parse_strand(rule.strand) for rule in self.rules], dtype=np.uint8)
+
+        # Lengths beyond the longest listed length share the final column
+        length_ranges = [parse_length(rule.length) for rule in self.rules]
+        width = max([high for ranges in length_ranges for _, high in ranges], default=0) + 2
+        length_bitmap = np.zeros((len(self.rules), width), dtype=bool)
+        for i, ranges in enumerate(length_ranges):
+            if not ranges: length_bitmap[i] = True
+            for low, high in ranges:
+                length_bitmap[i, low:high + 1] = True
+
+        # Rules bound to each registry label, in compressed sparse row form
+        counts = np.zeros(n_labels, dtype=np.int64)
+        for label, rules in self._bindings.items():
+            counts[label] = len(rules)
+        bind_ptr = np.concatenate([[0], np.cumsum(counts)])
+        bind_rules = np.zeros(bind_ptr[-1], dtype=np.int64)
+        for label, rules in self._bindings.items():
+            bind_rules[bind_ptr[label]:bind_ptr[label + 1]] = rules
+
+        self._tables = rank, nt_mask, strand_mask, length_bitmap, bind_ptr, bind_rules
+        return self._tables
+
+
+def _group(rows: np.ndarray, values: np.ndarray, n: int) -> list:
+    """Returns a tuple of the unique, sorted values of each row in range(n)"""
+
+    if not len(rows): return [()] * n
+    width = int(values.max()) + 1
+    pairs = np.unique(rows * width + values)
+    rows, values = pairs // width, (pairs % width).tolist()
+    bounds = np.searchsorted(rows, np.arange(n + 1)).tolist()
+    return [tuple(values[bounds[i]:bounds[i + 1]]) for i in range(n)]
@@ -9,6 +9,10 @@ one table. The outputs can then be used for further analysis (DEG, plots, etc).
 import argparse
 import pandas as pd
 
+from aquatx.srna.count_matrix import FORMATS, available_formats, merge_count_files, write_count_matrix
+from aquatx.srna.count_stats import ALIGNMENT_STATS, merge_stats_files
+from aquatx.srna.count_store import CountStore
+
 def get_args():
     """
     Get input arguments from the user/command line.
@@ -25,8 +29,40 @@ def get_args():
                         help='associated sample names for input files given')
     parser.add_argument('-m', '--mode', metavar='MODE', required=True,
                         help='mode for merging: counts, stats, or unique seq files')
+    parser.add_argument('-e', '--engine', choices=['pandas', 'fused'], default='pandas',
+                        help='the engine for merging counts. The fused engine reads count files '
+                             'in parallel into one float64 matrix over the union of their '
+                             'features, and writes it without intermediate data frames.')
+    parser.add_argument('-f', '--format', choices=list(FORMATS), default='csv',
+                        help='the format of merged counts: csv, parquet (requires pyarrow), '
+                             'hdf5 (requires h5py), or the sparse formats npz (compressed sparse '
+                             'rows with feature and sample names) and mtx (Matrix Market, with '
+                             '{name}_features.txt and {name}_samples.txt). Formats other than '
+                             'csv require --engine fused.')
+
+    def positive_workers(w):
+        if int(w) >= 1:
+            return int(w)
+        else:
+            raise argparse.ArgumentTypeError("Workers must be >= 1")
+
+    parser.add_argument('-w', '--workers', default=1, type=positive_workers,
+                        help='the number of threads the fused engine reads count files with, '
+                             'and stats files are read with. Threads overlap file reads with '
+                             'parsing, which is not itself parallel')
+    parser.add_argument('-S', '--store', metavar='DIR',
+                        help='merge counts incrementally into a count store directory. Only '
+                             'samples which are new to the store, or whose count files have '
+                             'changed, are read, and the output holds every sample in the '
+                             'store. Requires --engine fused.')
 
     args = parser.parse_args()
+    if args.format != 'csv' and args.engine != 'fused':
+        parser.error(f"--format {args.format} requires --engine fused")
+    if args.store is not None and (args.engine != 'fused' or args.mode != 'counts'):
+        parser.error('--store requires --engine fused and --mode counts')
+    if args.format not in available_formats():
+        parser.error(f"--format {args.format} requires {'pyarrow' if args.format == 'parquet' else 'h5py'}")
 
     return args
 
@@ -59,44 +95,53 @@ def merge_counts(counts_files, samples):
 
     return count_df
 
-def merge_stats(stats_files, samples):
+def merge_stats(stats_files, samples, workers=1):
     """
     Takes in a list of stats files and merges them together into one
     summary statistics table for the entire run.
 
+    Stats files are read in parallel into one matrix over the union of
+    their statistics, so a statistic missing from some samples is 0 for
+    them rather than dropped. JSON and tab separated stats files can be
+    mixed (see count_stats.read_stats()).
+
     Inputs:
         stats_files: A list of files to merge
         samples: Sample names, ordered the same as stats_files
+        workers: The number of threads to read files with
 
     Outputs:
         align_df: Overall alignment statistics data frame
-        feature_df: Feature counting statistics data frame
+        feature_df: Feature counting statistics data frame, with every other statistic
+        rate_df: Derived rates data frame, such as the multi-mapping and ambiguity rates
     """
-    # Define the stats we want
-    align_stats = ['_unique_sequences_aligned', '_aligned_reads',
-                   '_aligned_reads_multi_mapping', '_aligned_reads_unique_mapping']
-    feature_stats = ['_no_feature', '_ambiguous_alignments_classes',
-                     '_ambiguous_reads_classes', '_ambiguous_alignments_features',
-                     '_ambiguous_reads_features', '_alignments_unique_features',
-                     '_reads_unique_features']
-
-    # Create the first dataframe to build on
-    temp_stats = pd.read_csv(stats_files[0], sep='\t', header=None, skiprows=1, index_col=0)
+    stats, rates = merge_stats_files(stats_files, samples, workers)
+    stat_df = pd.DataFrame(stats.values, index=stats.keys, columns=stats.samples)
 
-    # Create an empty data frame based on input dimensions to fill in
-    stat_df = pd.DataFrame(index=temp_stats.index, columns=samples)
-    stat_df.loc[:, samples[0]] = temp_stats.values
+    align_df = stat_df.loc[stat_df.index.isin(ALIGNMENT_STATS)]
+    feature_df = stat_df.loc[~stat_df.index.isin(ALIGNMENT_STATS)]
+    rate_df = pd.DataFrame(rates.values, index=rates.keys, columns=rates.samples)
 
-    count = 1
-    for sf in stats_files[1:]:
-        temp_stats = pd.read_csv(sf, sep='\t', header=None, skiprows=1, index_col=0).reindex(stat_df.index)
-        stat_df.loc[:, samples[count]] = temp_stats.values
-        count += 1
+    return align_df, feature_df, rate_df
 
-    align_df = stat_df.loc[stat_df.index.isin(align_stats)]
-    feature_df = stat_df.loc[stat_df.index.isin(feature_stats)]
+def write_stats_tables(align_df, feature_df, rate_df, output_file):
+    """
+    Writes the tables of merge_stats() to one tab separated file, separated
+    by blank lines.
 
-    return align_df, feature_df
+    Inputs:
+        align_df, feature_df, rate_df: The data frames returned by merge_stats()
+        output_file: The file to write
+    """
+    align_df.index.name = 'Alignment Statistics'
+    align_df.to_csv(output_file, header=True, sep='\t')
+    with open(output_file, 'a') as stat_out:
+        stat_out.write('\n')
+        feature_df.index.name = 'Feature Statistics'
+        feature_df.to_csv(stat_out, header=True, sep='\t')
+        stat_out.write('\n')
+        rate_df.index.name = 'Derived Rates'
+        rate_df.to_csv(stat_out, header=True, sep='\t')
 
 def main():
     """ Main routine """
@@ -104,18 +149,21 @@ def main():
     args = get_args()
 
     # Step 2: Determine the merge mode
-    if args.mode == 'counts':
+    if args.mode == 'counts' and args.store is not None:
+        store = CountStore(args.store)
+        store.add(args.input_files, args.sample_names, args.workers)
+        write_count_matrix(store.read(), args.output_file, args.format)
+
+    elif args.mode == 'counts' and args.engine == 'fused':
+        count_matrix = merge_count_files(args.input_files, args.sample_names, args.workers)
+        write_count_matrix(count_matrix, args.output_file, args.format)
+
+    elif args.mode == 'counts':
         count_df = merge_counts(args.input_files, args.sample_names)
         count_df.to_csv(args.output_file)
 
     elif args.mode == 'stats':
-        align_stat, feat_stat = merge_stats(args.input_files, args.sample_names)
-        align_stat.index.name = 'Alignment Statistics'
-        align_stat.to_csv(args.output_file, header=True, sep='\t')
-        with open(args.output_file, 'a') as stat_out:
-            stat_out.write('\n')
-            feat_stat.index.name = 'Feature Statistics'
-            feat_stat.to_csv(stat_out, header=True, sep='\t')
+        write_stats_tables(*merge_stats(args.input_files, args.sample_names, args.workers), args.output_file)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,413 @@
+"""
+An in-process runner for the end-to-end workflow.
+
+The CWL workflow runs every step as a separate command, so each step starts a new
+interpreter which imports pandas, numpy and HTSeq again, and cwltool copies each
+step's outputs between directories. The native runner instead runs the collapse,
+count and merge stages in this interpreter. Only fastp, bowtie (with samtools, for
+bam outputs) and the R DESeq2 script run as subprocesses.
+
+Stages share data in memory where they can: the reference features are indexed once
+and shared by every sample's count stage, and the merged count matrix is built from
+the feature count arrays of each sample rather than by reading their files again.
+Outputs are written to the run directory under the same names as the workflow's, and
+the wall time of each stage is reported per sample.
+
+Samples are run concurrently by the scheduler, within the CPU and memory budgets of
+the run config. Each stage reserves the run's threads and the memory it declares, so
+one sample's fastp can run alongside another sample's bowtie. In-process stages share
+this interpreter, so they run their work in worker processes when threads > 1, which
+are started by a forkserver rather than forked from the scheduler's threads.
+
+Each per-sample stage's outputs are stored in a content-addressed StageCache, keyed by
+the stage's inputs and parameters and by the versions of aquatx and of the tools it
+runs, so rerunning or resuming a run skips the stages
+whose inputs haven't changed. The merge and DESeq2 stages always run.
+
+The runner reads the processed run configuration, so its options are the workflow's
+inputs, with the same defaults as the CWL tools.
+"""
+
+import functools
+import os
+import subprocess
+import time
+
+import numpy as np
+import HTSeq
+
+from contextlib import contextmanager
+from typing import Callable, List, Tuple
+
+from aquatx import __version__
+from aquatx.srna.Configuration import ConfigBase
+from aquatx.srna.aln_table import FORMATS, AlnTableWriter
+from aquatx.srna.collapser import seq2fasta, seq_counter
+from aquatx.srna.count_matrix import CountMatrix, read_counts, write_count_matrix
+from aquatx.srna.counter import ASSIGN_CACHE_SIZE, create_ref_dict, tally_feature_counts, write_counts
+from aquatx.srna.feature_rules import FeatureSelector, read_rules
+from aquatx.srna.merge_samples import merge_stats, write_stats_tables
+from aquatx.srna.scheduler import ResourcePool, Resources, Stage, run_pipelines
+from aquatx.srna.spill_table import parse_size
+from aquatx.srna.stage_cache import StageCache, default_cache_dir
+
+# Command line options of fastp and bowtie, as (workflow input, option, CWL default)
+FASTP_OPTIONS = [
+    ('fp_phred64', '--phred64', None),
+    ('compression', '--compression', None),
+    ('dont_overwrite', '--dont_overwrite', None),
+    ('disable_adapter_trimming', '--disable_adapter_trimming', None),
+    ('adapter_sequence', '--adapter_sequence', None),
+    ('trim_poly_x', '--trim_poly_x', None),
+    ('poly_x_min_len', '--poly_x_min_len', None),
+    ('disable_quality_filtering', '--disable_quality_filtering', None),
+    ('qualified_quality_phred', '--qualified_quality_phred', 30),
+    ('unqualified_percent_limit', '--unqualified_percent_limit', 0),
+    ('n_base_limit', '--n_base_limit', 1),
+    ('disable_length_filtering', '--disable_length_filtering', None),
+    ('length_required', '--length_required', 15),
+    ('length_limit', '--length_limit', 30),
+    ('overrepresentation_analysis', '--overrepresentation_analysis', None),
+    ('overrepresentation_sampling', '--overrepresentation_sampling', None),
+    ('threads', '--thread', 2),
+]
+
+BOWTIE_OPTIONS = [
+    ('fastq', '-q', None),
+    ('fasta', '-f', True),
+    ('trim5', '--trim5', None),
+    ('trim3', '--trim3', None),
+    ('bt_phred64', '--phred64-quals', None),
+    ('solexa', '--solexa-quals', None),
+    ('solexa13', '--solexa1.3-quals', None),
+    ('end_to_end', '-v', 0),
+    ('nofw', '--nofw', None),
+    ('k_aln', '-k', None),
+    ('all_aln', '--all', True),
+    ('time', '-t', True),
+    ('un', '--un', None),
+    ('no_unal', '--no-unal', True),
+    ('sam', '--sam', True),
+    ('threads', '--threads', None),
+    ('shared_mem', '--shmem', None),
+    ('seed', '--seed', None),
+]
+
+# The outputs of the count stage, by suffix of the sample's prefix. The feature counts are first.
+COUNT_OUTPUTS = ['_out_feature_counts.txt', '_out_class_counts.csv', '_out_nt_len_dist.csv',
+                 '_stats.txt', '_stats.json']
+
+# The memory each per-sample stage declares it needs
+STAGE_MEMORY = {'fastp': 1 << 30, 'collapse': 4 << 30, 'bowtie': 1 << 30, 'count': 2 << 30}
+
+
+class StageTimer:
+    """Records the wall time of each stage of a run
+
+    Attributes:
+        times: (stage, sample, seconds) for each stage, in the order they finished
+    """
+
+    def __init__(self):
+        self.times = []
+
+    @contextmanager
+    def __call__(self, stage: str, sample: str = ''):
+        """Times the stage run in the with block. Stages may be timed from several threads."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times.append((stage, sample, time.perf_counter() - start))
+
+    def summary(self) -> str:
+        """Returns a table of each stage's time, then the total time of each stage"""
+
+        totals = {}
+        for stage, _, seconds in self.times:
+            totals[stage] = totals.get(stage, 0) + seconds
+
+        lines = [f"{stage:<12}{sample:<32}{seconds:>10.2f}s" for stage, sample, seconds in self.times]
+        lines += [f"{stage:<12}{'(total)':<32}{seconds:>10.2f}s" for stage, seconds in totals.items()]
+        return '\n'.join(lines)
+
+    def write(self, path: str) -> None:
+        """Writes the stage times as CSV"""
+
+        with open(path, 'w') as f:
+            f.write('stage,sample,seconds\n')
+            f.writelines(f"{stage},{sample},{seconds:.3f}\n" for stage, sample, seconds in self.times)
+
+
+def options(config: ConfigBase, spec: List[Tuple[str, str, object]]) -> List[str]:
+    """Returns the command line options of spec for the config's values
+
+    Options without a value in the config take their CWL default. Flags are given if
+    their value is True, and options are skipped if their value is None or False.
+    """
+
+    args = []
+    for key, option, default in spec:
+        value = config.get(key)
+        if value is None: value = default
+        if value is None or value is False: continue
+        args += [option] if value is True else [option, str(value)]
+
+    return args
+
+
+def fastp_command(config: ConfigBase, i: int) -> List[str]:
+    """Returns the fastp command for the i-th sample of the config"""
+
+    return ['fastp', *options(config, FASTP_OPTIONS),
+            '--in1', _path(config.get('in_fq')[i]),
+            '--out1', config.get('out_fq')[i],
+            '--json', config.get('json')[i],
+            '--html', config.get('html')[i],
+            '--report_title', config.get('report_title')[i]]
+
+
+def bowtie_command(config: ConfigBase, i: int, reads: str) -> List[str]:
+    """Returns the bowtie command for aligning the i-th sample's collapsed reads
+
+    Alignments are written to the sample's outfile, or to stdout if the config asks for
+    bam outputs, as bowtie can't write them itself.
+    """
+
+    # The config's ebwt is the index's file name, as CWL stages the index files
+    index = _path(config.get('bt_index_files')[0])[:-len('.1.ebwt')]
+    sample = ConfigBase(dict(config.config, un=config.get('un')[i] if config.get('un') else None))
+    return ['bowtie', *options(sample, BOWTIE_OPTIONS),
+            index, reads, '-' if config.get('bam') else config.get('outfile')[i]]
+
+
+def stage_resources(config: ConfigBase, feature_index_size: int = 0) -> dict:
+    """Returns the Resources each per-sample stage declares
+
+    Every stage uses the run's threads. Stages declare the memory of STAGE_MEMORY, except
+    collapse, which declares the config's max_memory if it is set. Bowtie also declares the
+    size of the index it loads, and count declares the size of the feature index once for
+    each of its worker processes.
+    """
+
+    threads = config.get('threads') or 1
+    index_size = sum(os.path.getsize(_path(f)) for f in config.get('bt_index_files') or []
+                     if os.path.isfile(_path(f)))
+    memory = dict(STAGE_MEMORY)
+    if config.get('max_memory'): memory['collapse'] = parse_size(config.get('max_memory'))
+    memory['bowtie'] += index_size
+    memory['count'] += threads * feature_index_size
+    return {stage: Resources(threads, size) for stage, size in memory.items()}
+
+
+def resource_pool(config: ConfigBase) -> ResourcePool:
+    """Returns a ResourcePool of the config's cpu_budget and memory_budget
+
+    Without a cpu_budget, every CPU is used, and without a memory_budget memory isn't limited.
+    """
+
+    cpus = config.get('cpu_budget') or os.cpu_count() or 1
+    memory = config.get('memory_budget')
+    return ResourcePool(int(cpus), parse_size(memory) if memory else None)
+
+
+def run_native(config: ConfigBase) -> StageTimer:
+    """Runs the workflow of a processed Configuration in this interpreter
+
+    Samples run through the fastp, collapse, bowtie and count stages concurrently,
+    within the config's CPU and memory budgets (see scheduler.run_pipelines()).
+
+    Args:
+        config: The processed Configuration of the run
+
+    Returns: The StageTimer of the run's stages
+    """
+
+    run_dir = os.path.abspath(config.create_run_directory())
+    threads = config.get('threads') or 1
+    samples = config.get('out_prefix')
+    cache = StageCache(default_cache_dir(run_dir, config.get('cache_dir')))
+    timer = StageTimer()
+
+    def out(key, i):
+        return os.path.join(run_dir, config.get(key)[i])
+
+    # Reference features are indexed once for every sample
+    with timer('reference'):
+        features_sheet = config.get('features_sheet')
+        if features_sheet and config.get('antisense'):
+            raise ValueError("antisense can't be combined with feature_rules, whose rules name the strands to count.")
+        selector = FeatureSelector(read_rules(_path(features_sheet))) if features_sheet else None
+        ref_files = list(dict.fromkeys(_path(ref) for ref in config.get('ref_annotations')))
+        masks = [_path(m) for m in config.get('mask_annotations') or []]
+        ref_array_dict, registry = create_ref_dict(ref_files, config.get('antisense'), masks or None, 'numpy',
+                                                   os.path.join(cache.path, 'feature_index'), selector)
+        # Samples' count stages share the registry, so classes they register must exist first
+        registry.class_id('ambiguous')
+
+    index_paths = {index.path for index in ref_array_dict.values()}
+    needs = stage_resources(config, sum(_dir_size(path) for path in index_paths))
+
+    feature_counts = [None] * len(samples)
+    stats_files = [os.path.join(run_dir, sample) + '_stats.json' for sample in samples]
+    collapsed = [config.get('uniq_seq_prefix')[i] + '_collapsed.fa' + ('.gz' if config.get('compress') else '')
+                 for i in range(len(samples))]
+
+    # Thread counts don't change stage outputs, so they aren't part of the cache keys
+    fastp_options = [spec for spec in FASTP_OPTIONS if spec[0] != 'threads']
+    bowtie_options = [spec for spec in BOWTIE_OPTIONS if spec[0] != 'threads']
+
+    def fastp(i):
+        _cached(cache, 'fastp', [_path(config.get('in_fq')[i])],
+                {'options': options(config, fastp_options), 'report_title': config.get('report_title')[i]},
+                [out('out_fq', i), out('json', i), out('html', i)],
+                lambda: subprocess.run(fastp_command(config, i), cwd=run_dir, check=True), ['fastp'])
+
+    def collapse(i):
+        def run():
+            # The collapse stage's declared memory bounds its count table, which spills beyond it
+            spill_dir = config.get('spill_dir')
+            seqs = seq_counter(out('out_fq', i), workers=threads, max_memory=needs['collapse'].memory,
+                               spill_dir=_path(spill_dir) if spill_dir else None)
+            seq2fasta(seqs, out('uniq_seq_prefix', i), config.get('threshold') or 0, bool(config.get('compress')))
+
+        collapsed_file = os.path.join(run_dir, collapsed[i])
+        _cached(cache, 'collapse', [out('out_fq', i)],
+                {'threshold': config.get('threshold') or 0, 'compress': bool(config.get('compress'))},
+                [collapsed_file, collapsed_file.replace('_collapsed.fa', '_collapsed_lowcounts.fa')], run)
+
+    def bowtie(i):
+        index_files = [_path(f) for f in config.get('bt_index_files')]
+        _cached(cache, 'bowtie', [os.path.join(run_dir, collapsed[i])] + index_files,
+                {'options': options(config, bowtie_options), 'bam': bool(config.get('bam'))},
+                [out('outfile', i)] + ([out('un', i)] if config.get('un') else []),
+                lambda: _align(config, i, os.path.join(run_dir, collapsed[i]), run_dir),
+                ['bowtie'] + (['samtools'] if config.get('bam') else []))
+
+    def count(i):
+        prefix = os.path.join(run_dir, samples[i])
+        outputs = [prefix + suffix for suffix in COUNT_OUTPUTS]
+        if config.get('intermed_file'):
+            outputs.append(prefix + '_out_aln_table' + FORMATS[config.get('intermed_format') or 'txt'])
+
+        def run():
+            feature_counts[i] = _count(config, out('outfile', i), prefix, ref_array_dict, registry,
+                                       selector, threads)
+
+        params = {key: config.get(key) for key in
+                  ['antisense', 'intermed_file', 'intermed_format', 'assign_cache']}
+        inputs = [out('outfile', i)] + ref_files + masks + ([_path(features_sheet)] if features_sheet else [])
+        if _cached(cache, 'count', inputs, params, outputs, run):
+            feature_counts[i] = read_counts(outputs[0])[1]
+
+    stages = [Stage(name, needs[name], run) for name, run in
+              [('fastp', fastp), ('collapse', collapse), ('bowtie', bowtie), ('count', count)]]
+    run_pipelines(samples, stages, resource_pool(config), timer)
+
+    # Merged counts are built from each sample's count array
+    with timer('merge'):
+        counts_file = os.path.join(run_dir, config.get('output_file_counts'))
+        matrix = np.column_stack(feature_counts) if feature_counts else np.zeros((len(registry.feature_names), 0))
+        write_count_matrix(CountMatrix(list(registry.feature_names), list(samples), matrix), counts_file)
+        write_stats_tables(*merge_stats(stats_files, samples, threads),
+                           os.path.join(run_dir, config.get('output_file_stats')))
+
+    if config.get('use_deseq') is not False:
+        with timer('deseq'):
+            subprocess.run(['aquatx-deseq', '--input-file', counts_file,
+                            '--outfile-prefix', config.get('output_prefix')], cwd=run_dir, check=True)
+
+    print(timer.summary())
+    if cache.hits:
+        print(f"{len(cache.hits)} sample stages were restored from the cache at {cache.path}")
+    timer.write(os.path.join(run_dir, config.get('output_prefix') + '_stage_times.csv'))
+    return timer
+
+
+def _align(config: ConfigBase, i: int, reads: str, run_dir: str) -> None:
+    """Runs bowtie for the i-th sample, piping alignments through samtools for bam outputs"""
+
+    command = bowtie_command(config, i, reads)
+    if not config.get('bam'):
+        subprocess.run(command, cwd=run_dir, check=True)
+        return
+
+    with subprocess.Popen(command, cwd=run_dir, stdout=subprocess.PIPE) as bowtie:
+        samtools = subprocess.run(['samtools', 'view', '-b', '-o', config.get('outfile')[i], '-'],
+                                  cwd=run_dir, stdin=bowtie.stdout)
+        bowtie.stdout.close()
+    if bowtie.returncode or samtools.returncode:
+        raise subprocess.CalledProcessError(bowtie.returncode or samtools.returncode, command)
+
+
+def _cached(cache: StageCache, stage: str, inputs: List[str], params: dict, outputs: List[str],
+            run: Callable[[], None], tools: List[str] = ()) -> bool:
+    """Restores a stage's outputs from the cache, or runs the stage and stores its outputs
+
+    The cache key includes the aquatx version and the --version output of each of the
+    stage's tools, so upgrading either reruns the stage. Outputs are removed before the
+    stage runs, as they may be hard links to cached files which the stage would otherwise
+    overwrite in place.
+
+    Returns: True if the outputs were restored from the cache
+    """
+
+    versions = {'aquatx': __version__, **{tool: tool_version(tool) for tool in tools}}
+    key = cache.key(stage, inputs, dict(params, outputs=[os.path.basename(o) for o in outputs],
+                                        versions=versions))
+    if cache.fetch(key, outputs, stage): return True
+
+    for output in outputs:
+        if os.path.lexists(output): os.remove(output)
+    run()
+    cache.store(key, outputs)
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(command: str) -> str:
+    """Returns the output of a tool's --version, or an empty string if it can't be run"""
+
+    try:
+        result = subprocess.run([command, '--version'], capture_output=True, text=True)
+    except OSError:
+        return ''
+    return (result.stdout + result.stderr).strip()
+
+
+def _count(config: ConfigBase, aln_file: str, out_prefix: str, ref_array_dict, registry, selector, workers) -> np.ndarray:
+    """Counts a sample's alignments with the shared reference arrays, and writes its counts
+
+    Returns: The sample's feature counts, indexed by the registry's feature IDs
+    """
+
+    kwargs = dict(workers=workers, selector=selector, stats_json=out_prefix + '_stats.json',
+                  cache_size=config.get('assign_cache') if config.get('assign_cache') is not None
+                  else ASSIGN_CACHE_SIZE)
+    sam_alignment = HTSeq.SAM_Reader(aln_file)
+    stats_out = out_prefix + '_stats.txt'
+
+    if config.get('intermed_file'):
+        fmt = config.get('intermed_format') or 'txt'
+        with AlnTableWriter(out_prefix + '_out_aln_table' + FORMATS[fmt], registry, fmt) as outfile:
+            class_counts, feat_counts, nt_len_mat = tally_feature_counts(
+                sam_alignment, ref_array_dict, registry, stats_out, write=True, outfile=outfile, **kwargs)
+    else:
+        class_counts, feat_counts, nt_len_mat = tally_feature_counts(
+            sam_alignment, ref_array_dict, registry, stats_out, **kwargs)
+
+    write_counts(out_prefix, registry, class_counts, feat_counts, nt_len_mat)
+    return feat_counts
+
+
+def _dir_size(path: str) -> int:
+    """Returns the total size of the files in a directory"""
+
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def _path(file) -> str:
+    """Returns the absolute path of a CWL File object of the config, or of a path"""
+
+    return os.path.abspath(file['path'] if isinstance(file, dict) else file)
@@ -0,0 +1,167 @@
+"""
+A resource-aware scheduler which runs samples through pipelines of stages concurrently.
+
+Each sample runs through the stages in order on its own thread, so the stages of
+different samples overlap: one sample's fastp can run while another's bowtie does.
+Before a stage starts it reserves the CPUs and memory it declares from a shared
+ResourcePool, and it returns them when it finishes, so the stages running at any
+time never exceed the run's budgets. Stages needing more than a budget are given the
+whole budget, and so run alone.
+
+When resources are released, waiting stages are started in priority order: later
+stages first, so samples already in the pipeline are finished before new ones are
+started, then earlier samples. Smaller stages which fit are started ahead of a
+waiting stage that doesn't.
+
+Stages which start worker processes from a sample's thread use process_context(), as
+forking while other threads hold locks can deadlock the forked children.
+"""
+
+import itertools
+import multiprocessing
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from typing import Callable, List, NamedTuple, Optional
+
+
+class Resources(NamedTuple):
+    """The resources a stage needs while it runs
+
+    Attributes:
+        cpus: The number of CPUs the stage's threads or processes use
+        memory: The number of bytes of memory the stage uses
+    """
+
+    cpus: int
+    memory: int = 0
+
+
+class Stage(NamedTuple):
+    """A stage of a sample's pipeline
+
+    Attributes:
+        name: The stage's name
+        needs: The Resources the stage declares
+        run: Runs the stage for the sample with the given index
+    """
+
+    name: str
+    needs: Resources
+    run: Callable[[int], None]
+
+
+class ResourcePool:
+    """CPU and memory budgets which stages reserve while they run
+
+    Attributes:
+        cpus: The CPU budget
+        memory: The memory budget in bytes, or None if memory isn't limited
+    """
+
+    def __init__(self, cpus: int, memory: Optional[int] = None):
+        if cpus < 1: raise ValueError("The CPU budget must be at least 1.")
+        self.cpus = cpus
+        self.memory = memory
+        self._free_cpus = cpus
+        self._free_memory = memory
+        self._waiting = []  # (priority, ticket, needs), sorted
+        self._tickets = itertools.count()
+        self._changed = threading.Condition()
+
+    def fit(self, needs: Resources) -> Resources:
+        """Returns needs, limited to the budgets"""
+
+        return Resources(min(max(needs.cpus, 1), self.cpus),
+                         needs.memory if self.memory is None else min(needs.memory, self.memory))
+
+    @contextmanager
+    def reserve(self, needs: Resources, priority: tuple = ()):
+        """Waits until needs fit in the free resources, and holds them within the with block
+
+        Args:
+            needs: The resources to reserve. They are first limited to the budgets.
+            priority: Waiting reservations with lower priority values are granted first
+
+        Yields: The reserved Resources
+        """
+
+        needs = self.fit(needs)
+        entry = (priority, next(self._tickets), needs)
+        with self._changed:
+            self._waiting.append(entry)
+            self._waiting.sort()
+            self._changed.wait_for(lambda: self._next() is entry)
+            self._waiting.remove(entry)
+            self._take(needs, -1)
+            # Other waiting reservations may fit in what is left
+            self._changed.notify_all()
+
+        try:
+            yield needs
+        finally:
+            with self._changed:
+                self._take(needs, 1)
+                self._changed.notify_all()
+
+    def _fits(self, needs: Resources) -> bool:
+        return needs.cpus <= self._free_cpus and (self.memory is None or needs.memory <= self._free_memory)
+
+    def _next(self):
+        """Returns the waiting reservation which may start next, if any fits"""
+
+        return next((entry for entry in self._waiting if self._fits(entry[2])), None)
+
+    def _take(self, needs: Resources, sign: int) -> None:
+        self._free_cpus += sign * needs.cpus
+        if self.memory is not None: self._free_memory += sign * needs.memory
+
+
+def process_context():
+    """Returns the multiprocessing context for process pools started by the calling thread
+
+    Forked workers share the parent's memory, such as reference arrays, without pickling
+    it, but are only safe when no other thread is running. Otherwise workers are started
+    by a forkserver, or spawned where there is none.
+    """
+
+    methods = multiprocessing.get_all_start_methods()
+    if 'fork' in methods and threading.active_count() == 1:
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def run_pipelines(samples: List[str], stages: List[Stage], pool: ResourcePool, timer: Callable = None) -> None:
+    """Runs each sample through the stages in order, with samples running concurrently
+
+    If a stage fails, samples which are still running stop before their next stage, and
+    the first failure (in sample order) is raised once all samples have stopped.
+
+    Args:
+        samples: The name of each sample
+        stages: The stages of each sample's pipeline, in order
+        pool: The ResourcePool which stages reserve their declared needs from
+        timer: Called as timer(stage name, sample name) for a context manager which
+            times each stage. Default: None
+    """
+
+    failed = threading.Event()
+
+    def pipeline(i: int) -> None:
+        for s, stage in enumerate(stages):
+            if failed.is_set(): return
+            with pool.reserve(stage.needs, (-s, i)):
+                with (timer(stage.name, samples[i]) if timer else nullcontext()):
+                    try:
+                        stage.run(i)
+                    except BaseException:
+                        failed.set()
+                        raise
+
+    # A sample holds at least one CPU while it runs, so more threads would only wait
+    with ThreadPoolExecutor(max_workers=max(min(len(samples), pool.cpus), 1)) as executor:
+        futures = [executor.submit(pipeline, i) for i in range(len(samples))]
+
+    for future in futures:
+        future.result()
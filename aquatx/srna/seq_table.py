@@ -0,0 +1,294 @@
+"""
+A compact, insertion-ordered sequence count table for collapsing reads.
+
+Sequences of up to 31 nt over the alphabet ACGT are 2-bit packed into a single uint64
+key, with a sentinel bit above the highest base so that sequences of different lengths
+never share a key. Packed keys and counts are held in NumPy arrays indexed by the order
+in which each sequence was first seen. Lookups search sorted runs of the keys: each fold
+adds a run of its new keys, and runs are merged when a run grows as large as the one
+before it, so there are O(log n) runs and each key is copied O(log n) times, rather
+than the whole sorted index being copied on every fold.
+Sequences which can't be packed (longer reads or reads containing N) are kept in a small
+overflow dictionary but share the same ordering. This costs roughly 28 bytes per unique
+sequence compared to well over 100 bytes per entry for a dictionary of Python strings.
+"""
+
+import numpy as np
+
+from itertools import islice
+from typing import Iterable, Iterator, Tuple
+
+try:
+    from _collections import _count_elements  # Load Counter's C helper function if it is available
+except ImportError:
+    from collections import _count_elements   # Slower mapping[elem] = mapping.get(elem,default_val)+1
+
+# The longest sequence that fits in a uint64 key alongside its sentinel bit
+MAX_PACKED_LENGTH = 31
+
+# The number of unique sequences staged in a dictionary before they are folded into the arrays
+FOLD_SIZE = 262144
+
+# The number of sequences packed at a time while folding
+PACK_SIZE = 65536
+
+# Byte -> 2-bit code lookup table. Padding (NUL) maps to 0, anything other than ACGT is invalid.
+_INVALID = 255
+_CODES = np.full(256, _INVALID, dtype=np.uint8)
+_CODES[0] = 0
+for _code, _base in enumerate(b'ACGT'):
+    _CODES[_base] = _code
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def pack_sequences(seqs: list) -> Tuple[np.ndarray, np.ndarray]:
+    """Packs a list of byte sequences into uint64 keys
+
+    Args:
+        seqs: A list of sequences as bytes
+
+    Returns:
+        keys: The packed keys. Sequences which can't be packed are assigned 0.
+        packable: A boolean mask of the sequences which were packed
+    """
+
+    n = len(seqs)
+    if n == 0: return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=n)
+    fixed = np.array(seqs, dtype=f'S{MAX_PACKED_LENGTH}')  # Longer sequences are truncated, then masked
+    codes = _CODES[fixed.view(np.uint8).reshape(n, MAX_PACKED_LENGTH)]
+
+    invalid = codes == _INVALID
+    packable = (lengths <= MAX_PACKED_LENGTH) & ~invalid.any(axis=1)
+    codes[invalid] = 0
+
+    keys = np.zeros(n, dtype=np.uint64)
+    for col in range(MAX_PACKED_LENGTH):
+        keys = (keys << np.uint64(2)) | codes[:, col]
+
+    # Padding occupies the low bits of shorter sequences. Shift it out and set the sentinel bit.
+    short = np.minimum(lengths, MAX_PACKED_LENGTH).astype(np.uint64)
+    keys >>= np.uint64(2) * (np.uint64(MAX_PACKED_LENGTH) - short)
+    keys |= np.uint64(1) << (np.uint64(2) * short)
+    keys[~packable] = 0
+
+    return keys, packable
+
+
+def unpack_sequences(keys: np.ndarray) -> list:
+    """Unpacks uint64 keys produced by pack_sequences() into a list of byte sequences"""
+
+    n = len(keys)
+    if n == 0: return []
+
+    lengths = np.zeros(n, dtype=np.int64)
+    for length in range(1, MAX_PACKED_LENGTH + 1):
+        lengths += (keys >> np.uint64(2 * length)) > 0
+
+    fixed = np.zeros((n, MAX_PACKED_LENGTH), dtype=np.uint8)
+    for col in range(MAX_PACKED_LENGTH):
+        in_seq = col < lengths
+        shift = (np.uint64(2) * np.maximum(lengths - 1 - col, 0)).astype(np.uint64)
+        fixed[:, col] = np.where(in_seq, _BASES[(keys >> shift) & np.uint64(3)], 0)
+
+    # Trailing NUL padding is dropped when fixed-width byte strings are converted to bytes
+    return fixed.view(f'S{MAX_PACKED_LENGTH}').ravel().tolist()
+
+
+class SeqCountTable:
+    """An insertion-ordered table of sequence counts backed by NumPy arrays
+
+    Sequences are counted into a staging dictionary, which is folded into the arrays each
+    time it grows to fold_size unique sequences. Folding preserves the order in which
+    sequences were first seen, so iterating the table yields the same order as an
+    OrderedDict would. Blank sequences are never stored.
+
+    Attributes:
+        fold_size: The number of unique sequences staged before folding
+    """
+
+    def __init__(self, fold_size: int = FOLD_SIZE):
+        self.fold_size = fold_size
+
+        self._size = 0
+        self._packed = np.zeros(1024, dtype=np.uint64)  # Packed key by ID, 0 for overflow sequences
+        self._counts = np.zeros(1024, dtype=np.uint64)  # Count by ID
+        self._runs = []           # (sorted keys, their IDs), each at least twice the size of the next
+        self._overflow = {}       # Sequence -> ID for sequences which can't be packed
+        self._overflow_seqs = {}  # ID -> sequence
+        self._staging = {}
+
+    def count(self, seqs: Iterable[bytes]) -> None:
+        """Counts each occurrence of each sequence in seqs"""
+
+        if isinstance(seqs, list):
+            _count_elements(self._staging, seqs)
+            if len(self._staging) >= self.fold_size: self.flush()
+            return
+
+        it = iter(seqs)
+        while True:
+            chunk = list(islice(it, self.fold_size))
+            if not chunk: break
+            self.count(chunk)
+
+    def add_counts(self, counts: dict) -> np.ndarray:
+        """Adds the counts of a dictionary whose keys are ordered by first occurrence
+
+        Returns: The ID of each non-blank sequence in counts, in the dictionary's order
+        """
+
+        self.flush()
+        return self._fold(counts)
+
+    def flush(self) -> None:
+        """Folds staged counts into the arrays"""
+
+        if self._staging:
+            staged, self._staging = self._staging, {}
+            self._fold(staged)
+
+    def items(self, batch_size: int = 100000) -> Iterator[Tuple[bytes, int]]:
+        """Yields (sequence, count) pairs in first-seen order"""
+
+        for seqs, counts in self.iter_batches(batch_size):
+            yield from zip(seqs, counts.tolist())
+
+    def keys(self) -> Iterator[bytes]:
+        for seq, _ in self.items():
+            yield seq
+
+    def values(self) -> Iterator[int]:
+        self.flush()
+        yield from self._counts[:self._size].tolist()
+
+    def iter_batches(self, batch_size: int = 100000) -> Iterator[Tuple[list, np.ndarray]]:
+        """Yields (sequences, counts) for consecutive batches of IDs in first-seen order
+
+        Sequences are returned as bytes and counts as a uint64 array.
+        """
+
+        self.flush()
+        for start in range(0, self._size, batch_size):
+            end = min(start + batch_size, self._size)
+            packed = self._packed[start:end]
+            seqs = unpack_sequences(packed)
+            for offset in np.flatnonzero(packed == 0):
+                seqs[offset] = self._overflow_seqs[start + int(offset)]
+            yield seqs, self._counts[start:end]
+
+    def get(self, seq: bytes, default=None):
+        seq_id = self._find(seq)
+        return default if seq_id is None else int(self._counts[seq_id])
+
+    def __getitem__(self, seq: bytes) -> int:
+        count = self.get(seq)
+        if count is None: raise KeyError(seq)
+        return count
+
+    def __contains__(self, seq: bytes) -> bool:
+        return self._find(seq) is not None
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self.keys()
+
+    def __len__(self) -> int:
+        self.flush()
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        """The approximate memory used by the table's arrays, excluding overflow sequences"""
+
+        return sum(a.nbytes for a in (self._packed, self._counts)) + \
+            sum(keys.nbytes + ids.nbytes for keys, ids in self._runs)
+
+    def _find(self, seq: bytes):
+        """Returns the ID of a sequence, or None if it isn't in the table"""
+
+        self.flush()
+        if isinstance(seq, str): seq = seq.encode('utf-8')
+        keys, packable = pack_sequences([seq])
+        if not packable[0]: return self._overflow.get(seq)
+
+        seq_id = self._lookup(keys)[0]
+        return None if seq_id < 0 else int(seq_id)
+
+    def _fold(self, counts: dict) -> np.ndarray:
+        """Adds a dictionary of counts to the arrays, assigning new IDs in the dictionary's order"""
+
+        seqs = [seq.encode('utf-8') if isinstance(seq, str) else seq for seq in counts if seq]
+        if not seqs: return np.zeros(0, dtype=np.int64)
+        n = len(seqs)
+        block_counts = np.fromiter((counts[seq] for seq in counts if seq), dtype=np.uint64, count=n)
+
+        # Pack in slices to bound the size of pack_sequences()' temporary arrays
+        keys, packable = np.zeros(n, dtype=np.uint64), np.zeros(n, dtype=bool)
+        for start in range(0, n, PACK_SIZE):
+            keys[start:start + PACK_SIZE], packable[start:start + PACK_SIZE] = \
+                pack_sequences(seqs[start:start + PACK_SIZE])
+
+        # Look up IDs of sequences that are already in the table
+        ids = self._lookup(keys)
+        ids[~packable] = -1
+        for i in np.flatnonzero(~packable):
+            ids[i] = self._overflow.get(seqs[i], -1)
+
+        # Assign IDs to new sequences in first-seen order
+        new = ids < 0
+        n_new = int(new.sum())
+        ids[new] = np.arange(self._size, self._size + n_new)
+        self._reserve(self._size + n_new)
+        self._size += n_new
+
+        self._packed[ids[new]] = keys[new]
+        self._counts[ids] += block_counts
+        for i in np.flatnonzero(new & ~packable):
+            self._overflow[seqs[i]] = int(ids[i])
+            self._overflow_seqs[int(ids[i])] = seqs[i]
+
+        # New packed keys are added to the sorted index as a run
+        new_packed = new & packable
+        if new_packed.any():
+            new_keys, new_ids = keys[new_packed], ids[new_packed].astype(np.uint32)
+            order = np.argsort(new_keys)
+            self._add_run(new_keys[order], new_ids[order])
+
+        return ids
+
+    def _lookup(self, keys: np.ndarray) -> np.ndarray:
+        """Returns the ID of each packed key, or -1 for keys that aren't in the sorted runs"""
+
+        ids = np.full(len(keys), -1, dtype=np.int64)
+        for run_keys, run_ids in self._runs:
+            pos = np.minimum(np.searchsorted(run_keys, keys), len(run_keys) - 1)
+            found = run_keys[pos] == keys
+            ids[found] = run_ids[pos[found]]
+
+        return ids
+
+    def _add_run(self, keys: np.ndarray, ids: np.ndarray) -> None:
+        """Adds a sorted run of new keys, merging runs until each is at least twice the size of the next"""
+
+        self._runs.append((keys, ids))
+        while len(self._runs) > 1 and len(self._runs[-2][0]) < 2 * len(self._runs[-1][0]):
+            (keys_a, ids_a), (keys_b, ids_b) = self._runs[-2:]
+            # Each key of the smaller run lands after the keys of the larger run that precede it
+            at = np.searchsorted(keys_a, keys_b) + np.arange(len(keys_b))
+            from_b = np.zeros(len(keys_a) + len(keys_b), dtype=bool)
+            from_b[at] = True
+            keys, ids = np.empty(len(from_b), dtype=np.uint64), np.empty(len(from_b), dtype=np.uint32)
+            keys[at], ids[at] = keys_b, ids_b
+            keys[~from_b], ids[~from_b] = keys_a, ids_a
+            self._runs[-2:] = [(keys, ids)]
+
+    def _reserve(self, size: int) -> None:
+        """Grows the ID-indexed arrays to hold at least size entries"""
+
+        capacity = len(self._counts)
+        if size <= capacity: return
+        while capacity < size: capacity *= 2
+
+        self._packed = np.concatenate([self._packed, np.zeros(capacity - len(self._packed), dtype=np.uint64)])
+        self._counts = np.concatenate([self._counts, np.zeros(capacity - len(self._counts), dtype=np.uint64)])
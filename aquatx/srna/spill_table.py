@@ -0,0 +1,209 @@
+"""
+A memory-bounded sequence count table which spills to disk.
+
+Sequences are counted in an in-memory dictionary until it reaches its memory budget.
+The dictionary is then spilled: each (sequence, count) entry is written to one of a
+fixed number of partition files chosen by hashing the sequence, along with the entry's
+first-occurrence key. Keys are assigned from a running offset in the dictionary's
+insertion order, so a smaller key always means the sequence was seen earlier in the
+input. When the table is read, each partition is collapsed on its own (summing counts
+and keeping the smallest key of each sequence), sorted by key, and the sorted
+partitions are merged. This yields the same sequences, counts, and first-seen order
+as counting the whole input in a single OrderedDict.
+"""
+
+import heapq
+import os
+import re
+import shutil
+import tempfile
+import weakref
+
+from itertools import islice
+from typing import Iterable, Iterator, Tuple
+
+try:
+    from _collections import _count_elements  # Load Counter's C helper function if it is available
+except ImportError:
+    from collections import _count_elements   # Slower mapping[elem] = mapping.get(elem,default_val)+1
+
+# The number of partition files that spilled entries are distributed across
+PARTITIONS = 64
+
+# The approximate size of a dictionary entry, excluding the sequence's bytes
+ENTRY_OVERHEAD = 112
+
+# The number of sequences counted at a time from non-list iterables
+COUNT_BATCH_SIZE = 100000
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(size: str) -> int:
+    """Converts a human readable size such as 512M or 4G into bytes"""
+
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: {size}. Use a number with an optional K, M, G or T suffix.")
+
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+class SpillingCountTable:
+    """An insertion-ordered sequence count table with a memory budget
+
+    The table supports the counting interface used by the collapser's parsing engines,
+    and items() yields (sequence, count) pairs in first-seen order. If the budget is
+    never reached, nothing is written to disk. Spill files are removed when the table
+    is closed or garbage collected.
+
+    Attributes:
+        max_memory: The approximate number of bytes the in-memory dictionary may use
+        partitions: The number of partition files to spill to
+        spills: The number of times the in-memory dictionary has been spilled
+    """
+
+    def __init__(self, max_memory: int, partitions: int = PARTITIONS, spill_dir: str = None):
+        self.max_memory = max_memory
+        self.partitions = partitions
+        self.spills = 0
+
+        self._spill_dir = spill_dir
+        self._tmp = None
+        self._table = {}
+        self._offset = 0        # The first-occurrence key of the next spilled entry
+        self._max_entries = None
+        self._sorted = None     # Paths of the collapsed, key-sorted partitions
+        self._cleanup = None
+
+    def count(self, seqs: Iterable[bytes]) -> None:
+        """Counts each occurrence of each sequence in seqs"""
+
+        if not isinstance(seqs, list):
+            it = iter(seqs)
+            while True:
+                chunk = list(islice(it, COUNT_BATCH_SIZE))
+                if not chunk: break
+                self.count(chunk)
+            return
+
+        if not seqs: return
+        if self._max_entries is None: self._set_budget(seqs)
+
+        # Each sequence adds at most one entry, so count in slices that can't overfill the table
+        start = 0
+        while start < len(seqs):
+            room = max(self._max_entries - len(self._table), 1)
+            _count_elements(self._table, seqs[start:start + room])
+            start += room
+            if len(self._table) >= self._max_entries: self._spill()
+
+    def add_counts(self, counts: dict) -> None:
+        """Adds the counts of a dictionary whose keys are ordered by first occurrence"""
+
+        if not counts: return
+        if self._max_entries is None: self._set_budget(list(islice(counts, COUNT_BATCH_SIZE)))
+        # The table is spilled as soon as it fills, so large chunks don't overfill it
+        table = self._table
+        for seq, count in counts.items():
+            table[seq] = table.get(seq, 0) + count
+            if len(table) >= self._max_entries:
+                self._spill()
+                table = self._table
+
+    def flush(self) -> None:
+        """Drops blank sequences, which are counted from blank lines"""
+
+        self._table.pop(b"", None)
+        self._table.pop("", None)
+
+    def items(self) -> Iterator[Tuple[bytes, int]]:
+        """Yields (sequence, count) pairs in first-seen order. May be called more than once."""
+
+        self.flush()
+        if not self.spills:
+            yield from self._table.items()
+            return
+
+        if self._sorted is None:
+            self._spill()
+            self._sorted = [self._collapse_partition(p) for p in range(self.partitions)]
+
+        files = [open(path, 'rb') for path in self._sorted]
+        try:
+            for _, count, seq in heapq.merge(*map(_read_records, files)):
+                yield seq, count
+        finally:
+            for f in files: f.close()
+
+    def values(self) -> Iterator[int]:
+        for _, count in self.items():
+            yield count
+
+    def close(self) -> None:
+        """Removes the spill files"""
+
+        if self._cleanup is not None: self._cleanup()
+
+    def _set_budget(self, sample: list) -> None:
+        """Estimates how many entries fit in the budget from the length of sampled sequences"""
+
+        mean_length = sum(map(len, sample)) / len(sample)
+        self._max_entries = max(int(self.max_memory / (ENTRY_OVERHEAD + mean_length)), 1)
+
+    def _spill(self) -> None:
+        """Writes the in-memory entries to the partition files and empties the table"""
+
+        self.flush()
+        if not self._table: return
+        if self._tmp is None:
+            self._tmp = tempfile.mkdtemp(prefix='aquatx_collapse_', dir=self._spill_dir)
+            self._cleanup = weakref.finalize(self, shutil.rmtree, self._tmp, True)
+
+        buffers = [[] for _ in range(self.partitions)]
+        for key, (seq, count) in enumerate(self._table.items(), self._offset):
+            if isinstance(seq, str): seq = seq.encode('utf-8')
+            buffers[hash(seq) % self.partitions].append(b"%d\t%d\t%s\n" % (key, count, seq))
+
+        for p, records in enumerate(buffers):
+            if not records: continue
+            with open(self._partition_path(p), 'ab') as f:
+                f.write(b''.join(records))
+
+        self._offset += len(self._table)
+        self._table = {}
+        self.spills += 1
+
+    def _collapse_partition(self, p: int) -> str:
+        """Sums the counts of a partition's sequences and writes them sorted by first occurrence"""
+
+        entries = {}
+        path = self._partition_path(p)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for key, count, seq in _read_records(f):
+                    entry = entries.get(seq)
+                    if entry is None:
+                        entries[seq] = [key, count]
+                    else:
+                        # Keys are written in increasing order, so the first key is the smallest
+                        entry[1] += count
+            os.remove(path)
+
+        sorted_path = path + '.sorted'
+        with open(sorted_path, 'wb') as f:
+            f.write(b''.join(b"%d\t%d\t%s\n" % (key, count, seq)
+                             for seq, (key, count) in sorted(entries.items(), key=lambda e: e[1][0])))
+
+        return sorted_path
+
+    def _partition_path(self, p: int) -> str:
+        return os.path.join(self._tmp, f"partition_{p}")
+
+
+def _read_records(f) -> Iterator[Tuple[int, int, bytes]]:
+    """Yields (key, count, sequence) records from a spill file"""
+
+    for line in f:
+        key, count, seq = line.rstrip(b'\n').split(b'\t')
+        yield int(key), int(count), seq
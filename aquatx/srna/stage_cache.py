@@ -0,0 +1,139 @@
+"""
+A content-addressed cache of pipeline stage outputs.
+
+A stage's results are keyed by a hash of the stage's name, its parameters, and the
+contents of its input files, so a rerun of a stage with the same inputs and parameters
+finds the outputs of the earlier run, wherever and whenever that run was. Outputs are
+stored in a directory per key, and are hard linked between the cache and the run
+directory where they can be, so the cache takes little extra space on the same
+filesystem. Entries are written to a temporary directory and renamed into place,
+so interrupted stages never leave partial entries.
+
+Input files are hashed once per cache object, as long as their size and modification
+time don't change, since each stage's outputs are the next stage's inputs.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from typing import List, Optional
+
+from aquatx.srna.count_store import file_hash
+
+
+class StageCache:
+    """A directory of stage outputs keyed by the hash of each stage's inputs and parameters
+
+    Attributes:
+        path: The cache directory
+        hits: The names of stages whose outputs were restored from the cache
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = []
+        self._hashes = {}  # (path, size, mtime) -> content hash
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, stage: str, inputs: List[str], params: dict) -> str:
+        """Returns the key of a stage's results
+
+        Args:
+            stage: The stage's name
+            inputs: The stage's input files. Their contents, not their paths, are hashed.
+            params: The JSON serializable parameters which affect the stage's outputs
+        """
+
+        digest = hashlib.sha256(f"{stage}:{json.dumps(params, sort_keys=True)}".encode())
+        for file in inputs:
+            digest.update(b'\0' + self._file_hash(file).encode())
+
+        return digest.hexdigest()
+
+    def fetch(self, key: str, outputs: List[str], stage: str = '') -> bool:
+        """Restores a stage's outputs from the cache, if they are stored under key
+
+        Args:
+            key: The key of the stage's results
+            outputs: The paths the stage writes its outputs to. Outputs the stage
+                didn't produce when its results were stored are skipped.
+            stage: The stage's name, recorded in hits
+
+        Returns: True if the outputs were restored
+        """
+
+        entry = self._entry(key)
+        manifest = os.path.join(entry, 'manifest.json')
+        if not os.path.isfile(manifest): return False
+
+        with open(manifest) as f:
+            stored = json.load(f)['outputs']
+        for output in outputs:
+            name = os.path.basename(output)
+            if name in stored:
+                _link(os.path.join(entry, name), output)
+
+        with self._lock:
+            self.hits.append(stage)
+        return True
+
+    def store(self, key: str, outputs: List[str]) -> None:
+        """Stores the outputs which the stage produced under key"""
+
+        entry = self._entry(key)
+        if os.path.isdir(entry): return
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(entry))
+        try:
+            stored = []
+            for output in outputs:
+                if not os.path.isfile(output): continue
+                _link(output, os.path.join(tmp, os.path.basename(output)))
+                stored.append(os.path.basename(output))
+            with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+                json.dump({'outputs': stored}, f)
+            os.rename(tmp, entry)
+        except OSError:
+            # Another run stored the same results first
+            if not os.path.isdir(entry): raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def _file_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._hashes.get(stamp)
+        if digest is None:
+            digest = file_hash(path)
+            with self._lock:
+                self._hashes[stamp] = digest
+
+        return digest
+
+
+def _link(src: str, dst: str) -> None:
+    """Hard links src to dst, replacing dst, or copies it if it can't be linked"""
+
+    if os.path.lexists(dst):
+        if os.path.samefile(src, dst): return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def default_cache_dir(run_dir: str, cache_dir: Optional[str] = None) -> str:
+    """Returns the configured cache directory, or the stage_cache directory of the run"""
+
+    return cache_dir or os.path.join(run_dir, 'stage_cache')
@@ -15,11 +15,20 @@ VERSION = '0.1'
 REQUIRED = [
     'cwltool',
     'htseq',
+    'pysam',
     'numpy',
     'pandas',
     'matplotlib',
 ]
 
+# Optional packages
+EXTRAS = {
+    # Parquet and feather intermediate alignment tables, and Parquet merged counts
+    'columnar': ['pyarrow'],
+    # HDF5 merged counts
+    'hdf5': ['h5py'],
+}
+
 setuptools.setup(
     name=NAME,
     version=VERSION,
@@ -46,6 +55,7 @@ setuptools.setup(
     scripts=['aquatx/srna/aquatx-deseq'],
     python_requires=REQUIRES_PYTHON,
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
     classifiers=[
         'Programming Language :: Python :: 3',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
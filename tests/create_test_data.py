@@ -60,6 +60,69 @@ def create_fastq(mature_table, outfile, N=100):
                 f.writelines('@seq_id_'+str(i)+str(j)+'\n'+mature_table.loc[i,"seq"]+'\n+\n'+'E'*len(mature_table.loc[i,"seq"])+'\n')
             i+=1
 
+def create_test_gff(gff_file, out_file, mask_file, N=400, n_mask=40):
+    """
+    Creates a small reference gff from the first N features of a larger gff,
+    and a mask gff from a random subset of them. Multiple values in the Class
+    attribute are joined with commas so that the files are valid GFF3.
+    """
+    np.random.seed(256)
+    features = []
+    with open(gff_file) as f:
+        for line in f:
+            if line.startswith('#'): continue
+            fields = line.rstrip('\n').split('\t')
+            attrs = []
+            for attr in fields[8].split(';'):
+                if '=' in attr or not attrs:
+                    attrs.append(attr)
+                else:
+                    attrs[-1] += ',' + attr
+            fields[8] = ';'.join(attrs)
+            features.append(fields)
+            if len(features) == N: break
+
+    with open(out_file, 'w') as out:
+        out.writelines('\t'.join(f) + '\n' for f in features)
+
+    with open(mask_file, 'w') as out:
+        for i in sorted(np.random.choice(N, n_mask, replace=False)):
+            fields = list(features[i])
+            # Shift masks so they partially overlap the features they came from
+            shift = np.random.randint(-50, 50)
+            fields[3], fields[4] = str(max(int(fields[3]) + shift, 1)), str(int(fields[4]) + shift)
+            fields[8] = fields[8].replace('ID=Gene:', 'ID=Mask:')
+            out.write('\t'.join(fields) + '\n')
+
+def create_test_sam(gff_file, out_file, N=2000, chrom_len=15072434):
+    """
+    Creates a SAM file of N collapsed sequences aligned near the features of a gff.
+    Read names follow the collapser's ID_count=COUNT format, and some sequences
+    have multiple alignments, reported consecutively as bowtie does.
+    """
+    np.random.seed(256)
+    bounds = []
+    with open(gff_file) as f:
+        for line in f:
+            if line.startswith('#'): continue
+            fields = line.split('\t')
+            bounds.extend([int(fields[3]), int(fields[4])])
+
+    with open(out_file, 'w') as out:
+        out.write('@HD\tVN:1.0\tSO:unsorted\n')
+        out.write('@SQ\tSN:I\tLN:%d\n' % chrom_len)
+        for i in range(N):
+            length = np.random.randint(15, 36)
+            seq = ''.join(np.random.choice(list('ACGT'), length))
+            count = np.random.geometric(0.2)
+            for _ in range(np.random.choice([1, 1, 1, 2, 3])):
+                pos = bounds[np.random.randint(len(bounds))] + np.random.randint(-40, 40)
+                flag = np.random.choice([0, 16])
+                out.write('\t'.join(map(str, [
+                    '%d_count=%d' % (i, count), flag, 'I', max(pos, 1), 255, '%dM' % length,
+                    '*', 0, 0, seq, 'I' * length, 'XA:i:0', 'MD:Z:%d' % length, 'NM:i:0'
+                ])) + '\n')
+
 def main():
     mature_cel = parse_org(mature_file='testdata/mature.fa')
     mature_table = create_org_table(mature_cel, 'data/mature_counts.csv')
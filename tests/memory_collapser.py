@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+script to compare the peak memory used by collapser.py's count tables
+
+Random small RNA length sequences are counted into an OrderedDict and into
+a compact SeqCountTable, and the peak allocation of each is reported.
+"""
+
+import argparse
+import random
+import tracemalloc
+
+from collections import OrderedDict
+
+from aquatx.srna.seq_table import SeqCountTable
+
+try:
+    from _collections import _count_elements
+except ImportError:
+    from collections import _count_elements
+
+
+def get_args():
+    """ Get input arguments. """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--unique', type=int, default=2000000,
+                        help='Number of unique sequences to count')
+    parser.add_argument('-d', '--depth', type=int, default=3,
+                        help='Average number of reads per unique sequence')
+
+    return parser.parse_args()
+
+
+def make_reads(unique, depth):
+    """ Create reads of 15-30 nt as bytes, each unique sequence repeated ~depth times """
+
+    random.seed(0)
+    seqs = [bytes(random.choices(b'ACGT', k=random.randint(15, 30))) for _ in range(unique)]
+    return [random.choice(seqs) for _ in range(unique * depth)]
+
+
+def read_batches(reads, batch):
+    """ Yields batches as lists of new bytes objects, as the collapser's block engine does """
+
+    for i in range(0, len(reads), batch):
+        yield b'\n'.join(reads[i:i + batch]).split(b'\n')
+
+
+def peak_memory(count_fn, reads, batch=100000):
+    """ Returns the peak memory in MB and the number of entries counted """
+
+    tracemalloc.start()
+    table = count_fn(read_batches(reads, batch))
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    return peak, len(table)
+
+
+def count_ordered_dict(batches):
+    seqs = OrderedDict()
+    for batch in batches:
+        _count_elements(seqs, batch)
+    return seqs
+
+
+def count_compact(batches):
+    seqs = SeqCountTable()
+    for batch in batches:
+        seqs.count(batch)
+    seqs.flush()
+    return seqs
+
+
+def main():
+    args = get_args()
+    reads = make_reads(args.unique, args.depth)
+
+    for name, fn in [('OrderedDict', count_ordered_dict), ('SeqCountTable', count_compact)]:
+        peak, n = peak_memory(fn, reads)
+        print(f'{name}: {n} unique sequences, peak memory {peak:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,15 @@ def time_seq_counter_from_fastq():
     print('Average time to convert fastq sequences to a counter dictionary: {}'.format(sum([x/10 for x in times])/len(times)))
     print('Max time to convert fastq sequences to a counter dictionary: {}'.format(max([x/10 for x in times])))
 
+def time_seq_counter_engines():
+    SETUP_CODE = '''from aquatx.srna.collapser import seq_counter'''
+
+    for engine in ['readline', 'block']:
+        TEST_CODE = f'''seq_counter('tests/testdata/KB1_cleaned.fq', engine='{engine}')'''
+        times = timeit.repeat(setup=SETUP_CODE, stmt=TEST_CODE, repeat=2, number=10)
+        print('Average time to count fastq sequences with the {} engine: {}'.format(engine, sum([x/10 for x in times])/len(times)))
+        print('Max time to count fastq sequences with the {} engine: {}'.format(engine, max([x/10 for x in times])))
+
 def time_seq_2_fasta():
     SETUP_CODE = '''
 from aquatx.srna.collapser import seq_counter, seq2fasta
@@ -42,6 +51,7 @@ seq2fasta(seqs, 'tests/testdata/KB1_uniq.fa')'''
 
 def main():
     time_seq_counter_from_fastq()
+    time_seq_counter_engines()
     time_seq_2_fasta()
     time_collapse_fastq_file_full()
 
@@ -12,6 +12,9 @@ class MyTestCase(unittest.TestCase):
         result = Configuration(self.file)
         result.write_processed_config()
 
+        # The counter only uses features.csv rules when feature_rules is set
+        self.assertIsNone(result.get('features_sheet'))
+
     def test_rundir(self):
         from aquatx.aquatx import run
 
@@ -2,10 +2,14 @@
 
 import os
 import shutil
+import json
 import sys
+import tempfile
 import time
 import unittest
 
+from unittest import mock
+
 import psutil
 
 import aquatx.aquatx as aquatx
@@ -195,6 +199,28 @@ class test_aquatx(unittest.TestCase):
                 self.assertIn('cwltool', sub_names,
                               f"The cwltool subprocess does not appear to have started. Function: {test_context}")
 
+    """
+    Testing that a resumed run uses the engine it was last run with, unless
+    another engine is given, which is then recorded for later resumes.
+    """
+
+    def test_resume_engine(self):
+        with tempfile.TemporaryDirectory() as run_dir:
+            config = os.path.join(run_dir, 'processed_run_config.yml')
+            with open(config, 'w') as f:
+                f.write("run_directory: run\n")
+            resume_file = os.path.join(run_dir, aquatx.RESUME_FILE)
+            with open(resume_file, 'w') as f:
+                json.dump({'config': config, 'cwd': os.getcwd(), 'engine': 'cwl'}, f)
+
+            engines = []
+            with mock.patch.object(aquatx, 'run_workflow', lambda *args: engines.append(args[-1])):
+                aquatx.resume(self.aquatx_cwl_path, run_dir)
+                aquatx.resume(self.aquatx_cwl_path, run_dir, 'native')
+                aquatx.resume(self.aquatx_cwl_path, run_dir)
+
+            self.assertEqual(engines, ['cwl', 'native', 'native'])
+
     """
     A very minimal test for the subprocess context manager that is used
     to execute post-install aquatx commands via a shell.
@@ -1,14 +1,20 @@
 import unittest
+import tempfile
+import gzip
 import json
 import sys
 import os
 
+import numpy as np
+
 from tests.unit_test_helpers import reset_mocks, ShellCapture, reassemble_gz_w
 from unittest.mock import patch, MagicMock, call, mock_open, Mock
 from collections import OrderedDict
 from io import StringIO
 
 import aquatx.srna.collapser as collapser
+from aquatx.srna.seq_table import SeqCountTable, pack_sequences, unpack_sequences
+from aquatx.srna.spill_table import SpillingCountTable, parse_size
 
 class MyTestCase(unittest.TestCase):
     @classmethod
@@ -26,6 +32,8 @@ class MyTestCase(unittest.TestCase):
         self.fastq_file = 'testdata/cel_montgomery/Lib303_test.fastq'
         self.fastq_gzip = 'testdata/collapser/Lib303_test.fastq.gz'
         self.fastq_counts_dict = json.loads(read('./testdata/collapser/Lib303_counts_reference.json'))
+        # The default (block) engine counts sequences as raw bytes
+        self.fastq_counts_bytes = {seq.encode('utf-8'): count for seq, count in self.fastq_counts_dict.items()}
         self.fasta = {
             "thresh=0": read('testdata/collapser/Lib303_thresh_0_collapsed.fa'),
             "thresh=4": read('testdata/collapser/Lib303_thresh_4_collapsed.fa'),
@@ -59,6 +67,7 @@ class MyTestCase(unittest.TestCase):
                             b'\x1b\x08FPOn\x93\x92\xa4%R\'\x12\x08\x8e\xde\xaf\xac\x94\x97\x91\xc4\xa6\x94c\x89\xc1' \
                             b'\xf2\x1f\xb1\\G\xec|\x01\'\xbdlc\xd2\x00\x00\x00'
         self.min_counts_dict = {self.min_seq: 1}
+        self.min_counts_bytes = {self.min_seq.encode('utf-8'): 1}
         self.min_fasta = ">0_count=1\n" + self.min_seq
 
     """
@@ -72,12 +81,12 @@ class MyTestCase(unittest.TestCase):
         with patch.object(collapser.seq_counter, '__defaults__', new=(mock_open(read_data=self.min_fastq),)) as mo:
             min_count = collapser.seq_counter("mockPrefixDNE")
             mo[0].assert_called_once_with("mockPrefixDNE", "rb")
-            self.assertDictEqual(min_count, self.min_counts_dict)
+            self.assertDictEqual(min_count, self.min_counts_bytes)
             self.assertEqual([call('mockPrefixDNE', 'rb')], mo[0].call_args_list)
         print("seq_counter: passed single record test.", file=sys.stderr)
 
         # Zero length file test
-        with patch.object(collapser.seq_counter, '__defaults__', new=(mock_open(read_data=''),)) as mo:
+        with patch.object(collapser.seq_counter, '__defaults__', new=(mock_open(read_data=b''),)) as mo:
             zero_count = collapser.seq_counter("mockPrefixDNE")
             mo[0].assert_called_once_with("mockPrefixDNE", "rb")
             self.assertDictEqual(zero_count, {})
@@ -89,11 +98,147 @@ class MyTestCase(unittest.TestCase):
     """
     def test_seq_counter_full(self):
         seq_count_dict = collapser.seq_counter(self.fastq_file)
-        self.assertDictEqual(seq_count_dict, self.fastq_counts_dict)
+        self.assertDictEqual(seq_count_dict, self.fastq_counts_bytes)
         print("seq_counter: counts verified.", file=sys.stderr)
 
     """
-    Testing gzip reading in seq_counter() 
+    Testing that both seq_counter() engines produce the same counts in the same order.
+    A small block size is used so that records span block boundaries.
+    """
+    def test_seq_counter_engines(self):
+        readline_result = collapser.seq_counter(self.fastq_file, engine='readline')
+        self.assertDictEqual(readline_result, self.fastq_counts_dict)
+
+        with open(self.fastq_file, 'rb') as f:
+            block_result = OrderedDict()
+            collapser.block_engine(f, block_result, block_size=1000)
+        self.assertEqual([(seq.encode('utf-8'), count) for seq, count in readline_result.items()],
+                         list(block_result.items()))
+        print("seq_counter: block and readline engines verified.", file=sys.stderr)
+
+    """
+    Testing parallel seq_counter() with test-length library files. A small chunk size is
+    used so that inputs are split into many record-aligned chunks. Chunk counts must merge
+    into the reference counts with the same first-seen ordering as the serial counter.
+    """
+    def test_seq_counter_parallel(self):
+        for fastq in [self.fastq_file, self.fastq_gzip]:
+            seq_count_dict = collapser.parallel_seq_counter(fastq, workers=3, chunk_size=4096)
+            self.assertDictEqual(seq_count_dict, self.fastq_counts_bytes)
+            self.assertEqual(list(collapser.seq_counter(fastq).items()), list(seq_count_dict.items()))
+        print("seq_counter: parallel counts and ordering verified.", file=sys.stderr)
+
+    """
+    Testing that the compact SeqCountTable produces the same counts in the same order as
+    the OrderedDict counter. The test library's 76 nt reads exceed the packed key length,
+    so short sequences are added to exercise packed keys alongside overflow sequences.
+    """
+    def test_seq_counter_compact(self):
+        table = collapser.seq_counter(self.fastq_file, compact=True)
+        self.assertEqual(list(table.items()), list(self.fastq_counts_bytes.items()))
+
+        table = collapser.parallel_seq_counter(self.fastq_gzip, workers=2, chunk_size=4096, compact=True)
+        self.assertEqual(list(table.items()), list(self.fastq_counts_bytes.items()))
+
+        short = [b'ACGT', b'TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT', b'', b'ACGNT', b'A', b'ACGT', b'AC'] * 3
+        table = SeqCountTable(fold_size=4)
+        table.count(short)
+        table.count(iter(list(self.fastq_counts_bytes)[:5]))
+        expected = OrderedDict()
+        for seq in short + list(self.fastq_counts_bytes)[:5]:
+            if seq: expected[seq] = expected.get(seq, 0) + 1
+        self.assertEqual(list(table.items()), list(expected.items()))
+        self.assertEqual(table[b'ACGT'], 6)
+        self.assertNotIn(b'ACG', table)
+
+        # Many folds keep few sorted runs, and sequences are still found across runs
+        rng = np.random.default_rng(0)
+        seqs = [bytes(rng.choice(list(b'ACGT'), 12).tolist()) for _ in range(3000)]
+        table = SeqCountTable(fold_size=64)
+        expected = OrderedDict()
+        for start in range(0, len(seqs), 50):
+            table.count(seqs[start:start + 50] * 2)
+            for seq in seqs[start:start + 50] * 2:
+                expected[seq] = expected.get(seq, 0) + 1
+        self.assertEqual(list(table.items()), list(expected.items()))
+        self.assertLessEqual(len(table._runs), np.log2(len(expected)) + 1)
+        self.assertEqual(table[seqs[0]], expected[seqs[0]])
+
+        keys, packable = pack_sequences(short)
+        self.assertEqual(unpack_sequences(keys[packable]), [s for s in short if s != b'ACGNT'])
+        print("seq_counter: compact table counts and ordering verified.", file=sys.stderr)
+
+    """
+    Testing the memory-bounded counter. A tiny budget forces many spills so that most
+    sequences are split across spill files, and the merged partitions must still match
+    the reference counts and first-seen order. Spill files are removed on close().
+    """
+    def test_seq_counter_max_memory(self):
+        for kwargs in [dict(), dict(workers=2), dict(engine='readline')]:
+            table = collapser.seq_counter(self.fastq_file, max_memory=2000, **kwargs)
+            self.assertGreater(table.spills, 1)
+            items = [(seq.encode('utf-8') if isinstance(seq, str) else seq, count) for seq, count in table.items()]
+            self.assertEqual(items, list(self.fastq_counts_bytes.items()))
+
+            spill_dir = table._tmp
+            table.close()
+            self.assertFalse(os.path.exists(spill_dir))
+
+        # Chunks larger than the budget are spilled as they are merged, not after
+        table = SpillingCountTable(2000)
+        table.add_counts(self.fastq_counts_bytes)
+        self.assertLess(len(table._table), table._max_entries)
+        self.assertGreater(table.spills, 1)
+        self.assertEqual(list(table.items()), list(self.fastq_counts_bytes.items()))
+
+        # With a budget, uncompressed inputs are split into ranges of at most the chunk size
+        with patch.object(collapser, 'MIN_CHUNK_SIZE', 4096), \
+                patch.object(collapser, '_record_ranges', wraps=collapser._record_ranges) as ranges:
+            table = collapser.parallel_seq_counter(self.fastq_file, workers=2, max_memory=2000)
+        self.assertEqual(ranges.call_args[0][1], -(-os.path.getsize(self.fastq_file) // 4096))
+        self.assertEqual(list(table.items()), list(self.fastq_counts_bytes.items()))
+
+        # Nothing is written to disk if the budget isn't reached
+        table = collapser.seq_counter(self.fastq_gzip, max_memory=parse_size('1G'))
+        self.assertEqual(table.spills, 0)
+        self.assertEqual(list(table.items()), list(self.fastq_counts_bytes.items()))
+
+        self.assertEqual(parse_size('4G'), 4 * 1024 ** 3)
+        self.assertEqual(parse_size('512m'), 512 * 1024 ** 2)
+        with self.assertRaises(ValueError): parse_size('lots')
+        print("seq_counter: memory-bounded counts and ordering verified.", file=sys.stderr)
+
+    """
+    Testing the 5' nt x length histograms against a simple tally of the reference counts,
+    with short sequences added so that several lengths and an N are represented.
+    """
+    def test_nt_len_histogram(self):
+        seqs = OrderedDict(self.fastq_counts_bytes)
+        seqs.update({b'TGAGGTAGTAGGTTGTATAGTT': 12, b'NACGT': 2, b'GAC': 1})
+        unique, reads = collapser.nt_len_histogram(seqs)
+
+        expected_unique, expected_reads = np.zeros_like(unique), np.zeros_like(reads)
+        for seq, count in seqs.items():
+            row = collapser.HISTOGRAM_NTS.index(chr(seq[0]))
+            expected_unique[row, len(seq)] += 1
+            expected_reads[row, len(seq)] += count
+
+        self.assertEqual(unique.shape, (5, 77))
+        np.testing.assert_array_equal(unique, expected_unique)
+        np.testing.assert_array_equal(reads, expected_reads)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            prefix = os.path.join(tmp, 'hist')
+            collapser.write_nt_len_histogram((unique, reads), prefix)
+            with open(prefix + '_nt_len_dist_reads.csv') as f:
+                lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'Length,A,C,G,T,N')
+        self.assertEqual(lines[22], '22,0,0,0,12,0')
+        self.assertEqual(len(lines), 77)
+        print("nt_len_histogram: unique and read-weighted tallies verified.", file=sys.stderr)
+
+    """
+    Testing gzip reading in seq_counter()
     """
     def test_seq_counter_gzip(self):
         # MIN TEST
@@ -102,12 +247,12 @@ class MyTestCase(unittest.TestCase):
             with patch.object(collapser.seq_counter, '__defaults__', new=(mock_open(read_data=self.min_fastq_gz),)) as mo:
                 # Read the mock gzipped single record fastq file
                 gz_min_result = collapser.seq_counter("mockPrefixDNE")
-                self.assertEqual(self.min_counts_dict, gz_min_result)
+                self.assertEqual(self.min_counts_bytes, gz_min_result)
 
         # FULL TEST
         # Verify that full-length fastq.gz files can be read and properly counted
         gz_full_result = collapser.seq_counter(self.fastq_gzip)
-        self.assertDictEqual(self.fastq_counts_dict, gz_full_result)
+        self.assertDictEqual(self.fastq_counts_bytes, gz_full_result)
 
     """
     Testing gzip writing in seq2fasta()
@@ -134,6 +279,26 @@ class MyTestCase(unittest.TestCase):
             # Only a binary write to the output file should have been called
             self.assertEqual([call('Lib303_thresh_0_collapsed.fa.gz', 'wb')], gz_open.call_args_list)
 
+    """
+    Testing the threaded gzip backend. Fasta outputs written as parallel-compressed members
+    must decompress to the reference fasta, and threaded decompression must produce the
+    reference counts both for standard gzip files and for files written by the backend.
+    """
+    def test_threaded_gz_backend(self):
+        threaded = collapser.get_opener('threaded', level=6, threads=3)
+        with tempfile.TemporaryDirectory() as tmp:
+            prefix = os.path.join(tmp, "Lib303_thresh_0")
+            collapser.seq2fasta(self.fastq_counts_bytes, prefix, gz=True, gz_writer=threaded)
+            with gzip.open(prefix + "_collapsed.fa.gz", 'rt') as f:
+                self.assertEqual(self.fasta["thresh=0"], f.read())
+
+            with open(self.fastq_file, 'rb') as f, threaded(os.path.join(tmp, "reads.fq.gz"), 'wb') as out:
+                out.write(f.read())
+            for fastq in [self.fastq_gzip, os.path.join(tmp, "reads.fq.gz")]:
+                result = collapser.seq_counter(fastq, gz_reader=threaded)
+                self.assertEqual(list(self.fastq_counts_bytes.items()), list(result.items()))
+        print("gzip backends: threaded compression and decompression verified.", file=sys.stderr)
+
     """
     Testing that the correct usage messages are produced when improperly calling seq2fasta(),
     or when the specified prefix conflicts with files that already exist.
@@ -206,21 +371,21 @@ class MyTestCase(unittest.TestCase):
                         # Only the outfile should have been opened for writing. No low-count file.
                         mock_open_f.assert_called_once_with(self.output["file"]["out"]["dne"], "w")
                         if seqs == {}:
-                            # Empty input sequences should result in empty out file
-                            mock_open_f.return_value.__enter__().write.assert_called_once_with('')
+                            # Empty input sequences should result in empty out file (nothing is written)
+                            mock_open_f.return_value.__enter__().write.assert_not_called()
                         elif seqs == self.min_counts_dict:
                             mock_open_f.return_value.__enter__().write.assert_called_once_with(self.min_fasta)
 
                     elif thresh == 1:
-                        # Both the outfile and low-count file should have been written to
+                        # Both the outfile and low-count file should have been opened for writing
+                        self.assertEqual([call(self.output["file"][f]["dne"], "w") for f in ["out", "low"]],
+                                         mock_open_f.call_args_list)
                         if seqs == {}:
                             # Empty input sequences should result in empty out and low-count file.
-                            mock_open_f.return_value.__enter__().write.assert_has_calls([call(''), call('')])
+                            mock_open_f.return_value.__enter__().write.assert_not_called()
                         elif seqs == self.min_counts_dict:
                             # An empty outfile and a populated low-count file should have been written
-                            mock_open_f.return_value.__enter__().write.assert_has_calls([
-                                call(''), call(self.min_fasta)
-                            ])
+                            mock_open_f.return_value.__enter__().write.assert_called_once_with(self.min_fasta)
 
                     reset_mocks(mock_open_f, mock_os, mock_stdout)
 
@@ -236,9 +401,9 @@ class MyTestCase(unittest.TestCase):
         # Simulate that prefix "mockPrefixExists" exists for both output files
         mock_os.path.isfile.configure_mock(side_effect=self.prefix_exists_fn)
 
-        # The parameter sets to permute
+        # The parameter sets to permute (str keys from the readline engine, bytes keys from the block engine)
         test_map = {
-            'seqs': [self.fastq_counts_dict],
+            'seqs': [self.fastq_counts_dict, self.fastq_counts_bytes],
             'out_file': ["mockPrefixDNE"],
             'thresh': [0, 4]
         }
@@ -267,6 +432,65 @@ class MyTestCase(unittest.TestCase):
                     reset_mocks(mock_open_f, mock_os, mock_stdout)
 
 
+    """
+    Testing that streaming records in small batches produces output identical to the
+    reference fasta files. Each record must be routed to the correct file in a single pass.
+    """
+    def test_write_fasta_records_batches(self):
+        for batch_size in [1, 7, 100000]:
+            fasta, lowfa = StringIO(), StringIO()
+            collapser.write_fasta_records(iter(self.fastq_counts_bytes.items()), lambda x: x,
+                                          fasta, lowfa, thresh=4, batch_size=batch_size)
+            self.assertEqual(self.fasta["thresh=4"], fasta.getvalue())
+            self.assertEqual(self.fasta["thresh=4,low_count"], lowfa.getvalue())
+
+            fasta = StringIO()
+            collapser.write_fasta_records(iter(self.fastq_counts_dict.items()), lambda x: x,
+                                          fasta, batch_size=batch_size)
+            self.assertEqual(self.fasta["thresh=0"], fasta.getvalue())
+        print("write_fasta_records: batched output verified.", file=sys.stderr)
+
+    """
+    Testing collapse_samples() with two samples which share some of their sequences.
+    Each sample's fasta must hold its own counts under IDs from the shared index, and
+    the count matrix must agree with both the sample and index fasta files.
+    """
+    def test_collapse_samples(self):
+        def read_fasta(file):
+            with open(file) as f:
+                lines = f.read().split('\n')
+            headers = [header[1:].split('_count=') for header in lines[::2]]
+            return {int(seq_id): (seq, int(count)) for (seq_id, count), seq in zip(headers, lines[1::2])}
+
+        with open(self.fastq_file) as f:
+            lines = f.readlines()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            samples = [os.path.join(tmp, 'a.fastq'), os.path.join(tmp, 'b.fq.gz')]
+            with open(samples[0], 'w') as f:
+                f.writelines(lines[:2000])
+            with gzip.open(samples[1], 'wt') as f:
+                f.writelines(lines[1000:])
+
+            prefix = os.path.join(tmp, 'cohort')
+            index = collapser.collapse_samples(samples, prefix, compact=True)
+            matrix, names = collapser.load_count_matrix(prefix + '_count_matrix.npz')
+            index_fasta = read_fasta(prefix + '_collapsed.fa')
+
+            self.assertEqual(names, [prefix + '_a', prefix + '_b'])
+            self.assertEqual(matrix.shape, (len(index), 2))
+            self.assertEqual(matrix.sum(), sum(self.fastq_counts_dict.values()) + 250)
+            self.assertEqual([count for _, count in index_fasta.values()], matrix.sum(axis=1).tolist())
+
+            for col, (fastq, name) in enumerate(zip(samples, names)):
+                sample_fasta = read_fasta(name + '_collapsed.fa')
+                expected = collapser.seq_counter(fastq)
+                self.assertEqual({seq.encode(): count for seq, count in sample_fasta.values()}, expected)
+                for seq_id, (seq, count) in sample_fasta.items():
+                    self.assertEqual(index_fasta[seq_id][0], seq)
+                    self.assertEqual(matrix[seq_id, col], count)
+        print("collapse_samples: shared index and count matrix verified.", file=sys.stderr)
+
     """
     Testing fasta headers for correctness.
     
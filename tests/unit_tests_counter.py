@@ -2,11 +2,22 @@
 
 """ unit tests for functions in counter.py """
 
+import os
+import pickle
+import tempfile
 import unittest
 import pandas as pd
 import numpy as np
+import HTSeq
+import pysam
 import aquatx.srna.counter as smrna
 
+from types import SimpleNamespace
+from aquatx.srna import aln_table
+from aquatx.srna.aln_table import AlnTableWriter, read_aln_table
+from aquatx.srna.feature_index import FeatureIndex, FeatureRegistry, index_cache_key, subtract_masks
+from aquatx.srna.feature_rules import FeatureSelector, parse_length, parse_nt, read_rules
+
 class test_get_sam_flags(unittest.TestCase):
     """ 
     Testing the get_sam_flags function for returning
@@ -294,5 +305,528 @@ class test_feature_counter(unittest.TestCase):
     def test_good_feature_count(self):
         pd.testing.assert_frame_equal(self.df, smrna.feature_counter(self.testfeat, self.testdf))
 
+def named_counts(counts, registry):
+    """Maps tallied class and feature count arrays to dictionaries keyed by name"""
+    class_counts, feat_counts, nt_len_mat = counts
+    return (dict(zip(registry.class_names, class_counts.tolist())),
+            dict(zip(registry.feature_names, feat_counts.tolist())),
+            nt_len_mat)
+
+class test_feature_index(unittest.TestCase):
+    """
+    Testing that the numpy FeatureIndex assigns the same features and classes
+    as the HTSeq GenomicArrayOfSets for the same annotations, with and without
+    strandedness and masks, and that full tallies are identical.
+    """
+    def setUp(self):
+        testdata = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'counter')
+        self.gff = os.path.join(testdata, 'chr1_subset.gff3')
+        self.mask = os.path.join(testdata, 'chr1_subset_mask.gff3')
+        self.sam = os.path.join(testdata, 'Lib303_test.sam')
+        self.args = ([self.gff, self.gff], ['true', 'false'], [self.mask, 'None'])
+
+    def test_assign_features(self):
+        htseq_dict, htseq_registry = smrna.create_ref_dict(*self.args, index='htseq')
+        numpy_dict, numpy_registry = smrna.create_ref_dict(*self.args, index='numpy')
+        self.assertEqual(htseq_registry.feature_names, numpy_registry.feature_names)
+        self.assertEqual(htseq_registry.class_names, numpy_registry.class_names)
+
+        bounds = [f.iv.start for f in HTSeq.GFF_Reader(self.mask)] + \
+                 [f.iv.end for f in HTSeq.GFF_Reader(self.gff)]
+        np.random.seed(0)
+        for _ in range(5000):
+            start = max(int(np.random.choice(bounds)) + np.random.randint(-40, 40), 0)
+            chrom, strand = ['I', 'II'][np.random.randint(2)], ['+', '-'][np.random.randint(2)]
+            end = start + np.random.randint(15, 36)
+            aln = SimpleNamespace(iv=HTSeq.GenomicInterval(chrom, start, end, strand))
+            for rf in self.args[0]:
+                expected = smrna.assign_features(aln, {rf: htseq_dict[rf]}, htseq_registry)
+                result = smrna.assign_features(aln, {rf: numpy_dict[rf]}, numpy_registry)
+                np.testing.assert_array_equal(expected[0], result[0])
+                np.testing.assert_array_equal(expected[1], result[1])
+
+    def test_tally_feature_counts(self):
+        results = []
+        for index in ['htseq', 'numpy']:
+            ref_dict, registry = smrna.create_ref_dict(*self.args, index=index)
+            with tempfile.NamedTemporaryFile('r') as stats:
+                counts = smrna.tally_feature_counts(HTSeq.SAM_Reader(self.sam), ref_dict,
+                                                    registry, stats.name)
+                results.append((named_counts(counts, registry), stats.read()))
+
+        self.assertEqual(results[0], results[1])
+        self.assertGreater(results[0][0][0]['gene'], 0)
+
+    def test_assign_batch(self):
+        numpy_dict, numpy_registry = smrna.create_ref_dict(*self.args, index='numpy')
+        htseq_dict, htseq_registry = smrna.create_ref_dict(*self.args, index='htseq')
+
+        bounds = [f.iv.start for f in HTSeq.GFF_Reader(self.gff)] + \
+                 [f.iv.end for f in HTSeq.GFF_Reader(self.gff)]
+        np.random.seed(1)
+        starts = np.maximum(np.random.choice(bounds, 3000) + np.random.randint(-40, 40, 3000), 0)
+        ends = starts + np.random.randint(15, 36, 3000)
+        chroms = [['I', 'II', 'III'][i] for i in np.random.randint(3, size=3000)]
+        strands = [['+', '-'][i] for i in np.random.randint(2, size=3000)]
+
+        # Batched labels match single queries
+        for index in numpy_dict.values():
+            labels = index.assign_batch(chroms, strands, starts, ends)
+            for i, label in enumerate(labels.tolist()):
+                expected = index.assign(chroms[i], strands[i], int(starts[i]), int(ends[i]))
+                self.assertEqual(expected, label if label >= 0 else None)
+
+        # Batched integer IDs match HTSeq's per alignment names
+        alns = [SimpleNamespace(read='ACGT', iv=HTSeq.GenomicInterval(c, int(b), int(e), s))
+                for c, s, b, e in zip(chroms, strands, starts, ends)]
+        numpy_assigner = smrna.FeatureAssigner(numpy_dict, numpy_registry)
+        htseq_assigner = smrna.FeatureAssigner(htseq_dict, htseq_registry)
+        self.assertTrue(numpy_assigner.batched)
+        self.assertFalse(htseq_assigner.batched)
+        self.assertEqual(numpy_assigner.assign(alns), htseq_assigner.assign(alns))
+
+    def test_assignment_cache(self):
+        alns = [SimpleNamespace(read='ACGT', iv=HTSeq.GenomicInterval('I', start, start + 20, strand))
+                for start in range(1000, 200000, 1000) for strand in '+-']
+        repeated = alns + alns[::-1] + alns[:50]
+
+        for index in ['htseq', 'numpy']:
+            ref_dict, registry = smrna.create_ref_dict(*self.args, index=index)
+            expected = smrna.FeatureAssigner(ref_dict, registry, cache_size=0).assign(repeated)
+
+            # Results are the same whether or not they are cached, or evicted from a small cache
+            for cache_size in [10, 1000]:
+                assigner = smrna.FeatureAssigner(ref_dict, registry, cache_size=cache_size)
+                stats = smrna.Counter()
+                self.assertEqual(assigner.assign(repeated, stats), expected)
+                self.assertLessEqual(len(assigner._cache), cache_size)
+                self.assertEqual(stats['_assignment_cache_misses'], len(alns))
+                self.assertEqual(stats['_assignment_cache_hits'], len(alns) + 50)
+
+                # The least recently used intervals are evicted first
+                stats.clear()
+                assigner.assign(alns[-10:] + alns[:1], stats)
+                self.assertEqual(stats['_assignment_cache_hits'], 10 if cache_size == 10 else 11)
+
+    def test_stranded_index_rejects_unstranded_features(self):
+        registry = FeatureRegistry()
+        index = FeatureIndex(registry, stranded=True)
+        with self.assertRaises(KeyError):
+            index.add(HTSeq.GenomicInterval('I', 0, 10, '.'), registry.add('x', 'gene'))
+
+    def test_registry(self):
+        registry = FeatureRegistry()
+        index = FeatureIndex(registry)
+
+        # Names may contain underscores, and masks have no feature or class
+        gene = registry.add('WBGene_0001', 'gene_like')
+        mask = registry.add('mask_1', 'repeat', mask=True)
+        index.add(HTSeq.GenomicInterval('I', 0, 10, '+'), gene)
+        index.add(HTSeq.GenomicInterval('I', 20, 30, '+'), mask)
+        self.assertEqual(registry.label(gene), ('WBGene_0001', 'gene_like', False))
+        self.assertEqual(registry.feature_names, ['WBGene_0001'])
+        self.assertEqual(registry.class_names, ['gene_like'])
+        np.testing.assert_array_equal(registry.is_mask, [False, True])
+
+        self.assertEqual(index.assign('I', '+', 2, 8), gene)
+        self.assertIsNone(index.assign('I', '+', 22, 28))
+        np.testing.assert_array_equal(index.assign_batch(['I', 'I'], ['+', '+'], [2, 22], [8, 28]),
+                                      [gene, -1])
+
+        aln = SimpleNamespace(read='ACGT', iv=HTSeq.GenomicInterval('I', 2, 8, '+'))
+        assigner = smrna.FeatureAssigner({'gff': index}, registry)
+        self.assertEqual(assigner.assign([aln]), [('ACGT', '+', 2, 8, (0,), (0,))])
+        self.assertEqual(registry.class_names, ['gene_like', 'ambiguous'])
+
+    def test_index_cache(self):
+        with tempfile.TemporaryDirectory() as cache:
+            built = smrna.create_ref_dict(*self.args, index='numpy', cache_dir=cache)
+            self.assertEqual(len(os.listdir(cache)), 2)
+            cached = smrna.create_ref_dict(*self.args, index='numpy', cache_dir=cache)
+
+            # Cached indexes are memory-mapped and register the same names in the same order
+            self.assertEqual(built[1].feature_names, cached[1].feature_names)
+            self.assertEqual(built[1].class_names, cached[1].class_names)
+            bounds = next(iter(cached[0][self.gff]._compiled.values()))[0]
+            self.assertIsInstance(bounds, np.memmap)
+            with self.assertRaises(ValueError):
+                cached[0][self.gff].add(HTSeq.GenomicInterval('I', 0, 10, '+'), 0)
+
+            # Workers which aren't forked receive indexes by path and memory-map them
+            assigner = smrna.FeatureAssigner(*cached)
+            worker = pickle.loads(pickle.dumps(assigner))
+            bounds = next(iter(worker._ref_array_dict[self.gff]._compiled.values()))[0]
+            self.assertIsInstance(bounds, np.memmap)
+            self.assertEqual(worker.registry.feature_names, cached[1].feature_names)
+            index = cached[0][self.gff]
+            by_path, index.path = len(pickle.dumps(index)), None
+            self.assertLess(by_path, len(pickle.dumps(index)))
+
+            # Indexes built without a cache are saved before they are sent to workers
+            unsaved = smrna.create_ref_dict(*self.args, index='numpy')
+            assigner = smrna.FeatureAssigner(*unsaved)
+            assigner.save_indexes(os.path.join(cache, 'shared'))
+            self.assertTrue(all(index.path for index in unsaved[0].values()))
+            worker = pickle.loads(pickle.dumps(assigner))
+            bounds = next(iter(worker._ref_array_dict[self.gff]._compiled.values()))[0]
+            self.assertIsInstance(bounds, np.memmap)
+
+            with tempfile.NamedTemporaryFile('r') as stats:
+                expected = smrna.tally_feature_counts(HTSeq.SAM_Reader(self.sam), *built, stats.name)
+                result = smrna.tally_feature_counts(HTSeq.SAM_Reader(self.sam), *cached, stats.name)
+            self.assertEqual(named_counts(expected, built[1]), named_counts(result, cached[1]))
+
+        # Keys change with file contents and options
+        key = index_cache_key(self.gff, self.mask, stranded=True)
+        self.assertNotEqual(key, index_cache_key(self.gff, None, stranded=True))
+        self.assertNotEqual(key, index_cache_key(self.gff, self.mask, stranded=False))
+        self.assertNotEqual(key, index_cache_key(self.mask, self.mask, stranded=True))
+        self.assertEqual(key, index_cache_key(self.gff, self.mask, stranded=True))
+
+    def test_subtract_masks(self):
+        iv = lambda start, end, strand='+': HTSeq.GenomicInterval('I', start, end, strand)
+        features = [(iv(0, 100), 0), (iv(40, 60), 1), (iv(0, 100, '-'), 2), (iv(200, 210), 3)]
+        masks = [iv(10, 20), iv(15, 30), iv(50, 80), iv(95, 120, '.'), iv(200, 210, '-')]
+
+        # Overlapping masks are merged, unstranded masks apply to both strands, and fully masked features are dropped
+        self.assertEqual(subtract_masks(features, masks),
+                         [('I', 0, 10, '+', 0), ('I', 30, 50, '+', 0), ('I', 80, 95, '+', 0),
+                          ('I', 40, 50, '+', 1), ('I', 0, 95, '-', 2), ('I', 200, 210, '+', 3)])
+        self.assertEqual(subtract_masks(features[2:], masks, stranded=False),
+                         [('I', 0, 10, '-', 2), ('I', 30, 50, '-', 2), ('I', 80, 95, '-', 2)])
+        self.assertEqual(subtract_masks(features[:1], []), [('I', 0, 100, '+', 0)])
+
+        # Fully masked features are still registered when a cached index is loaded
+        with tempfile.TemporaryDirectory() as cache, \
+                tempfile.NamedTemporaryFile('w', suffix='.gff3') as gff, \
+                tempfile.NamedTemporaryFile('w', suffix='.gff3') as mask:
+            gff.write("I\t.\tgene\t1\t10\t.\t+\t.\tID=a\nI\t.\tgene\t21\t30\t.\t+\t.\tID=b\n")
+            mask.write("I\t.\tgene\t1\t10\t.\t+\t.\tID=m\n")
+            gff.flush(), mask.flush()
+            for _ in range(2):
+                ref_dict, registry = smrna.create_ref_dict([gff.name], None, [mask.name],
+                                                           index='numpy', cache_dir=cache)
+                self.assertEqual(registry.feature_names, ['a', 'b'])
+                self.assertIsNone(ref_dict[gff.name].assign('I', '+', 0, 10))
+                self.assertEqual(ref_dict[gff.name].assign('I', '+', 20, 30), 1)
+
+    def test_read_count(self):
+        self.assertEqual(smrna.read_count('12_count=305'), 305)
+        self.assertEqual(smrna.read_count('seq_5_x25431'), 25431)
+
+class test_parallel_tally(unittest.TestCase):
+    """
+    Testing that counting with multiple workers splits the sam file on bundle
+    boundaries and produces the same counts, in the same order, as a serial run.
+    """
+    def setUp(self):
+        testdata = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'counter')
+        self.gff = os.path.join(testdata, 'chr1_subset.gff3')
+        self.mask = os.path.join(testdata, 'chr1_subset_mask.gff3')
+        self.sam = os.path.join(testdata, 'Lib303_test.sam')
+
+    def test_sam_bundle_ranges(self):
+        ranges = smrna.sam_bundle_ranges(self.sam, 16)
+        self.assertGreater(len(ranges), 1)
+
+        with open(self.sam, 'rb') as f:
+            data = f.read()
+        names = []
+        for start, end in ranges:
+            lines = data[start:end].splitlines()
+            self.assertFalse(lines[0].startswith(b'@'))
+            names.append([line.split(b'\t')[0] for line in lines])
+
+        # Ranges are contiguous, cover every alignment and never split a read's bundle
+        self.assertEqual([r[0] for r in ranges[1:]], [r[1] for r in ranges[:-1]])
+        self.assertEqual(sum(map(len, names)), sum(1 for _ in HTSeq.SAM_Reader(self.sam)))
+        for before, after in zip(names, names[1:]):
+            self.assertNotEqual(before[-1], after[0])
+
+    def test_parallel_matches_serial(self):
+        for index in ['htseq', 'numpy']:
+            results = []
+            for workers in [1, 3]:
+                ref_dict, registry = smrna.create_ref_dict([self.gff], None, [self.mask], index=index)
+                with tempfile.NamedTemporaryFile('r') as stats, \
+                        tempfile.NamedTemporaryFile('r') as table:
+                    with AlnTableWriter(table.name, registry) as writer:
+                        counts = smrna.tally_feature_counts(HTSeq.SAM_Reader(self.sam), ref_dict,
+                                                            registry, stats.name,
+                                                            write=True, outfile=writer,
+                                                            workers=workers)
+                    results.append((named_counts(counts, registry), stats.read().splitlines(),
+                                    table.read()))
+
+            (serial, serial_stats, serial_table), (parallel, parallel_stats, parallel_table) = results
+            self.assertEqual(serial_table, parallel_table)
+            self.assertEqual([line.split('\t')[0] for line in serial_stats],
+                             [line.split('\t')[0] for line in parallel_stats])
+            for expected, result in zip(serial[:2], parallel[:2]):
+                self.assertEqual(list(expected), list(result))
+                np.testing.assert_allclose(list(expected.values()), list(result.values()))
+            self.assertEqual(serial[2], parallel[2])
+
+class test_bam_input(unittest.TestCase):
+    """
+    Testing that bam files are counted the same as the sam file they were made from,
+    both when grouped by read name as the aligner reports them and when sorted by
+    coordinate and indexed, where multi-mapping bundles span chromosomes.
+    """
+    @classmethod
+    def setUpClass(cls):
+        testdata = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'counter')
+        cls.gff = os.path.join(testdata, 'chr1_subset.gff3')
+        cls.tmp = tempfile.TemporaryDirectory()
+
+        # Move every other alignment to a second chromosome so that bundles span references
+        cls.sam = os.path.join(cls.tmp.name, 'test.sam')
+        with open(os.path.join(testdata, 'Lib303_test.sam')) as f, open(cls.sam, 'w') as out:
+            for i, line in enumerate(f):
+                fields = line.split('\t')
+                if fields[0] == '@SQ':
+                    out.write(line + line.replace('SN:I', 'SN:II'))
+                    continue
+                if not line.startswith('@') and i % 2: fields[2] = 'II'
+                out.write('\t'.join(fields))
+
+        cls.bam = os.path.join(cls.tmp.name, 'test.bam')
+        cls.sorted_bam = os.path.join(cls.tmp.name, 'test.sorted.bam')
+        pysam.view('-b', '-o', cls.bam, cls.sam, catch_stdout=False)
+        pysam.sort('-o', cls.sorted_bam, cls.bam)
+        pysam.index(cls.sorted_bam)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def count(self, aln_file, workers):
+        ref_dict, registry = smrna.create_ref_dict([self.gff], None, None, index='numpy')
+        with tempfile.NamedTemporaryFile('r') as stats, tempfile.NamedTemporaryFile('r') as table:
+            with AlnTableWriter(table.name, registry) as writer:
+                counts = smrna.tally_feature_counts(HTSeq.SAM_Reader(aln_file), ref_dict, registry,
+                                                    stats.name, write=True,
+                                                    outfile=writer, workers=workers)
+            # Cache hits depend on the order in which alignments are read
+            stats_counts = dict(line.split('\t') for line in stats.read().splitlines()[1:]
+                                if not line.startswith('_assignment_cache'))
+            return named_counts(counts, registry), stats_counts, table.read().splitlines()
+
+    def assertCountsEqual(self, expected, result, ordered=True):
+        (exp_counts, exp_stats, exp_table), (res_counts, res_stats, res_table) = expected, result
+        for exp, res in zip(exp_counts[:2], res_counts[:2]):
+            self.assertEqual(sorted(exp), sorted(res))
+            np.testing.assert_allclose([exp[k] for k in exp], [res[k] for k in exp])
+        self.assertEqual(exp_stats.keys(), res_stats.keys())
+        np.testing.assert_allclose([float(exp_stats[k]) for k in exp_stats],
+                                   [float(res_stats[k]) for k in exp_stats])
+        if ordered:
+            self.assertEqual(exp_table, res_table)
+        else:
+            self.assertEqual(sorted(exp_table), sorted(res_table))
+
+    def test_bam_bundle_ranges(self):
+        ranges = smrna.bam_bundle_ranges(self.bam, 8)
+        self.assertGreater(len(ranges), 1)
+        self.assertEqual([r[0] for r in ranges[1:]], [r[1] for r in ranges[:-1]])
+
+    def test_name_grouped_bam(self):
+        expected = self.count(self.sam, 1)
+        self.assertCountsEqual(expected, self.count(self.bam, 1))
+        self.assertCountsEqual(expected, self.count(self.bam, 3))
+
+    def test_coordinate_sorted_bam(self):
+        expected = self.count(self.sam, 1)
+        self.assertEqual(smrna.bam_regions(self.sorted_bam, 2), ['I', 'II'])
+        self.assertCountsEqual(expected, self.count(self.sorted_bam, 1), ordered=False)
+        self.assertCountsEqual(expected, self.count(self.sorted_bam, 2), ordered=False)
+
+        # Without an index, or with 1 worker, sorted reads are grouped on disk
+        with smrna.collated_bam(self.sorted_bam) as collated, pysam.AlignmentFile(collated) as sf:
+            names = [record.query_name for record in sf]
+        runs = [name for i, name in enumerate(names) if i == 0 or names[i - 1] != name]
+        self.assertEqual(len(runs), len(set(names)))
+
+class test_feature_rules(unittest.TestCase):
+    """
+    Testing that features.csv rules select the same features as checking every
+    feature of the annotations against every rule, with and without masks and
+    index caching.
+    """
+    def setUp(self):
+        testdata = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'counter')
+        self.gff = os.path.join(testdata, 'chr1_subset.gff3')
+        self.mask = os.path.join(testdata, 'chr1_subset_mask.gff3')
+        self.tmp = tempfile.TemporaryDirectory()
+        self.features_csv = os.path.join(self.tmp.name, 'features.csv')
+        with open(self.features_csv, 'w') as f:
+            f.write("Identifier,Class,Strand (sense/antisense/both),Feature Source,Hierarchy,"
+                    "5' End Nucleotide,Length\n")
+            for rule in ['Class,CSR,antisense,{},1,G,20-24', 'Class,CSR,sense,{},3,any,any',
+                         'Class,WAGO,antisense,{},2,"A,G",16-35', 'Class,unknown,both,{},2,U,20;22']:
+                f.write(rule.format(os.path.relpath(self.gff, self.tmp.name)) + '\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def expected(self, alns, mask=None):
+        """Checks every feature against every rule, one alignment at a time"""
+        rules = read_rules(self.features_csv)
+        feats = list(HTSeq.GFF_Reader(self.gff))
+        masks = [m.iv for m in HTSeq.GFF_Reader(mask)] if mask else []
+
+        # Positions of a feature covered by masks on its strand don't overlap alignments
+        def overlaps(feat_iv, strand, iv):
+            covering = [m for m in masks if m.chrom == feat_iv.chrom and m.strand in (strand, '.')]
+            return feat_iv.chrom == iv.chrom and \
+                any(not any(m.start <= p < m.end for m in covering)
+                    for p in range(max(feat_iv.start, iv.start), min(feat_iv.end, iv.end)))
+
+        results = []
+        for aln in alns:
+            iv, read = aln.iv, aln.read
+            candidates = []
+            for feat in feats:
+                for strand in [feat.iv.strand] if feat.iv.strand in ('+', '-') else ['+', '-']:
+                    if not overlaps(feat.iv, strand, iv): continue
+                    relation = 'sense' if strand == iv.strand else 'antisense'
+                    for rule in rules:
+                        lengths = parse_length(rule.length)
+                        if rule.matches(feat) and rule.strand in (relation, 'both') \
+                                and (read[0] in rule.nt.replace('U', 'T') or rule.nt == 'any') \
+                                and (not lengths or any(lo <= len(read) <= hi for lo, hi in lengths)):
+                            candidates.append((rule.hierarchy, feat.attr['ID'], rule.feature_class))
+            best = [c for c in candidates if c[0] == min(candidates)[0]] if candidates else []
+            results.append((sorted({c[1] for c in best}), sorted({c[2] for c in best})))
+        return results
+
+    def assign(self, alns, mask=None, cache_dir=None):
+        selector = FeatureSelector(read_rules(self.features_csv))
+        ref_dict, registry = smrna.create_ref_dict([self.gff], None, [mask] if mask else None,
+                                                   cache_dir=cache_dir, selector=selector)
+        assigner = smrna.FeatureAssigner(ref_dict, registry, selector)
+        return [(sorted(registry.feature_names[f] for f in feats),
+                 sorted(registry.class_names[c] for c in classes))
+                for _, _, _, _, feats, classes in assigner.assign(alns)]
+
+    def random_alignments(self, n):
+        bounds = [f.iv.start for f in HTSeq.GFF_Reader(self.gff)] + \
+                 [f.iv.end for f in HTSeq.GFF_Reader(self.gff)]
+        np.random.seed(2)
+        alns = []
+        for _ in range(n):
+            start = max(int(np.random.choice(bounds)) + np.random.randint(-30, 30), 0)
+            length = np.random.randint(15, 36)
+            read = ''.join(np.random.choice(list('ACGT'), length))
+            strand = ['+', '-'][np.random.randint(2)]
+            alns.append(SimpleNamespace(read=read, iv=HTSeq.GenomicInterval('I', start, start + length, strand)))
+        return alns
+
+    def test_rules_match_brute_force(self):
+        alns = self.random_alignments(1500)
+        result = self.assign(alns)
+        self.assertEqual(self.expected(alns), result)
+        self.assertGreater(sum(1 for feats, _ in result if feats), 100)
+        self.assertEqual(self.expected(alns, self.mask), self.assign(alns, self.mask))
+
+    def test_cached_rules(self):
+        alns = self.random_alignments(500)
+        with tempfile.TemporaryDirectory() as cache:
+            built = self.assign(alns, self.mask, cache)
+            self.assertEqual(len(os.listdir(cache)), 1)
+            self.assertEqual(built, self.assign(alns, self.mask, cache))
+
+    def test_multiple_features_of_one_class(self):
+        registry = FeatureRegistry()
+        registry.add('a', 'CSR'), registry.add('b', 'CSR')
+        assigner = smrna.FeatureAssigner({}, registry)
+        class_counts, feat_counts = assigner.new_counts()
+        stats, nt_len_mat = smrna.Counter(), {nt: smrna.Counter() for nt in 'ACGT'}
+
+        # Both features share the read's count, and its class is counted in full
+        smrna.tally_bundle('seq_1_x4', [('GACT', '+', 0, 4, (0, 1), (0,))], assigner,
+                           class_counts, feat_counts, stats, nt_len_mat)
+        np.testing.assert_array_equal(feat_counts, [2, 2])
+        np.testing.assert_array_equal(class_counts, [4, 0])
+        self.assertEqual(stats['_ambiguous_reads_features'], 4)
+
+    def test_parse_rules(self):
+        self.assertEqual(parse_length('16-35'), [(16, 35)])
+        self.assertEqual(parse_length('20, 22-24'), [(20, 20), (22, 24)])
+        self.assertEqual(parse_length('any'), [])
+        self.assertEqual(parse_nt('U'), parse_nt('T'))
+        self.assertEqual(parse_nt('A,G'), parse_nt('A') | parse_nt('G'))
+        for spec in ['24-20', 'x']:
+            with self.assertRaises(ValueError):
+                parse_length(spec)
+        with self.assertRaises(ValueError):
+            parse_nt('Z')
+
+class test_aln_table(unittest.TestCase):
+    """
+    Testing that the background alignment table writer writes the same table as the
+    counter's text output in each format, and appends chunk tables in order.
+    """
+    def setUp(self):
+        self.registry = FeatureRegistry()
+        self.registry.add('WBGene_1', 'miRNA')
+        self.registry.add('WBGene_2', 'piRNA')
+        self.bundles = [(1.0, [('ACGT', '+', 0, 4, (0,), (0,))]),
+                        (0.5, [('TTGA', '-', 10, 14, (1, 0), (1, 0)),
+                               ('TTGA', '+', 20, 24, (), ())])]
+        self.expected = pd.DataFrame(
+            [['ACGT', 1.0, '+', 0, 4, 'miRNA', 'WBGene_1'],
+             ['TTGA', 0.5, '-', 10, 14, 'miRNA;piRNA', 'WBGene_1;WBGene_2'],
+             ['TTGA', 0.5, '+', 20, 24, '_no_class', '_no_feature']],
+            columns=aln_table.COLUMNS)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, fmt, batch_size=1):
+        path = os.path.join(self.tmp.name, 'table' + aln_table.FORMATS[fmt])
+        with AlnTableWriter(path, self.registry, fmt, batch_size=batch_size, queue_size=1) as writer:
+            for counts, assignments in self.bundles:
+                writer.add(counts, assignments)
+        return path
+
+    def test_text_formats(self):
+        for fmt in ['txt', 'gz']:
+            for batch_size in [1, 100]:
+                result = read_aln_table(self.write(fmt, batch_size))
+                pd.testing.assert_frame_equal(self.expected, result)
+
+        with open(self.write('txt')) as f:
+            self.assertEqual(f.readline(), '\t'.join(aln_table.COLUMNS) + '\n')
+            self.assertEqual(f.readline(), 'ACGT\t1.0\t+\t0\t4\tmiRNA\tWBGene_1\n')
+
+    @unittest.skipUnless(aln_table.pa is not None, 'requires pyarrow')
+    def test_columnar_formats(self):
+        for fmt in ['parquet', 'feather']:
+            result = read_aln_table(self.write(fmt))
+            pd.testing.assert_frame_equal(self.expected, result, check_dtype=False)
+
+    def test_add_table(self):
+        chunk = os.path.join(self.tmp.name, 'chunk.txt')
+        with AlnTableWriter(chunk, self.registry, header=False) as writer:
+            writer.add(*self.bundles[1])
+
+        for fmt in aln_table.available_formats():
+            path = os.path.join(self.tmp.name, 'appended' + aln_table.FORMATS[fmt])
+            with AlnTableWriter(path, self.registry, fmt) as writer:
+                writer.add(*self.bundles[0])
+                writer.add_table(chunk)
+            pd.testing.assert_frame_equal(self.expected, read_aln_table(path), check_dtype=False)
+
+    def test_writer_errors_are_raised(self):
+        path = os.path.join(self.tmp.name, 'table.txt')
+        writer = AlnTableWriter(path, self.registry, batch_size=1)
+        writer.add(1.0, [('ACGT', '+', 0, 4, (5,), (0,))])  # Unknown feature ID
+        with self.assertRaises(IndexError):
+            writer.flush()
+        with self.assertRaises(IndexError):
+            writer.close()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+""" unit tests for functions in merge_samples.py and count_matrix.py """
+
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import aquatx.srna.merge_samples as merge
+
+from aquatx.srna import count_matrix
+from aquatx.srna.count_stats import RATES, STATS_KEYS, read_stats, write_stats
+from aquatx.srna.count_store import CountStore
+from aquatx.srna.count_matrix import merge_count_files, read_count_matrix, read_counts, write_count_matrix
+
+class test_fused_merge(unittest.TestCase):
+    """
+    Testing that the fused merge engine produces the same counts as the pandas
+    merge, aligns files which list different features, and writes each format.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        np.random.seed(0)
+        self.features = [f"Gene:WBGene{i:08d}" for i in range(500)]
+        self.samples = [f"sample_{i}" for i in range(12)]
+        self.counts = np.random.randint(0, 1000, (500, 12)) / np.random.randint(1, 7, (500, 12))
+        self.files = [self.write_counts(f"{sample}.txt", self.features, self.counts[:, j])
+                      for j, sample in enumerate(self.samples)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_counts(self, name, features, counts):
+        path = os.path.join(self.tmp.name, name)
+        pd.DataFrame({'feature': features, 'count': counts}).to_csv(path, sep='\t', header=False, index=False)
+        return path
+
+    def test_matches_pandas_merge(self):
+        expected = merge.merge_counts(self.files, self.samples)
+        for workers in [1, 4]:
+            result = merge_count_files(self.files, self.samples, workers)
+            self.assertEqual(result.features, expected.index.tolist())
+            self.assertEqual(result.samples, self.samples)
+            self.assertEqual(result.counts.dtype, np.float64)
+            np.testing.assert_allclose(result.counts, expected.to_numpy(dtype=np.float64))
+
+        # Counts are parsed exactly, so the CSV holds the values the counter wrote
+        path = os.path.join(self.tmp.name, 'merged.csv')
+        write_count_matrix(result, path)
+        written = pd.read_csv(path, index_col=0, dtype=str)
+        self.assertEqual(written.index.name, 'feature')
+        with open(self.files[3]) as f:
+            self.assertEqual(written[self.samples[3]].tolist(), [line.split('\t')[1].strip() for line in f])
+
+    def test_union_of_features(self):
+        files = [self.write_counts('a.txt', ['x', 'y', 'z'], [1.0, 2.0, 3.0]),
+                 self.write_counts('b.txt', ['z', 'w', 'x'], [4.0, 5.0, 6.0]),
+                 self.write_counts('c.txt', ['y, "quoted"'], [7.5])]
+        result = merge_count_files(files, ['a', 'b', 'c'])
+
+        # Features are ordered by first appearance, and are 0 where a file doesn't list them
+        self.assertEqual(result.features, ['x', 'y', 'z', 'w', 'y, "quoted"'])
+        np.testing.assert_array_equal(result.counts, [[1, 6, 0], [2, 0, 0], [3, 4, 0], [0, 5, 0], [0, 0, 7.5]])
+
+        path = os.path.join(self.tmp.name, 'union.csv')
+        write_count_matrix(result, path)
+        loaded = read_count_matrix(path)
+        self.assertEqual(loaded.features, result.features)
+        np.testing.assert_array_equal(loaded.counts, result.counts)
+
+        with self.assertRaises(ValueError):
+            merge_count_files(files, ['a', 'b'])
+
+    def test_formats(self):
+        matrix = merge_count_files(self.files, self.samples)
+        for fmt in count_matrix.available_formats():
+            path = os.path.join(self.tmp.name, 'merged' + count_matrix.FORMATS[fmt])
+            write_count_matrix(matrix, path, fmt)
+            loaded = read_count_matrix(path)
+            self.assertEqual(loaded.features, matrix.features)
+            self.assertEqual(loaded.samples, matrix.samples)
+            np.testing.assert_array_equal(loaded.counts, matrix.counts)
+
+        with self.assertRaises(ValueError):
+            write_count_matrix(matrix, os.path.join(self.tmp.name, 'merged.xlsx'), 'xlsx')
+
+    def test_sparse_formats(self):
+        counts = np.array([[0, 1.5, 0], [0, 0, 0], [2, 0, 3]])
+        matrix = count_matrix.CountMatrix(['x', 'y', 'z'], ['a', 'b', 'c'], counts)
+        sparse = count_matrix.to_sparse(matrix)
+
+        # Only nonzero counts are kept, row by row
+        np.testing.assert_array_equal(sparse.data, [1.5, 2, 3])
+        np.testing.assert_array_equal(sparse.indices, [1, 0, 2])
+        np.testing.assert_array_equal(sparse.indptr, [0, 1, 1, 3])
+        self.assertEqual(sparse.shape, (3, 3))
+
+        for fmt in ['npz', 'mtx']:
+            path = os.path.join(self.tmp.name, 'sparse' + count_matrix.FORMATS[fmt])
+            write_count_matrix(matrix, path, fmt)
+            loaded = count_matrix.read_sparse_count_matrix(path)
+            self.assertEqual((loaded.features, loaded.samples, loaded.shape), (sparse.features, sparse.samples, sparse.shape))
+            for expected, result in zip(sparse[2:5], loaded[2:5]):
+                np.testing.assert_array_equal(result, expected)
+
+        # Matrix Market names are written alongside, and entries may be in any order
+        features_file, samples_file = count_matrix.label_files(path)
+        self.assertEqual(features_file, os.path.join(self.tmp.name, 'sparse_features.txt'))
+        with open(samples_file) as f:
+            self.assertEqual(f.read(), "a\nb\nc\n")
+        with open(path, 'w') as f:
+            f.write("%%MatrixMarket matrix coordinate real general\n% comment\n3 3 3\n3 3 3\n1 2 1.5\n3 1 2\n")
+        np.testing.assert_array_equal(read_count_matrix(path).counts, counts)
+
+    def test_read_counts(self):
+        names, counts = read_counts(self.files[0])
+        self.assertEqual(names, self.features)
+        np.testing.assert_array_equal(counts, self.counts[:, 0])
+
+        path = os.path.join(self.tmp.name, 'bad.txt')
+        with open(path, 'w') as f:
+            f.write("x\t1.0\ny\n")
+        with self.assertRaises(ValueError):
+            read_counts(path)
+
+class test_count_store(unittest.TestCase):
+    """
+    Testing that a count store only reads new or changed samples, and that its
+    matrix matches merging every count file at once.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.tmp.name, 'store')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_counts(self, name, features, counts):
+        path = os.path.join(self.tmp.name, name)
+        pd.DataFrame({'feature': features, 'count': counts}).to_csv(path, sep='\t', header=False, index=False)
+        return path
+
+    def test_incremental_merge(self):
+        files = [self.write_counts('a.txt', ['x', 'y'], [1.0, 2.0]),
+                 self.write_counts('b.txt', ['y', 'z'], [3.0, 4.0])]
+        self.assertEqual(CountStore(self.store).add(files, ['a', 'b']), ['a', 'b'])
+
+        # Reopened stores skip samples with unchanged files, and append new samples and features
+        files.append(self.write_counts('c.txt', ['w', 'x'], [5.0, 6.0]))
+        store = CountStore(self.store)
+        self.assertEqual(store.add(files, ['a', 'b', 'c'], workers=2), ['c'])
+        expected = merge_count_files(files, ['a', 'b', 'c'])
+        result = CountStore(self.store).read()
+        self.assertEqual((result.features, result.samples), (expected.features, expected.samples))
+        np.testing.assert_array_equal(result.counts, expected.counts)
+        self.assertIsInstance(result.counts, np.memmap)
+
+        # A changed count file replaces its sample's column
+        self.write_counts('a.txt', ['x', 'y'], [7.0, 8.0])
+        self.assertEqual(store.add(files[:1], ['a']), ['a'])
+        np.testing.assert_array_equal(CountStore(self.store).read(['c', 'a']).counts,
+                                      [[6, 7], [0, 8], [0, 0], [5, 0]])
+        self.assertEqual(len([f for f in os.listdir(self.store) if f.endswith('.npy')]), 1)
+
+        with self.assertRaises(KeyError):
+            store.read(['d'])
+
+        # The matrix is regrown when features outgrow it, and earlier samples keep their counts
+        many = [f"feature_{i}" for i in range(40)]
+        files.append(self.write_counts('d.txt', many, np.arange(40.0)))
+        self.assertEqual(store.add(files, ['a', 'b', 'c', 'd']), ['d'])
+        expected = merge_count_files(files, ['a', 'b', 'c', 'd'])
+        np.testing.assert_array_equal(CountStore(self.store).read().counts, expected.counts)
+        self.assertEqual(len([f for f in os.listdir(self.store) if f.endswith('.npy')]), 1)
+
+class test_stats_merge(unittest.TestCase):
+    """
+    Testing that stats files are merged over the union of their statistics, that
+    JSON and legacy stats files agree, and that rates are derived for each sample.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_merge_stats(self):
+        legacy = os.path.join(self.tmp.name, 'a_stats.txt')
+        with open(legacy, 'w') as f:
+            f.write("Summary Statistics\n_aligned_reads\t10\n_aligned_reads_multi_mapping\t4\n"
+                    "_no_feature\t2.5\n")
+        structured = os.path.join(self.tmp.name, 'b_stats.json')
+        write_stats({'_aligned_reads': 20, '_ambiguous_reads_features': 5, '_new_statistic': 3}, structured)
+
+        # JSON files list every schema key, then other statistics
+        keys, values = read_stats(structured)
+        self.assertEqual(keys, STATS_KEYS + ['_new_statistic'])
+        self.assertEqual(values[keys.index('_aligned_reads')], 20)
+        keys, values = read_stats(legacy)
+        self.assertEqual(keys, ['_aligned_reads', '_aligned_reads_multi_mapping', '_no_feature'])
+        self.assertEqual(values.tolist(), [10, 4, 2.5])
+
+        align_df, feature_df, rate_df = merge.merge_stats([legacy, structured], ['a', 'b'], workers=2)
+        self.assertEqual(align_df.loc['_aligned_reads'].tolist(), [10, 20])
+        self.assertEqual(align_df.loc['_unique_sequences_aligned'].tolist(), [0, 0])
+
+        # Statistics missing from the first sample are kept
+        self.assertEqual(feature_df.loc['_new_statistic'].tolist(), [0, 3])
+        self.assertEqual(feature_df.loc['_no_feature'].tolist(), [2.5, 0])
+
+        self.assertEqual(rate_df.index.tolist(), list(RATES))
+        self.assertEqual(rate_df.loc['_multi_mapping_rate'].tolist(), [0.4, 0])
+        self.assertEqual(rate_df.loc['_no_feature_rate'].tolist(), [0.25, 0])
+        self.assertEqual(rate_df.loc['_ambiguity_rate_features'].tolist(), [0, 0.25])
+
+if __name__ == '__main__':
+    unittest.main()
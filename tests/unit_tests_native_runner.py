@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+""" unit tests for functions in native_runner.py """
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+import pandas as pd
+import aquatx.srna.counter as counter
+import aquatx.srna.native_runner as native
+
+from unittest import mock
+from aquatx.srna.Configuration import ConfigBase
+from aquatx.srna.scheduler import ResourcePool, Resources, Stage, process_context, run_pipelines
+from aquatx.srna.stage_cache import StageCache, default_cache_dir
+
+class test_native_runner(unittest.TestCase):
+    """
+    Testing that the native runner gives fastp and bowtie the options the CWL tools
+    would, and that its in-process count stage matches the counter's.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        testdata = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'counter')
+        self.gff = os.path.join(testdata, 'chr1_subset.gff3')
+        self.sam = os.path.join(testdata, 'Lib303_test.sam')
+        self.config = ConfigBase({
+            'threads': 4, 'length_required': 18, 'disable_adapter_trimming': True, 'trim_poly_x': False,
+            'in_fq': [{'class': 'File', 'path': 'a.fastq'}], 'out_fq': ['a_cleaned.fastq'],
+            'json': ['a_qc.json'], 'html': ['a_qc.html'], 'report_title': ['a_report'],
+            'bt_index_files': [{'class': 'File', 'path': '/ref/chr1.1.ebwt'}], 'ebwt': 'chr1',
+            'un': ['a_unaligned_seqs.fa'], 'outfile': ['a_aligned_seqs.sam'], 'seed': 0, 'all_aln': False,
+        })
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_commands(self):
+        self.assertEqual(native.fastp_command(self.config, 0),
+                         ['fastp', '--disable_adapter_trimming', '--qualified_quality_phred', '30',
+                          '--unqualified_percent_limit', '0', '--n_base_limit', '1',
+                          '--length_required', '18', '--length_limit', '30', '--thread', '4',
+                          '--in1', os.path.abspath('a.fastq'), '--out1', 'a_cleaned.fastq',
+                          '--json', 'a_qc.json', '--html', 'a_qc.html', '--report_title', 'a_report'])
+
+        self.assertEqual(native.bowtie_command(self.config, 0, 'a_collapsed.fa'),
+                         ['bowtie', '-f', '-v', '0', '-t', '--un', 'a_unaligned_seqs.fa', '--no-unal',
+                          '--sam', '--threads', '4', '--seed', '0', '/ref/chr1', 'a_collapsed.fa',
+                          'a_aligned_seqs.sam'])
+
+        # Bam alignments are written to stdout for samtools
+        self.config.set('bam', True)
+        self.assertEqual(native.bowtie_command(self.config, 0, 'a_collapsed.fa')[-1], '-')
+
+    def test_count(self):
+        ref_array_dict, registry = counter.create_ref_dict([self.gff], index='numpy')
+        prefixes = [os.path.join(self.tmp.name, sample) for sample in ['a', 'b']]
+        counts = [native._count(self.config, self.sam, prefix, ref_array_dict, registry, None, 1)
+                  for prefix in prefixes]
+
+        # Samples share the reference arrays, so their counts line up by feature
+        np.testing.assert_array_equal(counts[0], counts[1])
+        written = pd.read_csv(prefixes[0] + '_out_feature_counts.txt', sep='\t', header=None)
+        self.assertEqual(written[0].tolist(), registry.feature_names)
+        np.testing.assert_allclose(written[1].to_numpy(), counts[0])
+
+        ref_array_dict, registry = counter.create_ref_dict([self.gff], index='numpy')
+        stats_out = os.path.join(self.tmp.name, 'expected_stats.txt')
+        _, expected, _ = counter.tally_feature_counts(counter.HTSeq.SAM_Reader(self.sam), ref_array_dict,
+                                                      registry, stats_out)
+        np.testing.assert_array_equal(counts[0], expected)
+        with open(stats_out) as f:
+            no_feature = [line for line in f if line.startswith('_no_feature\t')]
+        self.assertEqual(len(no_feature), 1)
+
+        # Samples counted with worker processes from the scheduler's threads share the registry
+        ref_array_dict, registry = counter.create_ref_dict([self.gff], index='numpy')
+        registry.class_id('ambiguous')
+        n_classes = len(registry.class_names)
+        threaded = [None, None]
+
+        def count(i):
+            threaded[i] = native._count(self.config, self.sam, prefixes[i], ref_array_dict, registry, None, 2)
+
+        run_pipelines(['a', 'b'], [Stage('count', Resources(1), count)], ResourcePool(2))
+        for result in threaded:
+            np.testing.assert_allclose(result, expected)
+        self.assertEqual(len(registry.class_names), n_classes)
+        for suffix in ['_stats.txt', '_stats.json', '_out_class_counts.csv', '_out_nt_len_dist.csv']:
+            self.assertTrue(os.path.isfile(prefixes[1] + suffix))
+
+    def test_stage_timer(self):
+        timer = native.StageTimer()
+        for sample in ['a', 'b']:
+            with timer('count', sample):
+                pass
+        with self.assertRaises(ValueError):
+            with timer('merge'):
+                raise ValueError
+
+        self.assertEqual([(stage, sample) for stage, sample, _ in timer.times],
+                         [('count', 'a'), ('count', 'b'), ('merge', '')])
+        self.assertEqual(len(timer.summary().splitlines()), 5)
+
+        path = os.path.join(self.tmp.name, 'times.csv')
+        timer.write(path)
+        self.assertEqual(pd.read_csv(path).columns.tolist(), ['stage', 'sample', 'seconds'])
+
+class test_scheduler(unittest.TestCase):
+    """
+    Testing that samples' stages run concurrently and in order within the CPU and
+    memory budgets, and that a failed stage stops the run.
+    """
+    def run_samples(self, pool, needs, n_samples=6, fail=None):
+        lock = threading.Lock()
+        running, peaks, order = [0, 0], [0, 0], []
+
+        def stage(name, cpus, memory):
+            def run(i):
+                if (name, i) == fail: raise RuntimeError(f"{name} failed")
+                with lock:
+                    running[0] += cpus
+                    running[1] += memory
+                    peaks[:] = [max(p, r) for p, r in zip(peaks, running)]
+                    order.append((name, i))
+                time.sleep(0.02)
+                with lock:
+                    running[0] -= cpus
+                    running[1] -= memory
+            return Stage(name, Resources(cpus, memory), run)
+
+        stages = [stage(name, *pool.fit(need)) for name, need in needs]
+        run_pipelines([f"sample_{i}" for i in range(n_samples)], stages, pool)
+        return peaks, order
+
+    def test_budgets(self):
+        needs = [('fastp', Resources(2, 1)), ('bowtie', Resources(2, 3)), ('count', Resources(1, 2))]
+        peaks, order = self.run_samples(ResourcePool(4, 4), needs)
+        self.assertLessEqual(peaks[0], 4)
+        self.assertLessEqual(peaks[1], 4)
+        self.assertGreater(peaks[0], 2)
+
+        # Each sample's stages run in order, and samples overlap
+        for i in range(6):
+            self.assertEqual([name for name, j in order if j == i], ['fastp', 'bowtie', 'count'])
+        self.assertLess(order.index(('fastp', 1)), order.index(('count', 0)))
+
+        # Stages needing more than a budget are given all of it
+        pool = ResourcePool(2, 4)
+        self.assertEqual(pool.fit(Resources(8, 16)), Resources(2, 4))
+        peaks, _ = self.run_samples(ResourcePool(1), [('collapse', Resources(8))], n_samples=3)
+        self.assertEqual(peaks[0], 1)
+
+    def test_failure(self):
+        needs = [('fastp', Resources(1)), ('count', Resources(1))]
+        with self.assertRaisesRegex(RuntimeError, 'fastp failed'):
+            self.run_samples(ResourcePool(2), needs, n_samples=4, fail=('fastp', 1))
+
+        with self.assertRaises(ValueError):
+            ResourcePool(0)
+
+    def test_process_context(self):
+        # Processes are only forked when no other thread is running
+        methods = []
+        thread = threading.Thread(target=lambda: methods.append(process_context().get_start_method()))
+        thread.start()
+        thread.join()
+        self.assertNotEqual(methods[0], 'fork')
+
+    def test_config_budgets(self):
+        config = ConfigBase({'threads': 3, 'cpu_budget': 6, 'memory_budget': '8G', 'bt_index_files': []})
+        pool = native.resource_pool(config)
+        self.assertEqual((pool.cpus, pool.memory), (6, 8 << 30))
+        needs = native.stage_resources(config)
+        self.assertEqual(list(needs), ['fastp', 'collapse', 'bowtie', 'count'])
+        self.assertEqual(needs['collapse'], Resources(3, native.STAGE_MEMORY['collapse']))
+
+        # Collapse declares the budget it spills at, and count the index each worker maps
+        config.set('max_memory', '512M')
+        needs = native.stage_resources(config, feature_index_size=100)
+        self.assertEqual(needs['collapse'], Resources(3, 512 << 20))
+        self.assertEqual(needs['count'], Resources(3, native.STAGE_MEMORY['count'] + 300))
+
+        pool = native.resource_pool(ConfigBase({}))
+        self.assertEqual((pool.cpus, pool.memory), (os.cpu_count(), None))
+
+class test_stage_cache(unittest.TestCase):
+    """
+    Testing that stage results are keyed by the contents of their inputs and their
+    parameters, and that cached outputs are restored in place of rerunning stages.
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = StageCache(os.path.join(self.tmp.name, 'cache'))
+        self.input = self.write('reads.fa', '>1\nACGT\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_key(self):
+        key = self.cache.key('collapse', [self.input], {'threshold': 0})
+        copy = self.write('copy.fa', '>1\nACGT\n')
+
+        # Inputs are keyed by content, not path
+        self.assertEqual(self.cache.key('collapse', [copy], {'threshold': 0}), key)
+        self.assertNotEqual(self.cache.key('collapse', [self.input], {'threshold': 1}), key)
+        self.assertNotEqual(self.cache.key('fastp', [self.input], {'threshold': 0}), key)
+
+        self.write('reads.fa', '>1\nACGTA\n')
+        self.assertNotEqual(self.cache.key('collapse', [self.input], {'threshold': 0}), key)
+
+    def test_fetch_store(self):
+        key = self.cache.key('collapse', [self.input], {})
+        outputs = [os.path.join(self.tmp.name, name) for name in ['a_collapsed.fa', 'a_collapsed_lowcounts.fa']]
+        self.assertFalse(self.cache.fetch(key, outputs, 'collapse'))
+
+        # Outputs the stage didn't produce aren't stored
+        self.write('a_collapsed.fa', '>0_x1\nACGT\n')
+        self.cache.store(key, outputs)
+        os.remove(outputs[0])
+
+        self.assertTrue(self.cache.fetch(key, outputs, 'collapse'))
+        with open(outputs[0]) as f:
+            self.assertEqual(f.read(), '>0_x1\nACGT\n')
+        self.assertFalse(os.path.exists(outputs[1]))
+        self.assertEqual(self.cache.hits, ['collapse'])
+        self.assertEqual(default_cache_dir('run'), os.path.join('run', 'stage_cache'))
+        self.assertEqual(default_cache_dir('run', 'shared'), 'shared')
+
+    def test_cached(self):
+        output = os.path.join(self.tmp.name, 'out.txt')
+        runs = []
+
+        def run():
+            runs.append(1)
+            with open(output, 'w') as f:
+                f.write(str(len(runs)))
+
+        # The stage runs once, then its output is restored while its inputs are unchanged
+        for _ in range(2):
+            native._cached(self.cache, 'stage', [self.input], {'p': 1}, [output], run)
+        self.assertEqual(len(runs), 1)
+
+        # Rerunning a stage doesn't overwrite the cached output it was linked to
+        self.assertTrue(native._cached(self.cache, 'stage', [self.input], {'p': 1}, [output], run))
+        self.assertFalse(native._cached(self.cache, 'stage', [self.input], {'p': 2}, [output], run))
+        native._cached(self.cache, 'stage', [self.input], {'p': 1}, [output], run)
+        with open(output) as f:
+            self.assertEqual(f.read(), '1')
+
+        # Upgrading a stage's tool or aquatx reruns the stage
+        with mock.patch.object(native, 'tool_version', lambda tool: 'tool 1.0'):
+            self.assertFalse(native._cached(self.cache, 'stage', [self.input], {'p': 1}, [output], run, ['tool']))
+            self.assertTrue(native._cached(self.cache, 'stage', [self.input], {'p': 1}, [output], run, ['tool']))
+        with mock.patch.object(native, 'tool_version', lambda tool: 'tool 2.0'):
+            self.assertFalse(native._cached(self.cache, 'stage', [self.input], {'p': 1}, [output], run, ['tool']))
+        with mock.patch.object(native, '__version__', '0.0'):
+            self.assertFalse(native._cached(self.cache, 'stage', [self.input], {'p': 1}, [output], run))
+        self.assertEqual(native.tool_version('aquatx-missing-tool'), '')
+
+if __name__ == '__main__':
+    unittest.main()